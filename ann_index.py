@@ -0,0 +1,255 @@
+import os
+import json
+import zlib
+import sqlite3
+import argparse
+
+import numpy as np
+
+from similarity_engine import tokenize
+from setup_database import bump_index_version
+
+def ann_dir_for(db_path):
+    """Directory of the index built for a database: `ann/` next to the database file."""
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)), 'ann')
+
+def hash_embed(descriptions, dim=256):
+    """Embed descriptions as dense float32 vectors with the hashing trick.
+
+    Every word and word bigram is hashed to one of `dim` buckets with a hashed
+    sign, counts are damped with log(1 + count), and each vector is
+    L2-normalized so a dot product is a cosine similarity. CPU only, no training.
+    """
+    vectors = np.zeros((len(descriptions), dim), dtype=np.float32)
+    for row, description in enumerate(descriptions):
+        tokens = tokenize(description)
+        features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+        for feature in features:
+            h = zlib.crc32(feature.encode('utf-8'))
+            vectors[row, h % dim] += 1.0 if (h >> 31) & 1 else -1.0
+
+    vectors = np.sign(vectors) * np.log1p(np.abs(vectors))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return (vectors / norms).astype(np.float32)
+
+def train_centroids(vectors, n_lists, iterations=10, sample_size=50000, seed=0):
+    """Train spherical k-means centroids on a sample of the vectors."""
+    rng = np.random.default_rng(seed)
+    if len(vectors) > sample_size:
+        sample = vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))]
+    else:
+        sample = np.asarray(vectors)
+
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        for i in range(n_lists):
+            members = sample[assignments == i]
+            if len(members):
+                centroids[i] = members.sum(axis=0)
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        centroids /= norms
+    return centroids.astype(np.float32)
+
+def assign_lists(vectors, centroids, block_size=65536):
+    """Assign every vector to its nearest centroid, a block at a time."""
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), block_size):
+        block = np.asarray(vectors[start:start + block_size])
+        assignments[start:start + block_size] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+# Delta updates touching more than this share of the index retrain the centroids with a full build
+MAX_UPDATE_FRACTION = 0.2
+
+def _write_lists(directory, ids, centroids, assignments):
+    """Write the inverted lists and ids next to vectors.tmp.npy, then rename all three into place."""
+    list_members = np.argsort(assignments, kind='stable').astype(np.int32)
+    list_offsets = np.searchsorted(assignments[list_members], np.arange(len(centroids) + 1)).astype(np.int64)
+    np.savez(
+        os.path.join(directory, 'ivf.tmp.npz'),
+        centroids=centroids,
+        list_offsets=list_offsets,
+        list_members=list_members
+    )
+    with open(os.path.join(directory, 'ids.tmp.json'), 'w') as f:
+        json.dump(ids, f)
+    for name in ('vectors.npy', 'ids.json', 'ivf.npz'):
+        stem, ext = os.path.splitext(name)
+        os.replace(os.path.join(directory, f"{stem}.tmp{ext}"), os.path.join(directory, name))
+
+class ANNIndex:
+    """Inverted-file (IVF) approximate nearest-neighbour index over description embeddings.
+
+    Vectors live in a memory-mapped float32 matrix. Each vector belongs to the
+    inverted list of its nearest k-means centroid; a query scans only the
+    `nprobe` lists closest to it, so raising nprobe trades latency for recall
+    (nprobe equal to the number of lists is an exact search).
+    """
+
+    def __init__(self, ids, vectors, centroids, list_offsets, list_members, nprobe=8, version=0):
+        self.ids = ids
+        self.ordinals = {image_id: i for i, image_id in enumerate(ids)}
+        self.vectors = vectors
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_members = list_members
+        self.nprobe = nprobe
+        self.version = version
+
+    @classmethod
+    def build(cls, db_path, directory=None, dim=256, n_lists=None, nprobe=8):
+        """Embed every image description and write the index files to `directory`.
+
+        The directory defaults to ann_dir_for(db_path). Images flagged dead are
+        left out. Files are written under temporary names and renamed into
+        place, so processes still reading the previous index keep their memory
+        maps; the 'ann' index version is then bumped in the database so they
+        reload it.
+        """
+        directory = directory or ann_dir_for(db_path)
+        conn = sqlite3.connect(db_path)
+        rows = conn.execute('SELECT id, description FROM images WHERE dead = 0 ORDER BY id').fetchall()
+
+        os.makedirs(directory, exist_ok=True)
+        ids = [row[0] for row in rows]
+        vectors = np.lib.format.open_memmap(
+            os.path.join(directory, 'vectors.tmp.npy'), mode='w+', dtype=np.float32, shape=(len(ids), dim)
+        )
+        for start in range(0, len(rows), 65536):
+            chunk = rows[start:start + 65536]
+            vectors[start:start + len(chunk)] = hash_embed([row[1] for row in chunk], dim)
+        vectors.flush()
+
+        if n_lists is None:
+            n_lists = int(np.clip(4 * np.sqrt(len(ids)), 1, 4096))
+        n_lists = max(1, min(n_lists, len(ids)))
+
+        if ids:
+            centroids = train_centroids(vectors, n_lists)
+            assignments = assign_lists(vectors, centroids)
+        else:
+            centroids = np.zeros((1, dim), dtype=np.float32)
+            assignments = np.empty(0, dtype=np.int32)
+        del vectors
+        _write_lists(directory, ids, centroids, assignments)
+
+        bump_index_version(conn.cursor(), 'ann')
+        conn.commit()
+        conn.close()
+
+        print(f"ANN index built: {len(ids)} images, {len(centroids)} lists, {dim} dimensions.")
+        return cls.load(directory, nprobe)
+
+    @classmethod
+    def update(cls, db_path, image_ids, directory=None, nprobe=8, batch_size=500):
+        """Bring the index up to date after a delta ingest of `image_ids` (new or changed images).
+
+        Those images are embedded and assigned to the existing lists, and
+        images that were deleted or flagged dead since are dropped; the other
+        vectors are copied over. Falls back to a full build when there is no
+        index yet or the update covers more than MAX_UPDATE_FRACTION of it,
+        since the centroids are not retrained.
+        """
+        directory = directory or ann_dir_for(db_path)
+        if not cls.exists(directory):
+            return cls.build(db_path, directory, nprobe=nprobe)
+
+        index = cls.load(directory, nprobe)
+        conn = sqlite3.connect(db_path)
+        live = {row[0] for row in conn.execute('SELECT id FROM images WHERE dead = 0')}
+        changed = sorted(set(image_ids) & live)
+        if len(changed) > MAX_UPDATE_FRACTION * max(len(index.ids), 1):
+            conn.close()
+            return cls.build(db_path, directory, dim=index.vectors.shape[1], nprobe=nprobe)
+
+        descriptions = {}
+        for start in range(0, len(changed), batch_size):
+            batch = changed[start:start + batch_size]
+            placeholders = ', '.join('?' for _ in batch)
+            descriptions.update(conn.execute(f'SELECT id, description FROM images WHERE id IN ({placeholders})', batch))
+
+        old_assignments = np.empty(len(index.ids), dtype=np.int32)
+        for i in range(len(index.centroids)):
+            old_assignments[index.list_members[index.list_offsets[i]:index.list_offsets[i + 1]]] = i
+        changed_set = set(changed)
+        kept = np.asarray([ordinal for ordinal, image_id in enumerate(index.ids)
+                           if image_id in live and image_id not in changed_set], dtype=np.int64)
+        ids = [index.ids[ordinal] for ordinal in kept] + changed
+
+        dim = index.vectors.shape[1]
+        vectors = np.lib.format.open_memmap(
+            os.path.join(directory, 'vectors.tmp.npy'), mode='w+', dtype=np.float32, shape=(len(ids), dim)
+        )
+        for start in range(0, len(kept), 65536):
+            block = kept[start:start + 65536]
+            vectors[start:start + len(block)] = index.vectors[block]
+        added = hash_embed([descriptions[image_id] for image_id in changed], dim)
+        vectors[len(kept):] = added
+        vectors.flush()
+        del vectors
+
+        assignments = np.concatenate([old_assignments[kept], assign_lists(added, index.centroids)]).astype(np.int32)
+        _write_lists(directory, ids, index.centroids, assignments)
+
+        bump_index_version(conn.cursor(), 'ann')
+        conn.commit()
+        conn.close()
+
+        removed = sum(1 for image_id in index.ids if image_id not in live)
+        print(f"ANN index updated: {len(changed)} images embedded, {removed} removed, {len(ids)} images in total.")
+        return cls.load(directory, nprobe)
+
+    @classmethod
+    def load(cls, directory, nprobe=8):
+        """Load an index written by build, memory-mapping the vectors."""
+        with open(os.path.join(directory, 'ids.json')) as f:
+            ids = json.load(f)
+        vectors = np.load(os.path.join(directory, 'vectors.npy'), mmap_mode='r')
+        ivf = np.load(os.path.join(directory, 'ivf.npz'))
+        return cls(ids, vectors, ivf['centroids'], ivf['list_offsets'], ivf['list_members'], nprobe)
+
+    @staticmethod
+    def exists(directory):
+        """Check whether an index has been built in `directory`."""
+        return os.path.exists(os.path.join(directory, 'ivf.npz'))
+
+    def search(self, image_id, k=12, nprobe=None):
+        """Get up to k (image_id, score) pairs nearest to an image, excluding the image itself."""
+        ordinal = self.ordinals.get(image_id)
+        if ordinal is None:
+            return []
+        return self.search_vector(np.asarray(self.vectors[ordinal]), k, nprobe, exclude=ordinal)
+
+    def search_vector(self, query, k=12, nprobe=None, exclude=None):
+        """Get up to k (image_id, score) pairs nearest to a query vector."""
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        centroid_scores = self.centroids @ query
+        probed = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+
+        candidates = np.concatenate([
+            self.list_members[self.list_offsets[i]:self.list_offsets[i + 1]] for i in probed
+        ])
+        if exclude is not None:
+            candidates = candidates[candidates != exclude]
+        if len(candidates) == 0:
+            return []
+
+        # Sorted ordinals keep reads from the memory-mapped vectors sequential
+        candidates = np.sort(candidates)
+        scores = np.asarray(self.vectors[candidates]) @ query
+        k = min(k, len(candidates))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[candidates[i]], float(scores[i])) for i in top]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild the embedding (ANN) index of a database.')
+    parser.add_argument('--db', default='data/bathroom_images.db', help='path to the SQLite database')
+    parser.add_argument('--dir', help='index directory (default: ann/ next to the database)')
+    parser.add_argument('--lists', type=int, help='number of inverted lists (default: 4 * sqrt(images))')
+    args = parser.parse_args()
+
+    ANNIndex.build(args.db, args.dir, n_lists=args.lists)
@@ -1,120 +1,293 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+from flask import Flask, Response, g, render_template, request, jsonify, session, redirect, url_for
 import os
 import json
+import time
 import random
-import sqlite3
+import threading
 from datetime import datetime
 
 from process_data import CATEGORIES, process_csv_data
 from filter_data import filter_irrelevant_images
-from setup_database import setup_database, calculate_better_similarities_limited
-from recommendation_system import RecommendationSystem
+from setup_database import setup_database, stream_setup_database, delta_setup_database
+from similarity_engine import calculate_tfidf_similarities, calculate_incremental_similarities
+from ann_index import ANNIndex
+from recommendation_system import RecommendationSystem, parse_limit
 from user_preferences import UserPreferenceTracker
+from event_buffer import EventBuffer, MAX_CLIENT_EVENTS, parse_client_event, parse_client_events
+from metrics import ADMIN_TOKEN_HEADER, METRICS, MIN_SLOW_QUERY_MS, cache_samples, is_admin_request
+from thumbnails import CACHE_CONTROL, FORMATS, THUMBNAIL_WIDTHS, ThumbnailError, ThumbnailService, choose_format, variant_key
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
 
 # Global variables
 recommender = None
+event_buffer = None
+thumbnail_service = None
+thumbnail_service_lock = threading.Lock()
 db_path = 'data/bathroom_images.db'
 
-@app.route('/')
-def index():
-    """Render the home page."""
-    # Create a session ID if not exists
+def get_event_buffer():
+    """Get the write-behind buffer for interaction events, starting it on first use."""
+    global recommender, event_buffer
+    if recommender is None:
+        recommender = RecommendationSystem(db_path)
+    if event_buffer is None:
+        event_buffer = EventBuffer(recommender)
+        event_buffer.start()
+    return event_buffer
+
+def get_thumbnail_service():
+    """Get the thumbnail proxy, creating it on first use."""
+    global thumbnail_service
+    if thumbnail_service is None:
+        # Request threads can race here; a second service would leak its pool and cache index
+        with thumbnail_service_lock:
+            if thumbnail_service is None:
+                thumbnail_service = ThumbnailService()
+    return thumbnail_service
+
+def recommendation_cache_metrics():
+    """Metrics collector for the recommendation cache of the current recommender."""
+    if recommender is None:
+        return []
+    return cache_samples('recommendations', recommender.cache.stats())
+
+def thumbnail_cache_metrics():
+    """Metrics collector for the thumbnail disk cache."""
+    if thumbnail_service is None:
+        return []
+    return cache_samples('thumbnails', thumbnail_service.cache.stats())
+
+METRICS.add_collector(recommendation_cache_metrics)
+METRICS.add_collector(thumbnail_cache_metrics)
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+# Endpoints that never read the session, so their responses stay cacheable without a cookie
+SESSIONLESS_ENDPOINTS = {'static', 'get_thumbnail', 'get_metrics', 'toggle_metrics', 'get_slow_queries',
+                         'configure_slow_queries'}
+
+@app.before_request
+def ensure_session():
+    """Give the visitor a user and session id before any page or API view runs."""
+    if request.endpoint in SESSIONLESS_ENDPOINTS:
+        return
     if 'user_id' not in session:
         session['user_id'] = f"user_{random.randint(1000, 9999)}"
     if 'session_id' not in session:
         session['session_id'] = f"session_{random.randint(1000, 9999)}"
+
+# Endpoints that change or expose server internals, see metrics.ADMIN_TOKEN
+ADMIN_ENDPOINTS = {'toggle_metrics', 'get_slow_queries', 'configure_slow_queries'}
+
+@app.before_request
+def require_admin():
+    """Refuse admin endpoints to clients without the admin token (or off loopback when none is set)."""
+    if request.endpoint in ADMIN_ENDPOINTS and not is_admin_request(request.remote_addr, request.headers.get(ADMIN_TOKEN_HEADER)):
+        return jsonify({'success': False, 'error': 'Forbidden'}), 403
+
+@app.after_request
+def record_request_metrics(response):
+    """Record the request latency under its route rule, e.g. /api/similar/<image_id>.
+    
+    Flask also runs this for the 500 response of a view that raised.
+    """
+    start = g.pop('request_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        METRICS.observe_request(route, request.method, response.status_code, time.perf_counter() - start)
+    return response
+
+@app.teardown_appcontext
+def release_connection(exception):
+    """Hand the request thread's database connection back to the pool."""
+    if recommender is not None:
+        recommender.db.release()
+
+@app.route('/metrics')
+def get_metrics():
+    """Prometheus scrape endpoint."""
+    return Response(METRICS.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/admin/metrics', methods=['POST'])
+def toggle_metrics():
+    """Switch instrumentation on or off at runtime with {"enabled": true | false}."""
+    data = request.get_json(silent=True)
+    enabled = data.get('enabled') if isinstance(data, dict) else None
+    
+    if not isinstance(enabled, bool):
+        return jsonify({'success': False, 'error': 'Invalid parameters'}), 400
     
+    METRICS.enabled = enabled
+    return jsonify({'success': True, 'enabled': METRICS.enabled})
+
+@app.route('/admin/slow-queries')
+def get_slow_queries():
+    """Get the slow-query log, newest first, with each query's plan and flags."""
+    limit = request.args.get('limit', type=int)
+    slow_queries = METRICS.slow_queries
+    return jsonify({
+        'threshold_ms': slow_queries.threshold_ms,
+        'recorded': slow_queries.recorded,
+        'queries': slow_queries.entries(limit)
+    })
+
+@app.route('/admin/slow-queries', methods=['POST'])
+def configure_slow_queries():
+    """Change the threshold with {"threshold_ms": number >= MIN_SLOW_QUERY_MS} and/or empty the log with {"clear": true}."""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'success': False, 'error': 'Invalid parameters'}), 400
+    
+    threshold_ms = data.get('threshold_ms')
+    if threshold_ms is not None and (isinstance(threshold_ms, bool) or not isinstance(threshold_ms, (int, float)) or threshold_ms < MIN_SLOW_QUERY_MS):
+        return jsonify({'success': False, 'error': 'Invalid parameters'}), 400
+    
+    if threshold_ms is not None:
+        METRICS.slow_queries.threshold_ms = threshold_ms
+    if data.get('clear'):
+        METRICS.slow_queries.clear()
+    return jsonify({'success': True, 'threshold_ms': METRICS.slow_queries.threshold_ms})
+
+@app.route('/')
+def index():
+    """Render the home page."""
     return render_template('index.html', categories=CATEGORIES)
 
 @app.route('/api/images')
 def get_images():
     """API endpoint to get images."""
     category = request.args.get('category', 'all')
-    limit = int(request.args.get('limit', 12))
+    cursor = request.args.get('cursor')
+    try:
+        limit = parse_limit(request.args.get('limit'))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Invalid limit'}), 400
+    
+    # Per-session seed so the within-page shuffle is stable for a user
+    if 'feed_seed' not in session:
+        session['feed_seed'] = random.getrandbits(32)
     
     global recommender
     if recommender is None:
         recommender = RecommendationSystem(db_path)
     
-    if category == 'all':
-        images = recommender.get_initial_recommendations(limit)
-    elif category == 'for-you':
-        images = recommender.get_personalized_recommendations(session['user_id'], limit)
-    else:
-        images = recommender.get_recommendations_by_category(category, limit)
+    try:
+        page = recommender.get_feed_page(
+            category,
+            limit,
+            cursor=cursor,
+            user_id=session.get('user_id'),
+            seed=session['feed_seed']
+        )
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Invalid cursor'}), 400
     
-    return jsonify(images)
+    return jsonify(page)
 
 @app.route('/api/similar/<image_id>')
 def get_similar(image_id):
     """API endpoint to get similar images."""
-    limit = int(request.args.get('limit', 12))
+    try:
+        limit = parse_limit(request.args.get('limit'))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Invalid limit'}), 400
+    cross_category = request.args.get('cross_category', '0') == '1'
     
     global recommender
     if recommender is None:
         recommender = RecommendationSystem(db_path)
     
-    images = recommender.get_similar_images(image_id, limit)
+    # Get the original image through the recommender's connection
+    original_image = recommender.get_image(image_id)
+    if original_image is None:
+        return jsonify({'success': False, 'error': 'Image not found'}), 404
     
-    # Get the original image
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM images WHERE id = ?', (image_id,))
-    original_image = dict(cursor.fetchone())
-    conn.close()
+    images = recommender.get_similar_images(image_id, limit, cross_category=cross_category)
     
     return jsonify({
         'original': original_image,
         'similar': images
     })
 
+@app.route('/img/<image_id>/<int:width>')
+def get_thumbnail(image_id, width):
+    """Serve a resized WebP or JPEG variant of an image, fetched once and cached on disk."""
+    if width not in THUMBNAIL_WIDTHS:
+        return jsonify({'success': False, 'error': f"Width must be one of {list(THUMBNAIL_WIDTHS)}"}), 404
+    
+    global recommender
+    if recommender is None:
+        recommender = RecommendationSystem(db_path)
+    
+    image = recommender.get_image(image_id)
+    if image is None:
+        return jsonify({'success': False, 'error': 'Image not found'}), 404
+    
+    fmt = choose_format(request.headers.get('Accept'))
+    key = variant_key(image['url'], width, fmt)
+    headers = {'Cache-Control': CACHE_CONTROL, 'ETag': f'"{key}"', 'Vary': 'Accept'}
+    if key in request.if_none_match:
+        return Response(status=304, headers=headers)
+    
+    try:
+        _, data = get_thumbnail_service().get(image['url'], width, fmt)
+    except ThumbnailError as e:
+        return jsonify({'success': False, 'error': str(e)}), 502
+    
+    return Response(data, content_type=FORMATS[fmt][0], headers=headers)
+
 @app.route('/api/preference', methods=['POST'])
 def record_preference():
-    """API endpoint to record user preference."""
-    data = request.json
-    image_id = data.get('image_id')
-    rating = data.get('rating')  # 1 for like, -1 for dislike
+    """API endpoint to record user preference.
     
-    if not image_id or rating not in [1, -1]:
-        return jsonify({'success': False, 'error': 'Invalid parameters'})
+    The image must exist; the like or dislike is then queued and written in
+    the background, where similarity scores are updated with the batch.
+    """
+    event = parse_client_event(request.get_json(silent=True), 'preference', session['user_id'], session['session_id'])
+    if event is None:
+        return jsonify({'success': False, 'error': 'Invalid parameters'}), 400
     
     global recommender
     if recommender is None:
         recommender = RecommendationSystem(db_path)
+    if recommender.get_image(event['image_id']) is None:
+        return jsonify({'success': False, 'error': 'Image not found'}), 404
     
-    success = recommender.record_user_preference(session['user_id'], image_id, rating)
+    get_event_buffer().record_events([event])
     
-    # Update similarity scores
-    recommender.update_similarity_scores(session['user_id'])
-    
-    return jsonify({'success': success})
+    return jsonify({'success': True})
 
 @app.route('/api/view_time', methods=['POST'])
 def record_view_time():
     """API endpoint to record view time."""
-    data = request.json
-    image_id = data.get('image_id')
-    view_time = data.get('view_time')  # in seconds
+    event = parse_client_event(request.get_json(silent=True), 'view', session['user_id'], session['session_id'])
+    if event is None:
+        return jsonify({'success': False, 'error': 'Invalid parameters'}), 400
     
-    if not image_id or not view_time:
-        return jsonify({'success': False, 'error': 'Invalid parameters'})
+    get_event_buffer().record_events([event])
     
-    global recommender
-    if recommender is None:
-        recommender = RecommendationSystem(db_path)
+    return jsonify({'success': True})
+
+@app.route('/api/events', methods=['POST'])
+def record_events():
+    """API endpoint to record a batch of like, dislike and view events."""
+    data = request.get_json(silent=True)
+    items = data.get('events') if isinstance(data, dict) else None
+    
+    if not isinstance(items, list):
+        return jsonify({'success': False, 'error': 'Invalid parameters'}), 400
+    if len(items) > MAX_CLIENT_EVENTS:
+        return jsonify({'success': False, 'error': f'At most {MAX_CLIENT_EVENTS} events per request'}), 413
     
-    success = recommender.record_view_time(
-        session['session_id'], 
-        session['user_id'], 
-        image_id, 
-        view_time
-    )
+    # Queued together, so the whole batch is written in one transaction
+    events, rejected = parse_client_events(items, session['user_id'], session['session_id'])
+    get_event_buffer().record_events(events)
     
-    return jsonify({'success': success})
+    return jsonify({'success': True, 'accepted': len(events), 'rejected': rejected})
 
 @app.route('/similar/<image_id>')
 def similar_page(image_id):
@@ -126,31 +299,51 @@ def for_you_page():
     """Render the personalized recommendations page."""
     return render_template('index.html', category='for-you')
 
-def run_enhanced_bathroom_recommender(shower_csv_path, floor_csv_path, text_files_dict):
-    """Run the enhanced bathroom image recommendation system."""
+def run_enhanced_bathroom_recommender(shower_csv_path, floor_csv_path, text_files_dict, delta=None, check_urls=False):
+    """Run the enhanced bathroom image recommendation system.
+    
+    With `delta` (the default when the database already exists) only new or
+    changed source rows are ingested and given similarities, keeping the
+    popularity accumulated so far. With `check_urls` images with dead URLs
+    are left out of the ingest.
+    """
     print("Starting Enhanced Bathroom Image Recommendation System...")
     
-    # Process data
-    print("\n1. Processing and categorizing images...")
-    categories = process_csv_data(shower_csv_path, floor_csv_path, text_files_dict)
+    global db_path
+    if delta is None:
+        delta = os.path.exists(db_path)
     
-    # Filter images with improved filtering
-    print("\n2. Filtering irrelevant images with enhanced keywords...")
-    filtered_categories = filter_irrelevant_images(categories)
+    if delta:
+        print("\n1-3. Ingesting new and changed images...")
+        db_path, changed_ids = delta_setup_database(
+            shower_csv_path, floor_csv_path, text_files_dict, db_path=db_path, check_urls=check_urls
+        )
     
-    # Setup database
-    print("\n3. Setting up database...")
-    global db_path
-    db_path = setup_database(filtered_categories)
+        print("\n4. Calculating similarities for new images...")
+        calculate_incremental_similarities(db_path, changed_ids, top_k=20)
+    else:
+        # Process, filter and insert the data chunk by chunk
+        print("\n1-3. Categorizing, filtering and ingesting images...")
+        db_path = stream_setup_database(shower_csv_path, floor_csv_path, text_files_dict, check_urls=check_urls)
     
-    # Calculate better similarities with limits
-    print("\n4. Calculating enhanced image similarities (limited version)...")
-    calculate_better_similarities_limited(filtered_categories, db_path, max_images_per_category=50)
+        # Calculate text similarities for the whole catalog
+        print("\n4. Calculating TF-IDF image similarities...")
+        calculate_tfidf_similarities(db_path, top_k=20, workers=os.cpu_count() or 1)
+    
+    # Build the embedding index for cross-category "more like this", or bring it up to date
+    if delta:
+        ANNIndex.update(db_path, changed_ids)
+    else:
+        ANNIndex.build(db_path)
     
     # Create global recommender
     global recommender
     recommender = RecommendationSystem(db_path)
     
+    # Rotate equally popular images before serving, while no feed cursors are in use
+    rotated = recommender.refresh_feed_ranking()
+    print(f"Re-drew the feed tiebreak of {rotated} images.")
+    
     print("\n5. Starting web server...")
     app.run(host='0.0.0.0', port=5000, debug=True)
     
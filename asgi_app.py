@@ -0,0 +1,351 @@
+"""ASGI serving mode for the bathroom image recommender.
+
+Serves the same pages and API as app.py, but the handlers are async: SQLite
+work runs on a bounded thread pool (each worker thread keeps its own
+connection) and like/view events are queued in the write-behind EventBuffer,
+so those endpoints answer before anything is persisted. Run with:
+
+    BATHROOM_DB=data/bathroom_images.db uvicorn asgi_app:app --host 0.0.0.0 --port 8000
+"""
+import os
+import time
+import random
+import asyncio
+import functools
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.sessions import SessionMiddleware
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Mount, Route
+from starlette.staticfiles import StaticFiles
+from starlette.templating import Jinja2Templates
+
+from process_data import CATEGORIES
+from recommendation_system import RecommendationSystem, parse_limit
+from event_buffer import EventBuffer, MAX_CLIENT_EVENTS, parse_client_event, parse_client_events
+from metrics import ADMIN_TOKEN_HEADER, METRICS, MIN_SLOW_QUERY_MS, cache_samples, is_admin_request
+from thumbnails import CACHE_CONTROL, FORMATS, THUMBNAIL_WIDTHS, ThumbnailError, ThumbnailService, choose_format, variant_key
+
+DB_PATH = os.environ.get('BATHROOM_DB', 'data/bathroom_images.db')
+DB_WORKERS = int(os.environ.get('BATHROOM_DB_WORKERS', 8))
+# Set a fixed key when running several worker processes so sessions are valid in all of them
+SECRET_KEY = os.environ.get('BATHROOM_SECRET_KEY') or os.urandom(24).hex()
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+templates = Jinja2Templates(directory=os.path.join(BASE_DIR, 'templates'))
+# The templates are shared with the Flask app and use its url_for('static', filename=...) form
+templates.env.globals['url_for'] = lambda endpoint, filename: f'/static/{filename}'
+
+async def run_db(request, fn, *args, **kwargs):
+    """Run blocking database work on the bounded DB thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(request.app.state.db_executor, functools.partial(fn, *args, **kwargs))
+
+def ensure_session(request):
+    """Give the visitor a user and session id, as the Flask index page does."""
+    session = request.session
+    if 'user_id' not in session:
+        session['user_id'] = f"user_{random.randint(1000, 9999)}"
+    if 'session_id' not in session:
+        session['session_id'] = f"session_{random.randint(1000, 9999)}"
+    return session
+
+def admin_forbidden(request):
+    """A 403 response for clients without the admin token (or off loopback when none is set), else None."""
+    client_host = request.client.host if request.client else None
+    if is_admin_request(client_host, request.headers.get(ADMIN_TOKEN_HEADER)):
+        return None
+    return JSONResponse({'success': False, 'error': 'Forbidden'}, status_code=403)
+
+async def index(request):
+    """Render the home page."""
+    ensure_session(request)
+    return templates.TemplateResponse(request, 'index.html', {'categories': CATEGORIES})
+
+async def similar_page(request):
+    """Render the similar images page."""
+    return templates.TemplateResponse(request, 'similar.html', {'image_id': request.path_params['image_id']})
+
+async def for_you_page(request):
+    """Render the personalized recommendations page."""
+    return templates.TemplateResponse(request, 'index.html', {'category': 'for-you'})
+
+async def get_images(request):
+    """API endpoint to get images."""
+    category = request.query_params.get('category', 'all')
+    cursor = request.query_params.get('cursor')
+    try:
+        limit = parse_limit(request.query_params.get('limit'))
+    except ValueError:
+        return JSONResponse({'success': False, 'error': 'Invalid limit'}, status_code=400)
+
+    session = ensure_session(request)
+    if 'feed_seed' not in session:
+        session['feed_seed'] = random.getrandbits(32)
+
+    try:
+        page = await run_db(
+            request,
+            request.app.state.recommender.get_feed_page,
+            category,
+            limit,
+            cursor=cursor,
+            user_id=session['user_id'],
+            seed=session['feed_seed']
+        )
+    except ValueError:
+        return JSONResponse({'success': False, 'error': 'Invalid cursor'}, status_code=400)
+
+    return JSONResponse(page)
+
+async def get_similar(request):
+    """API endpoint to get similar images."""
+    image_id = request.path_params['image_id']
+    try:
+        limit = parse_limit(request.query_params.get('limit'))
+    except ValueError:
+        return JSONResponse({'success': False, 'error': 'Invalid limit'}, status_code=400)
+    cross_category = request.query_params.get('cross_category', '0') == '1'
+    recommender = request.app.state.recommender
+
+    def load():
+        original = recommender.get_image(image_id)
+        if original is None:
+            return None, []
+        return original, recommender.get_similar_images(image_id, limit, cross_category=cross_category)
+
+    original_image, images = await run_db(request, load)
+    if original_image is None:
+        return JSONResponse({'success': False, 'error': 'Image not found'}, status_code=404)
+
+    return JSONResponse({
+        'original': original_image,
+        'similar': images
+    })
+
+async def get_thumbnail(request):
+    """Serve a resized WebP or JPEG variant of an image, fetched once and cached on disk."""
+    image_id = request.path_params['image_id']
+    width = request.path_params['width']
+    if width not in THUMBNAIL_WIDTHS:
+        return JSONResponse({'success': False, 'error': f"Width must be one of {list(THUMBNAIL_WIDTHS)}"}, status_code=404)
+
+    image = await run_db(request, request.app.state.recommender.get_image, image_id)
+    if image is None:
+        return JSONResponse({'success': False, 'error': 'Image not found'}, status_code=404)
+
+    fmt = choose_format(request.headers.get('accept'))
+    key = variant_key(image['url'], width, fmt)
+    headers = {'Cache-Control': CACHE_CONTROL, 'ETag': f'"{key}"', 'Vary': 'Accept'}
+    if f'"{key}"' in request.headers.get('if-none-match', ''):
+        return Response(status_code=304, headers=headers)
+
+    # Downloads and disk reads run on the default pool so they do not hold DB workers
+    loop = asyncio.get_running_loop()
+    try:
+        _, data = await loop.run_in_executor(None, request.app.state.thumbnails.get, image['url'], width, fmt)
+    except ThumbnailError as e:
+        return JSONResponse({'success': False, 'error': str(e)}, status_code=502)
+
+    return Response(data, media_type=FORMATS[fmt][0], headers=headers)
+
+async def read_json(request):
+    """The request body as JSON, or None if it is not valid JSON."""
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+async def record_preference(request):
+    """API endpoint to record user preference. Returns before the event is written.
+
+    The image must exist; the like or dislike is then queued and written in
+    the background.
+    """
+    session = ensure_session(request)
+    event = parse_client_event(await read_json(request), 'preference', session['user_id'], session['session_id'])
+    if event is None:
+        return JSONResponse({'success': False, 'error': 'Invalid parameters'}, status_code=400)
+
+    if await run_db(request, request.app.state.recommender.get_image, event['image_id']) is None:
+        return JSONResponse({'success': False, 'error': 'Image not found'}, status_code=404)
+
+    request.app.state.event_buffer.record_events([event])
+
+    return JSONResponse({'success': True})
+
+async def record_view_time(request):
+    """API endpoint to record view time. Returns before the event is written."""
+    session = ensure_session(request)
+    event = parse_client_event(await read_json(request), 'view', session['user_id'], session['session_id'])
+    if event is None:
+        return JSONResponse({'success': False, 'error': 'Invalid parameters'}, status_code=400)
+
+    request.app.state.event_buffer.record_events([event])
+
+    return JSONResponse({'success': True})
+
+async def record_events(request):
+    """API endpoint to record a batch of like, dislike and view events. Returns before they are written."""
+    data = await read_json(request)
+    items = data.get('events') if isinstance(data, dict) else None
+
+    if not isinstance(items, list):
+        return JSONResponse({'success': False, 'error': 'Invalid parameters'}, status_code=400)
+    if len(items) > MAX_CLIENT_EVENTS:
+        return JSONResponse({'success': False, 'error': f'At most {MAX_CLIENT_EVENTS} events per request'}, status_code=413)
+
+    session = ensure_session(request)
+    events, rejected = parse_client_events(items, session['user_id'], session['session_id'])
+    request.app.state.event_buffer.record_events(events)
+
+    return JSONResponse({'success': True, 'accepted': len(events), 'rejected': rejected})
+
+async def get_metrics(request):
+    """Prometheus scrape endpoint."""
+    return Response(METRICS.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
+
+async def toggle_metrics(request):
+    """Switch instrumentation on or off at runtime with {"enabled": true | false}."""
+    forbidden = admin_forbidden(request)
+    if forbidden is not None:
+        return forbidden
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    enabled = data.get('enabled') if isinstance(data, dict) else None
+
+    if not isinstance(enabled, bool):
+        return JSONResponse({'success': False, 'error': 'Invalid parameters'}, status_code=400)
+
+    METRICS.enabled = enabled
+    return JSONResponse({'success': True, 'enabled': METRICS.enabled})
+
+async def get_slow_queries(request):
+    """Get the slow-query log, newest first, with each query's plan and flags."""
+    forbidden = admin_forbidden(request)
+    if forbidden is not None:
+        return forbidden
+    try:
+        limit = int(request.query_params['limit'])
+    except (KeyError, ValueError):
+        limit = None
+    slow_queries = METRICS.slow_queries
+    return JSONResponse({
+        'threshold_ms': slow_queries.threshold_ms,
+        'recorded': slow_queries.recorded,
+        'queries': slow_queries.entries(limit)
+    })
+
+async def configure_slow_queries(request):
+    """Change the threshold with {"threshold_ms": number >= MIN_SLOW_QUERY_MS} and/or empty the log with {"clear": true}."""
+    forbidden = admin_forbidden(request)
+    if forbidden is not None:
+        return forbidden
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        return JSONResponse({'success': False, 'error': 'Invalid parameters'}, status_code=400)
+
+    threshold_ms = data.get('threshold_ms')
+    if threshold_ms is not None and (isinstance(threshold_ms, bool) or not isinstance(threshold_ms, (int, float)) or threshold_ms < MIN_SLOW_QUERY_MS):
+        return JSONResponse({'success': False, 'error': 'Invalid parameters'}, status_code=400)
+
+    if threshold_ms is not None:
+        METRICS.slow_queries.threshold_ms = threshold_ms
+    if data.get('clear'):
+        METRICS.slow_queries.clear()
+    return JSONResponse({'success': True, 'threshold_ms': METRICS.slow_queries.threshold_ms})
+
+class RequestMetricsMiddleware:
+    """Record HTTP request latency under the matched route's path template."""
+
+    def __init__(self, app, metrics=METRICS):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not self.metrics.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The router stores the matched route in the scope, e.g. /api/similar/{image_id}
+            route = scope.get('route')
+            self.metrics.observe_request(
+                route.path if route is not None else 'unmatched', scope['method'], status,
+                time.perf_counter() - start
+            )
+
+def create_app(db_path=DB_PATH, db_workers=DB_WORKERS, secret_key=SECRET_KEY):
+    """Create the ASGI application for a database."""
+
+    @asynccontextmanager
+    async def lifespan(app):
+        app.state.db_executor = ThreadPoolExecutor(max_workers=db_workers, thread_name_prefix='db')
+        app.state.recommender = RecommendationSystem(db_path)
+        app.state.event_buffer = EventBuffer(app.state.recommender)
+        app.state.event_buffer.start()
+        app.state.thumbnails = ThumbnailService()
+        cache_metrics = METRICS.add_collector(
+            lambda: cache_samples('recommendations', app.state.recommender.cache.stats())
+        )
+        thumbnail_metrics = METRICS.add_collector(
+            lambda: cache_samples('thumbnails', app.state.thumbnails.cache.stats())
+        )
+        try:
+            yield
+        finally:
+            METRICS.remove_collector(cache_metrics)
+            METRICS.remove_collector(thumbnail_metrics)
+            app.state.thumbnails.close()
+            # Write queued events before the connections go away
+            app.state.event_buffer.stop()
+            app.state.db_executor.shutdown(wait=True)
+            app.state.recommender.close()
+
+    routes = [
+        Route('/', index),
+        Route('/similar/{image_id}', similar_page),
+        Route('/for-you', for_you_page),
+        Route('/api/images', get_images),
+        Route('/api/similar/{image_id}', get_similar),
+        Route('/img/{image_id}/{width:int}', get_thumbnail),
+        Route('/api/preference', record_preference, methods=['POST']),
+        Route('/api/view_time', record_view_time, methods=['POST']),
+        Route('/api/events', record_events, methods=['POST']),
+        Route('/metrics', get_metrics),
+        Route('/admin/metrics', toggle_metrics, methods=['POST']),
+        Route('/admin/slow-queries', get_slow_queries),
+        Route('/admin/slow-queries', configure_slow_queries, methods=['POST']),
+        Mount('/static', StaticFiles(directory=os.path.join(BASE_DIR, 'static')), name='static'),
+    ]
+
+    return Starlette(
+        routes=routes,
+        middleware=[
+            Middleware(RequestMetricsMiddleware),
+            Middleware(SessionMiddleware, secret_key=secret_key),
+        ],
+        lifespan=lifespan
+    )
+
+app = create_app()
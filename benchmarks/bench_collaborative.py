@@ -0,0 +1,105 @@
+"""Benchmark the offline item-item collaborative filtering build.
+
+Usage:
+    python benchmarks/bench_collaborative.py [interactions] [images] [users]
+
+Builds a synthetic database (default 1M likes/dislikes of 100k images by 50k
+users) where every user draws most ratings from one of a few hundred taste
+groups, times calculate_collaborative_neighbours, and compares for-you page
+latency with and without the collaborative blend.
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import tempfile
+import statistics
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from process_data import CATEGORIES
+from setup_database import migrate_schema
+from collaborative_filtering import calculate_collaborative_neighbours
+from recommendation_system import RecommendationSystem
+
+TASTE_GROUPS = 500
+PAGES = 300
+
+def build_database(db_path, interactions, images, users, seed=0):
+    """Create a catalog and a clustered rating history. Returns the user ids."""
+    rng = np.random.default_rng(seed)
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    migrate_schema(cursor, analyze=False)
+
+    ids = [f"{CATEGORIES[i % len(CATEGORIES)]}_{i}" for i in range(images)]
+    cursor.executemany(
+        'INSERT INTO images (id, url, description, source, category, popularity, shuffle_key) VALUES (?, ?, ?, ?, ?, ?, ?)',
+        ((image_id, f"https://i.pinimg.com/736x/{i:08x}.jpg", 'bathroom', 'Pinterest',
+          CATEGORIES[i % len(CATEGORIES)], int(rng.integers(0, 20)), int(rng.integers(0, 2 ** 31)))
+         for i, image_id in enumerate(ids))
+    )
+
+    # Each taste group favours its own slice of the catalog; a fifth of ratings are random
+    group_of_user = rng.integers(0, TASTE_GROUPS, users)
+    user_of_rating = rng.integers(0, users, interactions)
+    slice_size = images // TASTE_GROUPS
+    in_group = rng.random(interactions) < 0.8
+    images_of_rating = np.where(
+        in_group,
+        group_of_user[user_of_rating] * slice_size + rng.integers(0, slice_size, interactions),
+        rng.integers(0, images, interactions)
+    )
+    ratings = np.where(rng.random(interactions) < 0.8, 1, -1)
+
+    user_ids = [f"user_{n}" for n in range(users)]
+    cursor.executemany(
+        'INSERT OR IGNORE INTO user_preferences (user_id, image_id, rating, timestamp) VALUES (?, ?, ?, ?)',
+        ((user_ids[user], ids[image], int(rating), '2024-01-01 00:00:00')
+         for user, image, rating in zip(user_of_rating.tolist(), images_of_rating.tolist(), ratings.tolist()))
+    )
+    cursor.execute('''
+    INSERT INTO category_preferences (user_id, category, preference_score, timestamp)
+    SELECT p.user_id, i.category, SUM(p.rating), MAX(p.timestamp)
+    FROM user_preferences p JOIN images i ON i.id = p.image_id
+    GROUP BY p.user_id, i.category
+    ''')
+    conn.commit()
+    cursor.execute('ANALYZE')
+    conn.close()
+    return user_ids
+
+def time_pages(db_path, user_ids, share):
+    """Time first for-you pages for sampled users with the given collaborative share."""
+    recommender = RecommendationSystem(db_path)
+    recommender.collaborative_share = share
+    recommender.get_collaborative_index()
+    timings = []
+    for user_id in random.Random(1).sample(user_ids, PAGES):
+        start = time.perf_counter()
+        recommender.get_personalized_recommendations(user_id, 12)
+        timings.append((time.perf_counter() - start) * 1000)
+    recommender.close()
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.99)]
+
+if __name__ == '__main__':
+    interactions = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    images = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    users = int(sys.argv[3]) if len(sys.argv) > 3 else 50000
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, 'bench.db')
+        print(f"Building {interactions} ratings of {images} images by {users} users...")
+        user_ids = build_database(db_path, interactions, images, users)
+
+        start = time.perf_counter()
+        pairs = calculate_collaborative_neighbours(db_path)
+        print(f"Collaborative build: {pairs} pairs in {time.perf_counter() - start:.1f}s")
+
+        for label, share in [('category only', 0), ('with collaborative blend', 0.25)]:
+            p50, p99 = time_pages(db_path, user_ids, share)
+            print(f"for-you page, {label}: p50 {p50:.2f} ms, p99 {p99:.2f} ms")
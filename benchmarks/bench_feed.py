@@ -0,0 +1,124 @@
+"""Benchmark feed query latency: ORDER BY RANDOM() versus the precomputed ranking.
+
+Usage:
+    python benchmarks/bench_feed.py [catalog sizes...]
+
+Builds a synthetic catalog for each size (default 100k and 1M images) in a
+temporary directory and prints p50/p99 latency for the 'all', category and
+personalized feed queries.
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from process_data import CATEGORIES
+from setup_database import setup_database
+from recommendation_system import RecommendationSystem
+
+RUNS = 200
+PAGE_SIZE = 12
+
+# The queries the feed used before the ranking column existed
+RANDOM_ORDER_QUERIES = {
+    'all': ('SELECT * FROM images ORDER BY popularity DESC, RANDOM() LIMIT ?', lambda c: (PAGE_SIZE,)),
+    'category': (
+        'SELECT * FROM images WHERE category = ? ORDER BY popularity DESC, RANDOM() LIMIT ?',
+        lambda c: (c, PAGE_SIZE)
+    ),
+    'personalized': ('''
+        SELECT i.* FROM images i
+        LEFT JOIN user_preferences p ON i.id = p.image_id AND p.user_id = ?
+        WHERE i.category = ? AND (p.rating IS NULL OR p.rating > 0)
+        ORDER BY i.popularity DESC, RANDOM()
+        LIMIT ?''', lambda c: ('bench_user', c, PAGE_SIZE)
+    ),
+}
+
+def build_catalog(size, workdir):
+    """Create a database with `size` synthetic images and return its path."""
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        db_path = os.path.abspath(setup_database({category: [] for category in CATEGORIES}))
+    finally:
+        os.chdir(cwd)
+
+    rng = random.Random(size)
+    conn = sqlite3.connect(db_path)
+    rows = (
+        (
+            f"bench_{i}",
+            f"https://example.com/{i}.jpg",
+            'bathroom image',
+            'Benchmark',
+            CATEGORIES[i % len(CATEGORIES)],
+            rng.choice([0, 0, 0, 0.5, 1, 2, 5]),
+            rng.randrange(2 ** 31)
+        )
+        for i in range(size)
+    )
+    conn.executemany(
+        'INSERT INTO images (id, url, description, source, category, popularity, shuffle_key) VALUES (?, ?, ?, ?, ?, ?, ?)',
+        rows
+    )
+    conn.execute('ANALYZE')
+    conn.commit()
+    conn.close()
+    return db_path
+
+def percentiles(samples):
+    """Return (p50, p99) of a list of durations in milliseconds."""
+    ordered = sorted(samples)
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    return statistics.median(ordered), p99
+
+def time_calls(fn, runs=RUNS):
+    """Run fn `runs` times and return the durations in milliseconds."""
+    samples = []
+    for i in range(runs):
+        start = time.perf_counter()
+        fn(i)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+def run(size):
+    """Benchmark both query strategies against a catalog of `size` images."""
+    with tempfile.TemporaryDirectory() as workdir:
+        print(f"\nBuilding catalog with {size} images...")
+        db_path = build_catalog(size, workdir)
+        recommender = RecommendationSystem(db_path)
+        recommender.cursor.executemany(
+            'INSERT INTO category_preferences (user_id, category, preference_score) VALUES (?, ?, ?)',
+            [('bench_user', category, i + 1) for i, category in enumerate(CATEGORIES[:3])]
+        )
+        recommender.conn.commit()
+
+        category_at = lambda i: CATEGORIES[i % len(CATEGORIES)]
+        ranked = {
+            'all': lambda i: recommender.get_initial_recommendations(PAGE_SIZE),
+            'category': lambda i: recommender.get_recommendations_by_category(category_at(i), PAGE_SIZE),
+            'personalized': lambda i: recommender.get_personalized_recommendations('bench_user', PAGE_SIZE),
+        }
+
+        print(f"{'feed':<14}{'strategy':<14}{'p50 ms':>10}{'p99 ms':>10}")
+        for feed, (sql, params) in RANDOM_ORDER_QUERIES.items():
+            runs = RUNS if size <= 100000 else RUNS // 10
+            baseline = time_calls(lambda i: recommender.cursor.execute(sql, params(category_at(i))).fetchall(), runs)
+            p50, p99 = percentiles(baseline)
+            print(f"{feed:<14}{'RANDOM()':<14}{p50:>10.2f}{p99:>10.2f}")
+
+            p50, p99 = percentiles(time_calls(ranked[feed]))
+            print(f"{feed:<14}{'ranked':<14}{p50:>10.2f}{p99:>10.2f}")
+
+        recommender.close()
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100000, 1000000]
+    for size in sizes:
+        run(size)
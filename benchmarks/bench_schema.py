@@ -0,0 +1,132 @@
+"""Benchmark the similarity table with string ids versus integer keys.
+
+Usage:
+    python benchmarks/bench_schema.py [number of images] [neighbours per image]
+
+Builds a synthetic database at schema version 2 (TEXT image ids, rowid
+similarity table), measures its size and the neighbour join latency, then
+applies migration 3 (integer image keys, WITHOUT ROWID similarities) to the
+same data and measures again. Defaults to 200k images with 20 neighbours each.
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from process_data import CATEGORIES
+from setup_database import SCHEMA_MIGRATIONS, migrate_schema
+
+LOOKUPS = 2000
+
+def build_legacy(db_path, count, neighbours, seed=0):
+    """Create a version 2 database with `count` images and `neighbours` similarities each."""
+    rng = random.Random(seed)
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    for version, _, migration in SCHEMA_MIGRATIONS[:2]:
+        migration(cursor)
+        cursor.execute(f'PRAGMA user_version = {version}')
+
+    ids = [f"{CATEGORIES[i % len(CATEGORIES)]}_{i}" for i in range(count)]
+    cursor.executemany(
+        'INSERT INTO images (id, url, description, source, category, popularity, shuffle_key) VALUES (?, ?, ?, ?, ?, ?, ?)',
+        ((image_id, f"https://i.pinimg.com/736x/{i:08x}.jpg", 'modern white bathroom', 'Pinterest',
+          CATEGORIES[i % len(CATEGORIES)], rng.randint(0, 20), rng.getrandbits(31))
+         for i, image_id in enumerate(ids))
+    )
+
+    def pairs():
+        for i, image_id in enumerate(ids):
+            for _ in range(neighbours):
+                # Same category: same residue modulo the number of categories
+                j = (i + len(CATEGORIES) * rng.randint(1, count // len(CATEGORIES) - 1)) % count
+                yield image_id, ids[j], rng.random()
+
+    cursor.executemany(
+        'INSERT OR IGNORE INTO image_similarities (image_id1, image_id2, similarity_score) VALUES (?, ?, ?)',
+        pairs()
+    )
+    conn.commit()
+    cursor.execute('ANALYZE')
+    conn.close()
+    return ids
+
+def measure(db_path, sample, keyed):
+    """Vacuum the database and time the neighbour lookup join and a full neighbour scan."""
+    conn = sqlite3.connect(db_path)
+    conn.execute('VACUUM')
+    size = os.path.getsize(db_path)
+    cursor = conn.cursor()
+
+    if keyed:
+        lookup = '''
+        SELECT i.id, s.similarity_score FROM image_similarities s
+        JOIN images i ON i.image_key = s.image_key2
+        WHERE s.image_key1 = (SELECT image_key FROM images WHERE id = ?)
+        ORDER BY s.similarity_score DESC LIMIT 12
+        '''
+        scan = '''
+        SELECT s.image_key1, s.image_key2, s.similarity_score FROM image_similarities s
+        JOIN images i ON i.image_key = s.image_key2
+        ORDER BY s.image_key1, s.similarity_score DESC, i.popularity DESC
+        '''
+    else:
+        lookup = '''
+        SELECT i.id, s.similarity_score FROM image_similarities s
+        JOIN images i ON i.id = s.image_id2
+        WHERE s.image_id1 = ?
+        ORDER BY s.similarity_score DESC LIMIT 12
+        '''
+        scan = '''
+        SELECT s.image_id1, s.image_id2, s.similarity_score FROM image_similarities s
+        JOIN images i ON i.id = s.image_id2
+        ORDER BY s.image_id1, s.similarity_score DESC, i.popularity DESC
+        '''
+
+    timings = []
+    for image_id in sample:
+        start = time.perf_counter()
+        cursor.execute(lookup, (image_id,)).fetchall()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+
+    start = time.perf_counter()
+    rows = sum(1 for _ in cursor.execute(scan))
+    scan_time = time.perf_counter() - start
+    conn.close()
+
+    return {
+        'size_mb': size / 1e6,
+        'lookup_p50_ms': timings[len(timings) // 2] * 1000,
+        'lookup_p99_ms': timings[int(len(timings) * 0.99)] * 1000,
+        'scan_s': scan_time,
+        'rows': rows,
+    }
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    neighbours = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, 'bench.db')
+        print(f"Building {count} images with {neighbours} neighbours each...")
+        ids = build_legacy(db_path, count, neighbours)
+        sample = random.Random(1).sample(ids, min(LOOKUPS, len(ids)))
+
+        before = measure(db_path, sample, keyed=False)
+        start = time.perf_counter()
+        conn = sqlite3.connect(db_path)
+        migrate_schema(conn.cursor())
+        conn.close()
+        print(f"Migration 3 took {time.perf_counter() - start:.1f}s")
+        after = measure(db_path, sample, keyed=True)
+
+    print(f"{'':<16}{'string ids':>14}{'integer keys':>14}")
+    for label, key, unit in [('database size', 'size_mb', 'MB'), ('lookup p50', 'lookup_p50_ms', 'ms'),
+                             ('lookup p99', 'lookup_p99_ms', 'ms'), ('full scan', 'scan_s', 's')]:
+        print(f"{label:<16}{before[key]:>11.2f} {unit:<2}{after[key]:>11.2f} {unit:<2}")
+    assert before['rows'] == after['rows'], 'migration lost similarity rows'
@@ -0,0 +1,167 @@
+"""Load test the Flask app against the ASGI serving mode.
+
+Usage:
+    python benchmarks/bench_serving.py [--db PATH] [--concurrency N] [--duration SECONDS]
+
+Starts the Flask app (threaded development server) and the ASGI app (uvicorn)
+on the same database, one after the other, and drives each with the same mix
+of concurrent virtual users: every user opens the home page for a session and
+then loops over feed pages, similar images, likes and view times. Prints
+requests/sec and p50/p95/p99 latency per endpoint for both servers.
+"""
+import os
+import sys
+import time
+import random
+import socket
+import sqlite3
+import asyncio
+import argparse
+import subprocess
+
+import aiohttp
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Relative weights of the request types in the traffic mix
+MIX = [('feed', 6), ('similar', 3), ('preference', 1), ('view_time', 2)]
+
+def free_port():
+    """Get an unused local TCP port."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_flask(db_path, port):
+    """Start the Flask app on its threaded development server."""
+    code = (
+        'import logging, app; '
+        'logging.getLogger("werkzeug").setLevel(logging.ERROR); '
+        f'app.db_path = {db_path!r}; '
+        f'app.app.run(host="127.0.0.1", port={port}, threaded=True)'
+    )
+    return subprocess.Popen([sys.executable, '-c', code], cwd=ROOT)
+
+def start_asgi(db_path, port, db_workers):
+    """Start the ASGI app under uvicorn."""
+    env = dict(os.environ, BATHROOM_DB=db_path, BATHROOM_DB_WORKERS=str(db_workers))
+    return subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'asgi_app:app', '--host', '127.0.0.1',
+         '--port', str(port), '--log-level', 'warning', '--no-access-log'],
+        cwd=ROOT, env=env
+    )
+
+async def wait_ready(base_url, timeout=30):
+    """Wait until the server answers the home page."""
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as client:
+        while time.monotonic() < deadline:
+            try:
+                async with client.get(base_url + '/') as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"server at {base_url} did not start")
+
+async def virtual_user(base_url, image_ids, deadline, timings, seed):
+    """Issue requests from one visitor until the deadline, recording latency per request type."""
+    rng = random.Random(seed)
+    kinds = [kind for kind, _ in MIX]
+    weights = [weight for _, weight in MIX]
+    # The session cookie is set for 127.0.0.1, which the default jar refuses
+    async with aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True)) as client:
+        async with client.get(base_url + '/') as response:
+            await response.read()
+
+        next_cursor = None
+        while time.monotonic() < deadline:
+            kind = rng.choices(kinds, weights)[0]
+            image_id = rng.choice(image_ids)
+            if kind == 'feed':
+                params = {'limit': 12}
+                if next_cursor:
+                    params['cursor'] = next_cursor
+                request = client.get(base_url + '/api/images', params=params)
+            elif kind == 'similar':
+                request = client.get(f"{base_url}/api/similar/{image_id}")
+            elif kind == 'preference':
+                request = client.post(base_url + '/api/preference', json={'image_id': image_id, 'rating': rng.choice([1, -1])})
+            else:
+                request = client.post(base_url + '/api/view_time', json={'image_id': image_id, 'view_time': rng.randint(1, 30)})
+
+            start = time.perf_counter()
+            try:
+                async with request as response:
+                    body = await response.json()
+                    ok = response.status == 200
+            except aiohttp.ClientError:
+                body, ok = None, False
+            elapsed = time.perf_counter() - start
+
+            timings.setdefault(kind, []).append(elapsed if ok else None)
+            if kind == 'feed' and ok:
+                # Keep paging, and start over once the feed runs out
+                next_cursor = body.get('next_cursor')
+
+async def run_load(base_url, image_ids, concurrency, duration):
+    """Run the virtual users against a server and return the per-type timings and wall time."""
+    timings = {}
+    start = time.monotonic()
+    deadline = start + duration
+    await asyncio.gather(*(virtual_user(base_url, image_ids, deadline, timings, seed)
+                           for seed in range(concurrency)))
+    return timings, time.monotonic() - start
+
+def percentile(values, fraction):
+    """Get a percentile of sorted values."""
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def summarize(label, timings, elapsed):
+    """Print throughput and tail latency for one server."""
+    total = sum(len(values) for values in timings.values())
+    errors = sum(1 for values in timings.values() for value in values if value is None)
+    print(f"\n{label}: {total / elapsed:.0f} req/s over {elapsed:.1f}s ({total} requests, {errors} errors)")
+    print(f"  {'endpoint':<12}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for kind, _ in MIX:
+        values = sorted(value for value in timings.get(kind, []) if value is not None)
+        if not values:
+            continue
+        print(f"  {kind:<12}{len(values):>8}" + ''.join(
+            f"{percentile(values, fraction) * 1000:>10.1f}" for fraction in (0.5, 0.95, 0.99)))
+
+def sample_image_ids(db_path, count=2000):
+    """Pick image ids to request similar images and record events for."""
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute('SELECT id FROM images ORDER BY RANDOM() LIMIT ?', (count,)).fetchall()
+    conn.close()
+    return [row[0] for row in rows]
+
+def bench(label, process, base_url, image_ids, args):
+    """Load test one server process, stopping it afterwards."""
+    try:
+        asyncio.run(wait_ready(base_url))
+        timings, elapsed = asyncio.run(run_load(base_url, image_ids, args.concurrency, args.duration))
+    finally:
+        process.terminate()
+        process.wait()
+    summarize(label, timings, elapsed)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the Flask and ASGI servers under load.')
+    parser.add_argument('--db', default='data/bathroom_images.db')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--db-workers', type=int, default=8)
+    args = parser.parse_args()
+
+    db_path = os.path.abspath(args.db)
+    image_ids = sample_image_ids(db_path)
+    print(f"{args.concurrency} virtual users for {args.duration:.0f}s per server on {db_path}")
+
+    port = free_port()
+    bench('Flask (threaded)', start_flask(db_path, port), f"http://127.0.0.1:{port}", image_ids, args)
+
+    port = free_port()
+    bench('ASGI (uvicorn)', start_asgi(db_path, port, args.db_workers), f"http://127.0.0.1:{port}", image_ids, args)
@@ -0,0 +1,398 @@
+"""End-to-end benchmark suite: ingest, similarity build, event writes and HTTP latency.
+
+Usage:
+    python benchmarks/bench_suite.py [--sizes 10000 100000 1000000] [--output results.json]
+                                     [--baseline previous.json] [--concurrency 16] [--duration 15]
+
+For each catalog size a synthetic export is generated in a temporary directory
+(shower and floor tile CSVs plus a color URL file, spread over CATEGORIES, with
+a few irrelevant rows for the filter to drop), together with a synthetic
+interaction trace. The suite then measures:
+
+- ingest: process_csv_data -> filter_irrelevant_images -> setup_database
+- similarity build: calculate_tfidf_similarities
+- event writes: the trace replayed through the EventBuffer write path
+- HTTP: the Flask app under concurrent clients, p50/p95/p99 per endpoint
+
+Results are written as JSON. With --baseline, metrics that got worse by more
+than --tolerance are listed and the exit status is 1, for regression checks.
+"""
+import io
+import os
+import sys
+import csv
+import json
+import time
+import random
+import sqlite3
+import asyncio
+import argparse
+import itertools
+import platform
+import tempfile
+import subprocess
+import contextlib
+from datetime import datetime
+
+import aiohttp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from process_data import CATEGORIES, FILE_CATEGORY_MAPPING, process_csv_data
+from filter_data import filter_irrelevant_images
+from setup_database import setup_database
+from similarity_engine import calculate_tfidf_similarities
+from recommendation_system import RecommendationSystem, preference_event, view_event
+from event_buffer import EventBuffer
+from bench_serving import ROOT, free_port, percentile, start_flask, wait_ready
+
+# Category keyword placed in each description, so process_data routes the row as intended
+SHOWER_CSV_KEYWORDS = {
+    'standing_shower': 'walk in shower',
+    'bathtub': 'freestanding bathtub',
+    'mirror': 'framed mirror',
+    'vanity': 'double vanity',
+    'toilet': 'wall hung toilet',
+}
+COLOR_FILE = next(name for name, category in FILE_CATEGORY_MAPPING.items() if category == 'color')
+
+VOCABULARY = '''
+modern contemporary minimalist rustic farmhouse industrial scandinavian coastal vintage classic
+luxury traditional transitional mediterranean japanese boho art deco mid century spa retreat
+white black gray grey beige cream navy sage emerald blush terracotta charcoal ivory gold brass
+chrome nickel bronze copper matte glossy marble granite quartz concrete terrazzo travertine
+slate wood oak walnut teak bamboo stone pebble glass brick hexagon subway herringbone chevron
+penny mosaic large format plank textured fluted arched floating recessed niche skylight window
+small large narrow compact open spacious bright moody warm cool natural light double single
+'''.split()
+IRRELEVANT_WORDS = ['kitchen', 'living room', 'person', 'sofa', 'garden']
+
+# Virtual users of the load test get Flask session ids user_1000..user_9999, so the
+# trace uses the same ids and every visitor arrives with an interaction history
+TRACE_USERS = [f"user_{n}" for n in range(1000, 10000)]
+
+# Relative weights of the requests each virtual user makes
+ENDPOINT_MIX = [
+    ('feed_all', 4), ('feed_category', 3), ('feed_for_you', 2), ('similar', 3),
+    ('events', 2), ('preference', 1), ('view_time', 1)
+]
+
+@contextlib.contextmanager
+def quiet():
+    """Silence the progress output of the pipeline stages being timed."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+def build_vocabulary(size):
+    """Word pool that grows with the catalog, so each image keeps about the same number of textual neighbours.
+
+    A fixed vocabulary would make every pair of descriptions overlap more and
+    more often as the catalog grows, which real exports do not do.
+    """
+    count = max(len(VOCABULARY), size // 20)
+    words = list(VOCABULARY)
+    for length in (2, 3):
+        if len(words) < count:
+            words.extend(''.join(parts) for parts in
+                         itertools.islice(itertools.product(VOCABULARY, repeat=length), count - len(words)))
+    return words
+
+def describe(rng, vocabulary, keyword):
+    """Build a synthetic description around a category keyword."""
+    words = rng.sample(vocabulary, 5)
+    words.insert(rng.randrange(len(words) + 1), keyword)
+    # About 3% of rows are off-topic and dropped by the filter
+    if rng.random() < 0.03:
+        words.append(rng.choice(IRRELEVANT_WORDS))
+    return ' '.join(words) + ' bathroom'
+
+def generate_export(size, directory, seed=0):
+    """Write synthetic source files for about `size` images. Returns (shower_csv, floor_csv, text_files)."""
+    rng = random.Random(seed)
+    vocabulary = build_vocabulary(size)
+    shower_csv = os.path.join(directory, 'bathroom_shower_images.csv')
+    floor_csv = os.path.join(directory, 'floor_tile_images.csv')
+    color_urls = []
+
+    with open(shower_csv, 'w', newline='') as shower_file, open(floor_csv, 'w', newline='') as floor_file:
+        shower_writer, floor_writer = csv.writer(shower_file), csv.writer(floor_file)
+        shower_writer.writerow(['Image_ID', 'URL', 'Description', 'Source'])
+        floor_writer.writerow(['Image_ID', 'URL', 'Description', 'Source'])
+        for i in range(size):
+            category = CATEGORIES[i % len(CATEGORIES)]
+            url = f"https://i.pinimg.com/736x/{i:08x}.jpg"
+            if category == 'floor_tiles':
+                floor_writer.writerow([i, url, describe(rng, vocabulary, 'porcelain floor tile'), 'Pinterest'])
+            elif category == 'color':
+                color_urls.append(url)
+            else:
+                shower_writer.writerow([i, url, describe(rng, vocabulary, SHOWER_CSV_KEYWORDS[category]), 'Pinterest'])
+
+    return shower_csv, floor_csv, {COLOR_FILE: '\n'.join(color_urls)}
+
+def generate_trace(image_ids, interactions, seed=0):
+    """Build a skewed interaction trace: a few images get most of the likes and views."""
+    rng = random.Random(seed)
+    ranked = list(image_ids)
+    rng.shuffle(ranked)
+    events = []
+    for _ in range(interactions):
+        user_id = rng.choice(TRACE_USERS)
+        image_id = ranked[int(len(ranked) * rng.random() ** 3)]
+        roll = rng.random()
+        if roll < 0.2:
+            events.append(preference_event(user_id, image_id, 1))
+        elif roll < 0.3:
+            events.append(preference_event(user_id, image_id, -1))
+        else:
+            events.append(view_event(f"session_{user_id}", user_id, image_id, rng.randint(1, 30)))
+    return events
+
+def rate(count, seconds):
+    """Items per second, guarding against a zero duration."""
+    return count / seconds if seconds > 0 else 0.0
+
+def bench_ingest(export, workdir):
+    """Time the three ingest stages and return (db_path, metrics)."""
+    shower_csv, floor_csv, text_files = export
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        with quiet():
+            start = time.perf_counter()
+            categories = process_csv_data(shower_csv, floor_csv, text_files)
+            processed = time.perf_counter()
+            filtered = filter_irrelevant_images(categories)
+            filtered_at = time.perf_counter()
+            db_path = os.path.abspath(setup_database(filtered))
+            finished = time.perf_counter()
+    finally:
+        os.chdir(cwd)
+
+    rows = sum(len(images) for images in categories.values())
+    images = sum(len(images) for images in filtered.values())
+    return db_path, {
+        'source_rows': rows,
+        'images': images,
+        'process_s': processed - start,
+        'filter_s': filtered_at - processed,
+        'setup_database_s': finished - filtered_at,
+        'total_s': finished - start,
+        'rows_per_s': rate(rows, finished - start),
+    }
+
+def bench_similarities(db_path, workers):
+    """Time the TF-IDF similarity build."""
+    start = time.perf_counter()
+    with quiet():
+        calculate_tfidf_similarities(db_path, top_k=20, workers=workers)
+    elapsed = time.perf_counter() - start
+    conn = sqlite3.connect(db_path)
+    pairs = conn.execute('SELECT COUNT(*) FROM image_similarities').fetchone()[0]
+    conn.close()
+    return {'workers': workers, 'build_s': elapsed, 'pairs': pairs}
+
+def bench_events(db_path, trace, batch_size=500):
+    """Replay the trace through the write-behind buffer's flush, one transaction per batch."""
+    recommender = RecommendationSystem(db_path)
+    buffer = EventBuffer(recommender)
+    start = time.perf_counter()
+    for offset in range(0, len(trace), batch_size):
+        buffer.record_events(trace[offset:offset + batch_size])
+        buffer.flush()
+    elapsed = time.perf_counter() - start
+    recommender.close()
+    return {'events': len(trace), 'batch_size': batch_size, 'replay_s': elapsed, 'events_per_s': rate(len(trace), elapsed)}
+
+async def http_client(base_url, image_ids, deadline, timings, seed):
+    """One visitor: open the home page for a session, then issue the endpoint mix until the deadline."""
+    rng = random.Random(seed)
+    kinds = [kind for kind, _ in ENDPOINT_MIX]
+    weights = [weight for _, weight in ENDPOINT_MIX]
+    async with aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True)) as client:
+        async with client.get(base_url + '/') as response:
+            await response.read()
+
+        cursors = {}
+        while time.monotonic() < deadline:
+            kind = rng.choices(kinds, weights)[0]
+            image_id = rng.choice(image_ids)
+            if kind.startswith('feed'):
+                feed = {'feed_all': 'all', 'feed_for_you': 'for-you'}.get(kind) or rng.choice(CATEGORIES)
+                params = {'category': feed, 'limit': 12}
+                if cursors.get(feed):
+                    params['cursor'] = cursors[feed]
+                request = client.get(base_url + '/api/images', params=params)
+            elif kind == 'similar':
+                request = client.get(f"{base_url}/api/similar/{image_id}")
+            elif kind == 'events':
+                events = [{'type': 'view', 'image_id': rng.choice(image_ids), 'view_time': rng.randint(1, 30)}
+                          for _ in range(rng.randint(5, 20))]
+                events.append({'type': rng.choice(['like', 'dislike']), 'image_id': image_id})
+                request = client.post(base_url + '/api/events', json={'events': events})
+            elif kind == 'preference':
+                request = client.post(base_url + '/api/preference', json={'image_id': image_id, 'rating': rng.choice([1, -1])})
+            else:
+                request = client.post(base_url + '/api/view_time', json={'image_id': image_id, 'view_time': rng.randint(1, 30)})
+
+            start = time.perf_counter()
+            try:
+                async with request as response:
+                    body = await response.json()
+                    ok = response.status == 200
+            except aiohttp.ClientError:
+                body, ok = None, False
+            elapsed = time.perf_counter() - start
+
+            timings.setdefault(kind, []).append(elapsed if ok else None)
+            if kind.startswith('feed') and ok:
+                cursors[feed] = body.get('next_cursor')
+
+def bench_http(db_path, concurrency, duration, warmup):
+    """Load test the Flask app and return per-endpoint latency percentiles."""
+    conn = sqlite3.connect(db_path)
+    image_ids = [row[0] for row in conn.execute('SELECT id FROM images ORDER BY RANDOM() LIMIT 2000')]
+    conn.close()
+
+    async def run(base_url):
+        await wait_ready(base_url)
+        # Warm up first so lazily built indexes and caches are not counted
+        start = time.monotonic()
+        await asyncio.gather(*(http_client(base_url, image_ids, start + warmup, {}, seed)
+                               for seed in range(concurrency)))
+        timings = {}
+        start = time.monotonic()
+        await asyncio.gather(*(http_client(base_url, image_ids, start + duration, timings, seed)
+                               for seed in range(concurrency)))
+        return timings, time.monotonic() - start
+
+    port = free_port()
+    process = start_flask(db_path, port)
+    try:
+        timings, elapsed = asyncio.run(run(f"http://127.0.0.1:{port}"))
+    finally:
+        process.terminate()
+        process.wait()
+
+    total = sum(len(values) for values in timings.values())
+    endpoints = {}
+    for kind, _ in ENDPOINT_MIX:
+        values = timings.get(kind, [])
+        ok = sorted(value for value in values if value is not None)
+        endpoints[kind] = {
+            'requests': len(values),
+            'errors': len(values) - len(ok),
+            **({f"p{int(fraction * 100)}_ms": percentile(ok, fraction) * 1000 for fraction in (0.5, 0.95, 0.99)} if ok else {})
+        }
+    return {
+        'server': 'flask',
+        'concurrency': concurrency,
+        'duration_s': elapsed,
+        'requests': total,
+        'requests_per_s': rate(total, elapsed),
+        'endpoints': endpoints,
+    }
+
+def run_size(size, args):
+    """Run every stage for one catalog size."""
+    with tempfile.TemporaryDirectory() as workdir:
+        print(f"\n== {size} images ==")
+        export = generate_export(size, workdir, seed=size)
+
+        db_path, ingest = bench_ingest(export, workdir)
+        print(f"ingest: {ingest['images']} images in {ingest['total_s']:.1f}s ({ingest['rows_per_s']:.0f} rows/s)")
+
+        similarities = bench_similarities(db_path, args.workers)
+        print(f"similarities: {similarities['pairs']} pairs in {similarities['build_s']:.1f}s")
+
+        conn = sqlite3.connect(db_path)
+        image_ids = [row[0] for row in conn.execute('SELECT id FROM images')]
+        conn.close()
+        trace = generate_trace(image_ids, int(size * args.interactions_per_image), seed=size)
+        events = bench_events(db_path, trace)
+        print(f"events: {events['events']} in {events['replay_s']:.1f}s ({events['events_per_s']:.0f}/s)")
+
+        http = bench_http(db_path, args.concurrency, args.duration, args.warmup)
+        print(f"http: {http['requests_per_s']:.0f} req/s with {args.concurrency} clients")
+        for kind, stats in http['endpoints'].items():
+            if 'p50_ms' in stats:
+                print(f"  {kind:<14}{stats['p50_ms']:>8.1f}{stats['p95_ms']:>8.1f}{stats['p99_ms']:>8.1f} ms"
+                      f"  ({stats['requests']} requests, {stats['errors']} errors)")
+
+    return {'ingest': ingest, 'similarities': similarities, 'events': events, 'http': http}
+
+def git_commit():
+    """Get the commit being benchmarked, if this is a git checkout."""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def flatten(results, prefix=''):
+    """Flatten nested results into {'path.to.metric': value} for comparison."""
+    flat = {}
+    for key, value in results.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, path + '.'))
+        elif isinstance(value, (int, float)):
+            flat[path] = value
+    return flat
+
+def compare(results, baseline, tolerance):
+    """List metrics that regressed by more than `tolerance` against a baseline. Returns the regressions."""
+    current, previous = flatten(results), flatten(baseline)
+    regressions = []
+    for path, value in sorted(current.items()):
+        old = previous.get(path)
+        if not old:
+            continue
+        # Throughputs should not drop, timings should not grow
+        if path.endswith('_per_s'):
+            change = (old - value) / old
+        elif path.endswith('_ms') or path.endswith('_s'):
+            change = (value - old) / old
+        else:
+            continue
+        if change > tolerance:
+            regressions.append((path, old, value, change))
+
+    print(f"\n{len(regressions)} regressions beyond {tolerance:.0%} against the baseline")
+    for path, old, value, change in regressions:
+        print(f"  {path}: {old:.3f} -> {value:.3f} ({change:+.0%})")
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark ingest, similarity build and HTTP latency.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--interactions-per-image', type=float, default=1.0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=15)
+    parser.add_argument('--warmup', type=float, default=3)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    report = {
+        'meta': {
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'args': vars(args),
+        },
+        'results': {str(size): run_size(size, args) for size in args.sizes},
+    }
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(report['results'], baseline['results'], args.tolerance):
+            sys.exit(1)
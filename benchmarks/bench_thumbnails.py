@@ -0,0 +1,152 @@
+"""Benchmark the thumbnail proxy against a local stub image server.
+
+Usage:
+    python benchmarks/bench_thumbnails.py [images] [--latency MS] [--concurrency N]
+
+Serves generated full-size JPEGs from a local HTTP server (with optional
+added latency per request), points a synthetic catalog at it and measures
+through the Flask app's /img/<image_id>/<width> route: cold misses (fetch
+and resize), warm disk cache hits, 304 revalidations, bytes saved against
+the originals, how many fetches concurrent requests for one image cause,
+and LRU eviction under a small cache budget.
+"""
+import io
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import tempfile
+import threading
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app as flask_app
+from setup_database import migrate_schema
+from thumbnails import THUMBNAIL_WIDTHS, ThumbnailService
+
+def make_original(seed, width=1600, height=2400):
+    """A photo-sized JPEG: smooth gradients plus noise, so it compresses like a real picture."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x * 255 / width, y * 255 / height, (x + y) * 127 / (width + height)], axis=-1)
+    pixels = np.clip(base + rng.normal(0, 12, base.shape), 0, 255).astype(np.uint8)
+    output = io.BytesIO()
+    Image.fromarray(pixels).save(output, 'JPEG', quality=90)
+    return output.getvalue()
+
+class StubServer:
+    """Local HTTP server returning the same original for every path, counting requests."""
+
+    def __init__(self, body, latency=0.0):
+        stub = self
+        self.requests = 0
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests += 1
+                time.sleep(latency)
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+
+def build_database(db_path, images, base_url):
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    migrate_schema(cursor, analyze=False)
+    cursor.executemany(
+        'INSERT INTO images (id, url, description, source, category, popularity, shuffle_key) VALUES (?, ?, ?, ?, ?, ?, ?)',
+        ((f"bathtub_{i}", f"{base_url}/originals/{i}.jpg", 'bathroom', 'Pinterest', 'bathtub', 0, i)
+         for i in range(images))
+    )
+    conn.commit()
+    conn.close()
+
+def timed_get(client, path, headers=None):
+    start = time.perf_counter()
+    response = client.get(path, headers=headers or {})
+    return (time.perf_counter() - start) * 1000, response
+
+def summary(timings):
+    timings = sorted(timings)
+    return f"p50 {statistics.median(timings):.2f} ms, p95 {timings[int(len(timings) * 0.95)]:.2f} ms"
+
+def bench(images, latency, concurrency):
+    original = make_original(0)
+    stub = StubServer(original, latency / 1000)
+    accept = {'Accept': 'image/webp,image/*,*/*;q=0.8'}
+
+    with tempfile.TemporaryDirectory() as directory:
+        flask_app.db_path = os.path.join(directory, 'bench.db')
+        build_database(flask_app.db_path, images, stub.url)
+        flask_app.thumbnail_service = ThumbnailService(os.path.join(directory, 'thumbnails'))
+        client = flask_app.app.test_client()
+        width = THUMBNAIL_WIDTHS[1]
+
+        cold = []
+        for i in range(images):
+            elapsed, response = timed_get(client, f"/img/bathtub_{i}/{width}", accept)
+            assert response.status_code == 200, response.status_code
+            cold.append(elapsed)
+        variant_bytes = len(response.data)
+        print(f"original {len(original) / 1024:.0f} KB -> {width}px {response.content_type} "
+              f"{variant_bytes / 1024:.1f} KB ({len(original) / variant_bytes:.0f}x smaller)")
+        print(f"cold miss (fetch + resize), {images} images: {summary(cold)}")
+
+        warm = [timed_get(client, f"/img/bathtub_{i % images}/{THUMBNAIL_WIDTHS[i % 3]}", accept)[0]
+                for i in range(images * 3)]
+        print(f"warm hit, all widths: {summary(warm)}; origin requests so far: {stub.requests}")
+
+        etag = response.headers['ETag']
+        revalidated = [timed_get(client, f"/img/bathtub_{images - 1}/{width}", dict(accept, **{'If-None-Match': etag}))
+                       for _ in range(200)]
+        assert revalidated[0][1].status_code == 304
+        print(f"304 revalidation: {summary([elapsed for elapsed, _ in revalidated])}")
+
+        # Many requests for one uncached image should share a single download
+        before = stub.requests
+        with ThreadPoolExecutor(concurrency) as pool:
+            statuses = list(pool.map(
+                lambda _: flask_app.app.test_client().get(f"/img/bathtub_0/{width}").status_code, range(concurrency)
+            ))
+        print(f"{concurrency} concurrent requests for one new JPEG variant: "
+              f"{stub.requests - before} origin fetch(es), statuses {sorted(set(statuses))}")
+        flask_app.thumbnail_service.close()
+
+        budget = variant_bytes * 3 * 10
+        service = ThumbnailService(os.path.join(directory, 'small'), max_bytes=budget)
+        for i in range(images):
+            service.get(f"{stub.url}/originals/{i}.jpg", width, 'webp')
+        stats = service.cache.stats()
+        print(f"budget {budget / 1024:.0f} KB: {stats['entries']} files, {stats['bytes'] / 1024:.0f} KB, "
+              f"{stats['evictions']} evictions")
+        service.close()
+
+    stub.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the thumbnail proxy against a local stub server.')
+    parser.add_argument('images', type=int, nargs='?', default=50, help='catalog size')
+    parser.add_argument('--latency', type=float, default=50, help='added origin latency in ms')
+    parser.add_argument('--concurrency', type=int, default=16, help='parallel requests for one image')
+    args = parser.parse_args()
+
+    bench(args.images, args.latency, args.concurrency)
@@ -0,0 +1,156 @@
+"""Benchmark the URL health checker against local fake image hosts.
+
+Usage:
+    python benchmarks/bench_url_health.py [urls] [--hosts N] [--latency MS] [--max-per-host N]
+
+Starts N local aiohttp servers, each a separate host to the checker, serving
+a mix of live images, 404s, HTML pages, hosts that reject HEAD, 503s and
+requests that outlast the timeout. Checks that every URL gets the expected
+verdict, that no host ever sees more than --max-per-host requests at once,
+the check throughput, and that a second ingest of the same images only
+re-checks stale URLs.
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import asyncio
+import argparse
+import tempfile
+import threading
+from collections import Counter
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from setup_database import migrate_schema
+from url_health import check_urls, filter_live_images
+
+TIMEOUT = 1.0
+
+# URL kind: (share of URLs, expected verdict)
+KINDS = {
+    'ok': (0.70, 'ok'),
+    'gone': (0.10, 'dead'),
+    'page': (0.05, 'dead'),
+    'nohead': (0.08, 'ok'),
+    'busy': (0.05, 'error'),
+    'slow': (0.02, 'error'),
+}
+
+class FakeHosts:
+    """Local image hosts on their own event loop thread, tracking peak concurrency per host."""
+
+    def __init__(self, hosts, latency):
+        self.latency = latency
+        self.active = [0] * hosts
+        self.peak = [0] * hosts
+        self.requests = Counter()
+        self.ports = []
+        self.runners = []
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+        threading.Thread(target=self._run, args=(hosts, started), daemon=True).start()
+        started.wait()
+
+    def _run(self, hosts, started):
+        asyncio.set_event_loop(self.loop)
+        for host in range(hosts):
+            self.loop.run_until_complete(self._start(host))
+        started.set()
+        self.loop.run_forever()
+
+    async def _start(self, host):
+        async def handle(request):
+            kind = request.match_info['kind']
+            self.requests[request.method] += 1
+            self.active[host] += 1
+            self.peak[host] = max(self.peak[host], self.active[host])
+            try:
+                await asyncio.sleep(TIMEOUT * 2 if kind == 'slow' else self.latency)
+                if kind == 'gone':
+                    return web.Response(status=404)
+                if kind == 'busy':
+                    return web.Response(status=503)
+                if kind == 'page':
+                    return web.Response(text='<html>Pin not found</html>', content_type='text/html')
+                if kind == 'nohead' and request.method == 'HEAD':
+                    return web.Response(status=405)
+                return web.Response(body=b'\xff\xd8' + b'\0' * 2046, content_type='image/jpeg')
+            finally:
+                self.active[host] -= 1
+
+        app = web.Application()
+        app.router.add_route('*', '/{kind}/{name}', handle)
+        # Stop handlers whose client gave up, so they do not count as in flight
+        runner = web.AppRunner(app, access_log=None, handler_cancellation=True)
+        await runner.setup()
+        self.runners.append(runner)
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        self.ports.append(site._server.sockets[0].getsockname()[1])
+
+    def close(self):
+        async def cleanup():
+            for runner in self.runners:
+                await runner.cleanup()
+
+        asyncio.run_coroutine_threadsafe(cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+def make_urls(count, ports, seed=0):
+    """Random URLs over the fake hosts. Returns {url: expected verdict}."""
+    rng = random.Random(seed)
+    names = list(KINDS)
+    weights = [KINDS[name][0] for name in names]
+    expected = {}
+    for i in range(count):
+        kind = rng.choices(names, weights)[0]
+        expected[f"http://127.0.0.1:{rng.choice(ports)}/{kind}/{i}.jpg"] = KINDS[kind][1]
+    return expected
+
+def bench(count, hosts, latency, max_per_host):
+    fake = FakeHosts(hosts, latency / 1000)
+    expected = make_urls(count, fake.ports)
+
+    start = time.perf_counter()
+    results = check_urls(list(expected), max_per_host=max_per_host, timeout=TIMEOUT)
+    elapsed = time.perf_counter() - start
+    wrong = [(row[0], row[4], expected[row[0]]) for row in results if row[4] != expected[row[0]]]
+    print(f"checked {len(results)} URLs on {hosts} hosts in {elapsed:.2f}s ({len(results) / elapsed:.0f} URLs/sec), "
+          f"{dict(fake.requests)} requests")
+    print(f"verdicts: {dict(Counter(row[4] for row in results))}; wrong: {len(wrong)} {wrong[:3]}")
+    print(f"peak concurrent requests per host: {fake.peak} (limit {max_per_host})")
+
+    # Ingest stage: a second pass over the same images only checks what went stale
+    with tempfile.TemporaryDirectory() as directory:
+        conn = sqlite3.connect(os.path.join(directory, 'bench.db'))
+        cursor = conn.cursor()
+        migrate_schema(cursor, analyze=False)
+        categories = {'bathtub': [{'id': f"bathtub_{i}", 'url': url} for i, url in enumerate(expected)]}
+
+        for attempt in ('first ingest', 'second ingest', 'after errors expire'):
+            if attempt == 'after errors expire':
+                # Age the inconclusive checks past their TTL
+                cursor.execute("UPDATE url_checks SET checked_at = checked_at - 86400 WHERE verdict = 'error'")
+                conn.commit()
+            start = time.perf_counter()
+            filtered, checked = filter_live_images(cursor, categories, max_per_host=max_per_host, timeout=TIMEOUT)
+            conn.commit()
+            print(f"{attempt}: checked {checked} URLs, kept {len(filtered['bathtub'])} of {count} images "
+                  f"in {time.perf_counter() - start:.2f}s")
+        conn.close()
+
+    fake.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the URL health checker against local fake hosts.')
+    parser.add_argument('urls', type=int, nargs='?', default=5000, help='URLs to check')
+    parser.add_argument('--hosts', type=int, default=4, help='fake hosts to spread the URLs over')
+    parser.add_argument('--latency', type=float, default=20, help='response latency in ms')
+    parser.add_argument('--max-per-host', type=int, default=8, help='requests in flight per host')
+    args = parser.parse_args()
+
+    bench(args.urls, args.hosts, args.latency, args.max_per_host)
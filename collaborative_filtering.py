@@ -0,0 +1,95 @@
+import time
+import sqlite3
+import argparse
+
+import numpy as np
+import scipy.sparse as sp
+
+from setup_database import bump_index_version, migrate_schema
+from similarity_engine import top_k_neighbours, write_similarities
+
+def load_rating_matrix(cursor, min_users=2):
+    """Load user_preferences as a sparse image x user matrix with L2-normalized rows.
+
+    Likes are +1 and dislikes -1, so the dot product of two rows is the
+    cosine similarity of the two images' audiences. Images rated by fewer than
+    `min_users` users are left out: a single shared rater would make them
+    look identical. Returns (matrix, image keys of the rows).
+    """
+    cursor.execute('''
+    SELECT p.user_id, i.image_key, p.rating
+    FROM user_preferences p
+    JOIN images i ON i.id = p.image_id
+    WHERE p.rating != 0
+    ''')
+    rows = cursor.fetchall()
+    if not rows:
+        return sp.csr_matrix((0, 0), dtype=np.float32), np.empty(0, dtype=np.int64)
+
+    user_ordinals = {}
+    users = np.fromiter((user_ordinals.setdefault(row[0], len(user_ordinals)) for row in rows),
+                        dtype=np.int32, count=len(rows))
+    keys, items = np.unique(np.fromiter((row[1] for row in rows), dtype=np.int64, count=len(rows)),
+                            return_inverse=True)
+    ratings = np.sign(np.fromiter((row[2] for row in rows), dtype=np.float32, count=len(rows)))
+
+    matrix = sp.csr_matrix((ratings, (items, users)), shape=(len(keys), len(user_ordinals)), dtype=np.float32)
+    keep = np.diff(matrix.indptr) >= min_users
+    matrix, keys = matrix[keep], keys[keep]
+
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sp.diags((1 / norms).astype(np.float32)) @ matrix, keys
+
+def calculate_collaborative_neighbours(db_path, top_k=20, block_size=2048, min_score=0.05, min_users=2):
+    """Rebuild collaborative_neighbours from the whole user_preferences history.
+
+    The image x user rating matrix is multiplied with its transpose a block of
+    images at a time (the same blocked top-k product as the TF-IDF engine), so
+    memory is bounded by the block. The table is replaced in one transaction
+    and its index version bumped so running servers reload it.
+    """
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    migrate_schema(cursor)
+
+    start_time = time.perf_counter()
+    matrix, keys = load_rating_matrix(cursor, min_users)
+    loaded = time.perf_counter()
+    print(f"Loaded {matrix.nnz} ratings of {matrix.shape[0]} images by {matrix.shape[1]} users "
+          f"in {loaded - start_time:.1f}s")
+
+    sources, neighbours, scores = top_k_neighbours(matrix, top_k, block_size, min_score)
+    computed = time.perf_counter()
+    print(f"Computed item-item neighbours in {computed - loaded:.1f}s")
+
+    cursor.execute('BEGIN IMMEDIATE')
+    cursor.execute('DELETE FROM collaborative_neighbours')
+    total = write_similarities(cursor, (
+        (int(keys[source]), int(keys[neighbour]), float(score))
+        for source, neighbour, score in zip(sources.tolist(), neighbours.tolist(), scores.tolist())
+    ), table='collaborative_neighbours')
+    bump_index_version(cursor, 'collaborative')
+    conn.commit()
+    conn.close()
+
+    print(f"Collaborative filtering complete! Created {total} relationships "
+          f"in {time.perf_counter() - start_time:.1f}s.")
+    return total
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild item-item collaborative neighbours from user preferences.')
+    parser.add_argument('--db', default='data/bathroom_images.db', help='path to the SQLite database')
+    parser.add_argument('--top-k', type=int, default=20, help='neighbours kept per image')
+    parser.add_argument('--block-size', type=int, default=2048, help='rows per sparse matrix product')
+    parser.add_argument('--min-score', type=float, default=0.05, help='smallest cosine similarity kept')
+    parser.add_argument('--min-users', type=int, default=2, help='users an image needs to get neighbours')
+    args = parser.parse_args()
+
+    calculate_collaborative_neighbours(
+        args.db,
+        top_k=args.top_k,
+        block_size=args.block_size,
+        min_score=args.min_score,
+        min_users=args.min_users
+    )
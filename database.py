@@ -0,0 +1,107 @@
+import queue
+import sqlite3
+import threading
+
+from metrics import InstrumentedCursor
+
+# Pragmas applied to every connection. WAL lets readers run while a writer commits,
+# and synchronous=NORMAL is durable across application crashes in WAL mode.
+CONNECTION_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,  # 64 MB page cache per connection
+    'mmap_size': 268435456,  # 256 MB memory-mapped I/O
+    'temp_store': 'MEMORY',
+    'busy_timeout': 5000,  # ms to wait for a lock before raising "database is locked"
+}
+
+# Number of compiled statements sqlite3 keeps per connection for reuse
+STATEMENT_CACHE_SIZE = 256
+
+# Idle connections kept for reuse after their thread releases them; extra ones are closed
+POOL_SIZE = 16
+
+def connect(db_path):
+    """Open a SQLite connection with the tuned pragmas and a Row factory."""
+    conn = sqlite3.connect(
+        db_path,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE
+    )
+    conn.row_factory = sqlite3.Row
+    for pragma, value in CONNECTION_PRAGMAS.items():
+        conn.execute(f'PRAGMA {pragma} = {value}')
+    return conn
+
+class Database:
+    """Pooled SQLite connections for one database file.
+
+    A thread takes a connection (and cursor) on first use and keeps it until
+    it calls release(), so request threads never share a connection.
+    Released connections wait in a bounded pool for the next thread, which
+    reuses their compiled statements; connections beyond `pool_size` are
+    closed, so short-lived request threads do not leak one each. With a
+    `metrics` registry the cursors report statement timings to it.
+    """
+
+    def __init__(self, db_path, metrics=None, pool_size=POOL_SIZE):
+        self.db_path = db_path
+        self.metrics = metrics
+        self._local = threading.local()
+        self._idle = queue.Queue(maxsize=pool_size)
+        self._connections = set()
+        self._lock = threading.Lock()
+
+    def connection(self):
+        """Get the calling thread's connection, taking one from the pool or opening it if needed."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            try:
+                conn, cursor = self._idle.get_nowait()
+            except queue.Empty:
+                conn = connect(self.db_path)
+                if self.metrics is None:
+                    cursor = conn.cursor()
+                else:
+                    cursor = conn.cursor(InstrumentedCursor)
+                    cursor.metrics = self.metrics
+                with self._lock:
+                    self._connections.add(conn)
+            self._local.conn = conn
+            self._local.cursor = cursor
+        return conn
+
+    def cursor(self):
+        """Get the calling thread's cursor."""
+        self.connection()
+        return self._local.cursor
+
+    def release(self):
+        """Return the calling thread's connection to the pool, closing it if the pool is full."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            return
+        cursor = self._local.cursor
+        self._local.conn = self._local.cursor = None
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait((conn, cursor))
+        except queue.Full:
+            with self._lock:
+                self._connections.discard(conn)
+            conn.close()
+
+    def close(self):
+        """Close the connections of all threads and the pool."""
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = set()
+        self._idle = queue.Queue(maxsize=self._idle.maxsize)
+        self._local = threading.local()
+
+def explain_query_plan(cursor, sql, params=()):
+    """Get the EXPLAIN QUERY PLAN detail lines for a statement, in plan order."""
+    cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+    return [row[-1] for row in cursor.fetchall()]
@@ -0,0 +1,178 @@
+import atexit
+import threading
+
+from recommendation_system import preference_event, view_event
+
+# Largest batch accepted from one /api/events request
+MAX_CLIENT_EVENTS = 500
+
+CLIENT_RATINGS = {'like': 1, 'dislike': -1}
+
+def parse_client_events(items, user_id, session_id):
+    """Turn the events posted by the front end into apply_events events.
+
+    Each item is {'type': 'like' | 'dislike', 'image_id': ...} or
+    {'type': 'view', 'image_id': ..., 'view_time': seconds}. Returns the valid
+    events and the number of items that were rejected.
+    """
+    events = []
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get('image_id'), str) or not item['image_id']:
+            continue
+        kind = item.get('type')
+        if kind in CLIENT_RATINGS:
+            events.append(preference_event(user_id, item['image_id'], CLIENT_RATINGS[kind]))
+        elif kind == 'view':
+            view_time = item.get('view_time')
+            if isinstance(view_time, (int, float)) and not isinstance(view_time, bool) and view_time > 0:
+                events.append(view_event(session_id, user_id, item['image_id'], view_time))
+    return events, len(items) - len(events)
+
+def parse_client_event(data, kind, user_id, session_id):
+    """Validate the body of /api/preference (kind 'preference') or /api/view_time (kind 'view').
+
+    The body is {'image_id': ..., 'rating': 1 | -1} or {'image_id': ...,
+    'view_time': seconds}. It is checked by parse_client_events, so the
+    single-event routes accept exactly what /api/events accepts. Returns the
+    event, or None if the body is invalid.
+    """
+    if not isinstance(data, dict):
+        return None
+    item = {'image_id': data.get('image_id')}
+    if kind == 'preference':
+        rating = data.get('rating')
+        item['type'] = next(
+            (name for name, value in CLIENT_RATINGS.items() if type(rating) is int and rating == value), None
+        )
+    else:
+        item.update(type='view', view_time=data.get('view_time'))
+    events, _ = parse_client_events([item], user_id, session_id)
+    return events[0] if events else None
+
+class EventBuffer:
+    """Write-behind buffer for like/dislike and view-time events.
+
+    Events are accepted immediately and written by a background thread in
+    batches through RecommendationSystem.apply_events, so many HTTP requests
+    share one transaction. A batch is flushed when `max_batch` events are
+    waiting or `flush_interval` seconds have passed, and once more on shutdown.
+    """
+
+    def __init__(self, recommender, max_batch=500, flush_interval=1.0):
+        self.recommender = recommender
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._events = []
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+
+    def record_preference(self, user_id, image_id, rating):
+        """Queue a like (1) or dislike (-1)."""
+        self._add(preference_event(user_id, image_id, rating))
+
+    def record_view_time(self, session_id, user_id, image_id, view_time):
+        """Queue a view-time event."""
+        self._add(view_event(session_id, user_id, image_id, view_time))
+
+    def record_events(self, events):
+        """Queue several events at once. They are flushed together, so they land in one transaction."""
+        with self._condition:
+            self._events.extend(events)
+            if len(self._events) >= self.max_batch:
+                self._condition.notify()
+
+    def _add(self, event):
+        with self._condition:
+            self._events.append(event)
+            if len(self._events) >= self.max_batch:
+                self._condition.notify()
+
+    def pending(self):
+        """Number of events waiting to be written."""
+        with self._condition:
+            return len(self._events)
+
+    def flush(self):
+        """Write all queued events now. Returns the number of events applied.
+
+        If the batch fails it is retried one event at a time and the events
+        that fail again are logged and dropped, so a bad event is never
+        retried forever.
+        """
+        with self._flush_lock:
+            with self._condition:
+                events, self._events = self._events, []
+            if not events:
+                return 0
+
+            try:
+                applied = self.recommender.apply_events(events)
+            except Exception as e:
+                # Apply the batch event by event, so one bad event does not hold back the rest
+                self.recommender.conn.rollback()
+                print(f"Error applying {len(events)} events, retrying one at a time: {e}")
+                events, applied = self._apply_each(events)
+
+            # Likes also strengthen the similarity between the user's liked images;
+            # only the last rating of an image in the batch counts
+            ratings = {}
+            for event in events:
+                if event['type'] == 'preference':
+                    ratings.pop((event['user_id'], event['image_id']), None)
+                    ratings[(event['user_id'], event['image_id'])] = event['rating']
+            new_likes = {}
+            for (user_id, image_id), rating in ratings.items():
+                if rating > 0:
+                    new_likes.setdefault(user_id, []).append(image_id)
+            for user_id, image_ids in new_likes.items():
+                self.recommender.update_similarity_scores(user_id, image_ids)
+
+            return applied
+
+    def _apply_each(self, events):
+        """Apply events one at a time, dropping those that still fail. Returns (applied events, count)."""
+        kept = []
+        applied = 0
+        for event in events:
+            try:
+                applied += self.recommender.apply_events([event])
+            except Exception as e:
+                self.recommender.conn.rollback()
+                print(f"Dropping event {event}: {e}")
+                continue
+            kept.append(event)
+        return kept, applied
+
+    def start(self):
+        """Start the background flusher and make sure queued events are written at exit."""
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='event-buffer', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Stop the background flusher and write any remaining events."""
+        if self._thread is not None:
+            with self._condition:
+                self._stopping = True
+                self._condition.notify()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._stopping and len(self._events) < self.max_batch:
+                    self._condition.wait(self.flush_interval)
+                stopping = self._stopping
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error flushing events: {e}")
+            if stopping:
+                return
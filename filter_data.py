@@ -1,4 +1,5 @@
 import os
+import importlib.util
 import pandas as pd
 import json
 import sqlite3
@@ -11,27 +12,84 @@ import re
 # Import process_data module
 from process_data import CATEGORIES, process_csv_data
 
-def filter_irrelevant_images(categories):
-    """Filter out irrelevant images from the categorized dataset with improved keywords."""
-    # Expanded relevance keywords for each category
-    relevance_keywords = {
-        'toilet': ['toilet', 'commode', 'wc', 'bathroom fixture', 'lavatory', 'water closet', 'flush', 'bidet'],
-        'standing_shower': ['shower', 'shower door', 'shower head', 'shower stall', 'shower glass', 'shower tile', 'walk in shower', 'shower enclosure', 'rainfall shower'],
-        'bathtub': ['bathtub', 'bath', 'tub', 'soaking', 'freestanding', 'clawfoot', 'jacuzzi', 'whirlpool', 'spa bath'],
-        'mirror': ['mirror', 'bathroom mirror', 'vanity mirror', 'wall mirror', 'framed mirror', 'medicine cabinet'],
-        'vanity': ['vanity', 'sink', 'cabinet', 'countertop', 'bathroom cabinet', 'washbasin', 'basin', 'bathroom furniture'],
-        'floor_tiles': ['tile', 'floor', 'ceramic', 'porcelain', 'marble', 'pattern', 'mosaic', 'travertine', 'slate', 'limestone', 'flooring'],
-        'color': ['color', 'paint', 'palette', 'scheme', 'tone', 'hue', 'bathroom color', 'wall color', 'accent', 'decor']
-    }
+# Expanded relevance keywords for each category
+RELEVANCE_KEYWORDS = {
+    'toilet': ['toilet', 'commode', 'wc', 'bathroom fixture', 'lavatory', 'water closet', 'flush', 'bidet'],
+    'standing_shower': ['shower', 'shower door', 'shower head', 'shower stall', 'shower glass', 'shower tile', 'walk in shower', 'shower enclosure', 'rainfall shower'],
+    'bathtub': ['bathtub', 'bath', 'tub', 'soaking', 'freestanding', 'clawfoot', 'jacuzzi', 'whirlpool', 'spa bath'],
+    'mirror': ['mirror', 'bathroom mirror', 'vanity mirror', 'wall mirror', 'framed mirror', 'medicine cabinet'],
+    'vanity': ['vanity', 'sink', 'cabinet', 'countertop', 'bathroom cabinet', 'washbasin', 'basin', 'bathroom furniture'],
+    'floor_tiles': ['tile', 'floor', 'ceramic', 'porcelain', 'marble', 'pattern', 'mosaic', 'travertine', 'slate', 'limestone', 'flooring'],
+    'color': ['color', 'paint', 'palette', 'scheme', 'tone', 'hue', 'bathroom color', 'wall color', 'accent', 'decor']
+}
+
+# Expanded irrelevance keywords
+IRRELEVANCE_KEYWORDS = [
+    'person', 'people', 'woman', 'man', 'child', 'sofa', 'couch', 'living room', 
+    'kitchen', 'bedroom', 'office', 'outdoor', 'garden', 'food', 'car', 'vehicle',
+    'dog', 'cat', 'pet', 'animal', 'clothing', 'fashion', 'restaurant', 'cafe',
+    'store', 'shop', 'concert', 'party', 'beach', 'mountain', 'forest'
+]
+
+# Special case for floor_tiles: exclude images with people or furniture as main subject
+EXTRA_IRRELEVANCE_KEYWORDS = {
+    'floor_tiles': ['sofa', 'person', 'people'],
+}
+
+def compile_keywords(keywords):
+    """Compile keywords into a single alternation regex matching any of them as a substring."""
+    # Longest first so a shared prefix never hides a longer keyword
+    ordered = sorted({keyword.lower() for keyword in keywords}, key=len, reverse=True)
+    return re.compile('|'.join(re.escape(keyword) for keyword in ordered))
+
+# Matchers are built once at import time, one scan of the text per check
+RELEVANCE_PATTERNS = {category: compile_keywords(keywords) for category, keywords in RELEVANCE_KEYWORDS.items()}
+IRRELEVANCE_PATTERNS = {
+    category: compile_keywords(IRRELEVANCE_KEYWORDS + EXTRA_IRRELEVANCE_KEYWORDS.get(category, []))
+    for category in RELEVANCE_KEYWORDS
+}
+
+def is_relevant_image(image, category):
+    """Check whether an image belongs in its category.
     
-    # Expanded irrelevance keywords
-    irrelevance_keywords = [
-        'person', 'people', 'woman', 'man', 'child', 'sofa', 'couch', 'living room', 
-        'kitchen', 'bedroom', 'office', 'outdoor', 'garden', 'food', 'car', 'vehicle',
-        'dog', 'cat', 'pet', 'animal', 'clothing', 'fashion', 'restaurant', 'cafe',
-        'store', 'shop', 'concert', 'party', 'beach', 'mountain', 'forest'
-    ]
+    Relevant if a category keyword appears in the description or URL and no
+    irrelevance keyword appears in the description.
+    """
+    description = image.get('description', '').lower()
+    url = image.get('url', '').lower()
     
+    relevance = RELEVANCE_PATTERNS[category]
+    if not (relevance.search(description) or relevance.search(url)):
+        return False
+    return not IRRELEVANCE_PATTERNS[category].search(description)
+
+# With pyarrow installed pandas matches Arrow strings natively instead of looping in Python
+STRING_DTYPE = 'string[pyarrow]' if importlib.util.find_spec('pyarrow') else object
+
+def _lowered(values):
+    """Lowercase a column of strings, treating missing values as empty."""
+    return pd.Series(values, dtype=object).fillna('').astype(str).astype(STRING_DTYPE).str.lower()
+
+def relevant_flags(descriptions, urls, category):
+    """Vectorized is_relevant_image over parallel sequences of descriptions and URLs, as a numpy bool array."""
+    descriptions = _lowered(descriptions)
+    urls = _lowered(urls)
+    
+    # Pattern strings rather than compiled regexes, which pandas can only apply row by row
+    relevance = RELEVANCE_PATTERNS[category].pattern
+    matches = descriptions.str.contains(relevance) | urls.str.contains(relevance)
+    matches &= ~descriptions.str.contains(IRRELEVANCE_PATTERNS[category].pattern)
+    return matches.to_numpy(dtype=bool)
+
+def relevant_mask(df, category, description_column='description', url_column='url'):
+    """Vectorized relevance check over a DataFrame of images, returning a boolean Series."""
+    return pd.Series(relevant_flags(df[description_column], df[url_column], category), index=df.index)
+
+def filter_irrelevant_images(categories, verbose=True):
+    """Filter out irrelevant images from the categorized dataset with improved keywords.
+    
+    Set `verbose=False` to skip the statistics, e.g. when filtering chunk by chunk.
+    """
     # Statistics before filtering
     before_counts = {category: len(images) for category, images in categories.items()}
     total_before = sum(before_counts.values())
@@ -41,52 +99,29 @@ def filter_irrelevant_images(categories):
     removed_counts = {category: 0 for category in categories}
     
     for category, images in categories.items():
-        filtered_images = []
-        
-        for image in images:
-            description = image.get('description', '').lower()
-            url = image.get('url', '').lower()
-            
-            # Check if the image is relevant based on keywords
-            is_relevant = False
-            
-            # Check for relevance keywords in description or URL
-            for keyword in relevance_keywords[category]:
-                if keyword.lower() in description or keyword.lower() in url:
-                    is_relevant = True
-                    break
-            
-            # Check for irrelevance keywords
-            for keyword in irrelevance_keywords:
-                if keyword.lower() in description:
-                    is_relevant = False
-                    break
-            
-            # Special case for floor_tiles: exclude images with people or furniture as main subject
-            if category == 'floor_tiles' and any(kw in description for kw in ['sofa', 'person', 'people']):
-                is_relevant = False
-            
-            # Add relevant images to filtered list
-            if is_relevant:
-                filtered_images.append(image)
-            else:
-                removed_counts[category] += 1
-        
+        relevant = relevant_flags(
+            [image.get('description', '') for image in images], [image.get('url', '') for image in images], category
+        )
+        filtered_images = [image for image, keep in zip(images, relevant) if keep]
+        removed_counts[category] = len(images) - len(filtered_images)
         filtered_categories[category] = filtered_images
     
     # Statistics after filtering
     after_counts = {category: len(images) for category, images in filtered_categories.items()}
     total_after = sum(after_counts.values())
     
+    if not verbose:
+        return filtered_categories
+    
     # Print statistics
     print("Filtering complete!")
     print(f"Total images before filtering: {total_before}")
     print(f"Total images after filtering: {total_after}")
-    print(f"Total removed: {total_before - total_after} ({(total_before - total_after) / total_before * 100:.2f}%)")
+    print(f"Total removed: {total_before - total_after} ({(total_before - total_after) / max(total_before, 1) * 100:.2f}%)")
     print("\nCategory statistics:")
     
     for category in categories:
         print(f"{category}: {before_counts[category]} → {after_counts[category]} " +
-              f"(removed: {removed_counts[category]}, {removed_counts[category] / before_counts[category] * 100:.2f}%)")
+              f"(removed: {removed_counts[category]}, {removed_counts[category] / max(before_counts[category], 1) * 100:.2f}%)")
     
     return filtered_categories
@@ -0,0 +1,378 @@
+import os
+import re
+import hmac
+import time
+import zlib
+import bisect
+import ipaddress
+import sqlite3
+import threading
+import functools
+import collections
+from datetime import datetime
+
+# Histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Normalized SQL longer than this is cut and tagged with a checksum of the full text
+MAX_QUERY_LABEL = 160
+
+# Queries at least this slow are kept in the slow-query log with their plan
+SLOW_QUERY_MS = float(os.environ.get('BATHROOM_SLOW_QUERY_MS', 100))
+SLOW_QUERY_CAPACITY = 200
+
+# Lowest threshold the admin endpoint accepts; below it nearly every statement is explained and logged
+MIN_SLOW_QUERY_MS = 1
+
+# Admin endpoints require this token in the X-Admin-Token header when it is set,
+# and only answer clients on the loopback interface when it is not
+ADMIN_TOKEN = os.environ.get('BATHROOM_ADMIN_TOKEN')
+ADMIN_TOKEN_HEADER = 'X-Admin-Token'
+
+# Statements for which sqlite3 opens a transaction, i.e. that need the write lock
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+_WHITESPACE = re.compile(r'\s+')
+_PLACEHOLDER_LIST = re.compile(r'\?(?:\s*,\s*\?)+')
+
+def normalize_sql(sql):
+    """Collapse whitespace and fold placeholder lists such as IN (?, ?, ?) to IN (?, ...)."""
+    return _PLACEHOLDER_LIST.sub('?, ...', _WHITESPACE.sub(' ', sql).strip())
+
+def is_admin_request(client_host, token):
+    """True if a request to an admin endpoint may proceed, see ADMIN_TOKEN."""
+    if ADMIN_TOKEN:
+        return token is not None and hmac.compare_digest(token.encode('utf-8'), ADMIN_TOKEN.encode('utf-8'))
+    try:
+        return ipaddress.ip_address(client_host).is_loopback
+    except (TypeError, ValueError):
+        return False
+
+@functools.lru_cache(maxsize=1024)
+def query_label(sql):
+    """Normalize a statement into a metric label.
+
+    One query built for different batch sizes is a single series, and long
+    statements are cut and tagged with a checksum of the full text.
+    """
+    label = normalize_sql(sql)
+    if len(label) > MAX_QUERY_LABEL:
+        label = f"{label[:MAX_QUERY_LABEL]}... #{zlib.crc32(label.encode('utf-8')):08x}"
+    return label
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Histogram:
+    """Latency histogram with one series per combination of label values."""
+
+    def __init__(self, name, help, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def observe(self, label_values, value):
+        """Record a value; not thread-safe on its own, Metrics holds a lock around it."""
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total, count) in sorted(self._series.items()):
+            labels = list(zip(self.label_names, label_values))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+class Counter:
+    """Monotonic counter with one series per combination of label values."""
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self._series = {}
+
+    def inc(self, label_values, amount=1):
+        self._series[label_values] = self._series.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self._series.items()):
+            lines.append(f"{self.name}{_format_labels(list(zip(self.label_names, label_values)))} {_format_value(value)}")
+        return lines
+
+def parameter_shape(parameters):
+    """Describe bound parameters by type without their values, e.g. 'str, int x 3'."""
+    if isinstance(parameters, dict):
+        return ', '.join(f":{name} {type(value).__name__}" for name, value in parameters.items())
+    runs = []
+    for value in parameters:
+        type_name = type(value).__name__
+        if runs and runs[-1][0] == type_name:
+            runs[-1][1] += 1
+        else:
+            runs.append([type_name, 1])
+    return ', '.join(name if count == 1 else f"{name} x {count}" for name, count in runs)
+
+def plan_flags(plan):
+    """Flag the costly steps of an EXPLAIN QUERY PLAN: full table scans and temporary B-tree sorts."""
+    flags = []
+    for line in plan:
+        if line.startswith('SCAN ') and 'INDEX' not in line and line != 'SCAN CONSTANT ROW':
+            flags.append('full_scan')
+        if 'USE TEMP B-TREE' in line:
+            flags.append('temp_btree')
+    return sorted(set(flags))
+
+class SlowQueryLog:
+    """Bounded ring buffer of statements slower than a threshold.
+
+    Each entry keeps the normalized SQL, the shape of its parameters (never
+    the values, which hold user ids), the duration, the row count and the
+    EXPLAIN QUERY PLAN taken on the same connection right after the query.
+    """
+
+    def __init__(self, threshold_ms=SLOW_QUERY_MS, capacity=SLOW_QUERY_CAPACITY):
+        self.threshold = threshold_ms / 1000
+        self.recorded = 0
+        self._entries = collections.deque(maxlen=capacity)
+        self._lock = threading.Lock()
+
+    @property
+    def threshold_ms(self):
+        return self.threshold * 1000
+
+    @threshold_ms.setter
+    def threshold_ms(self, value):
+        self.threshold = value / 1000
+
+    def record(self, conn, sql, parameters, seconds, rows):
+        """Store a slow statement with its query plan."""
+        # database imports this module for InstrumentedCursor
+        from database import explain_query_plan
+
+        try:
+            plan = explain_query_plan(conn.cursor(), sql, parameters) if parameters is not None else None
+        except sqlite3.Error:
+            plan = None
+        entry = {
+            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'duration_ms': round(seconds * 1000, 3),
+            'rows': rows,
+            'sql': normalize_sql(sql),
+            'params': parameter_shape(parameters) if parameters is not None else 'executemany',
+            'plan': plan,
+            'flags': plan_flags(plan or []),
+        }
+        with self._lock:
+            self._entries.append(entry)
+            self.recorded += 1
+
+        flags = f" [{', '.join(entry['flags'])}]" if entry['flags'] else ''
+        print(f"Slow query ({entry['duration_ms']:.1f} ms){flags}: {query_label(sql)}")
+
+    def entries(self, limit=None):
+        """Get the logged queries, newest first."""
+        with self._lock:
+            entries = list(self._entries)
+        entries.reverse()
+        return entries[:limit] if limit is not None else entries
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+class Metrics:
+    """In-process request, SQL and cache metrics rendered in the Prometheus text format.
+
+    Recording is skipped while `enabled` is False, so instrumentation can be
+    switched on and off at runtime. Collectors registered with add_collector
+    are called at scrape time for values owned by other objects, such as the
+    recommendation cache counters. Statements slower than the threshold of
+    `slow_queries` are also kept there with their query plans.
+    """
+
+    def __init__(self, enabled=True, slow_query_ms=SLOW_QUERY_MS):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._collectors = []
+        self.slow_queries = SlowQueryLog(slow_query_ms)
+        self.request_seconds = Histogram(
+            'bathroom_http_request_duration_seconds', 'HTTP request latency by route.',
+            ('route', 'method', 'status')
+        )
+        self.query_seconds = Histogram(
+            'bathroom_sqlite_query_duration_seconds', 'SQLite statement latency, including fetching its rows.',
+            ('query',)
+        )
+        self.query_rows = Counter(
+            'bathroom_sqlite_query_rows_total', 'Rows fetched or changed by SQLite statements.', ('query',)
+        )
+        self.lock_wait_seconds = Histogram(
+            'bathroom_sqlite_lock_wait_seconds', 'Time spent waiting for the SQLite write lock.'
+        )
+
+    def observe_request(self, route, method, status, seconds):
+        if self.enabled:
+            with self._lock:
+                self.request_seconds.observe((route, method, str(status)), seconds)
+
+    def observe_query(self, sql, seconds, rows, conn=None, parameters=None):
+        """Record a statement; with its connection, a slow one is also added to the slow-query log."""
+        if self.enabled:
+            label = query_label(sql)
+            with self._lock:
+                self.query_seconds.observe((label,), seconds)
+                self.query_rows.inc((label,), rows)
+            if conn is not None and seconds >= self.slow_queries.threshold:
+                self.slow_queries.record(conn, sql, parameters, seconds, rows)
+
+    def observe_lock_wait(self, seconds):
+        if self.enabled:
+            with self._lock:
+                self.lock_wait_seconds.observe((), seconds)
+
+    def add_collector(self, collector):
+        """Register a callable returning [(name, type, help, [(labels dict, value)])] at scrape time."""
+        with self._lock:
+            self._collectors.append(collector)
+        return collector
+
+    def remove_collector(self, collector):
+        with self._lock:
+            if collector in self._collectors:
+                self._collectors.remove(collector)
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format."""
+        lines = [
+            '# HELP bathroom_metrics_enabled Whether instrumentation is currently recording.',
+            '# TYPE bathroom_metrics_enabled gauge',
+            f"bathroom_metrics_enabled {int(self.enabled)}",
+        ]
+        with self._lock:
+            for metric in (self.request_seconds, self.query_seconds, self.query_rows, self.lock_wait_seconds):
+                lines.extend(metric.render())
+            collectors = list(self._collectors)
+
+        for collector in collectors:
+            for name, metric_type, help, samples in collector():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(sorted(labels.items()))} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+def cache_samples(cache_name, stats):
+    """Turn RecommendationCache.stats() into collector samples labelled with the cache name."""
+    labels = {'cache': cache_name}
+    return [
+        ('bathroom_cache_hits_total', 'counter', 'Cache lookups that found an entry.', [(labels, stats['hits'])]),
+        ('bathroom_cache_misses_total', 'counter', 'Cache lookups that found nothing.', [(labels, stats['misses'])]),
+        ('bathroom_cache_hit_ratio', 'gauge', 'Share of cache lookups that were hits.', [(labels, stats['hit_ratio'])]),
+        ('bathroom_cache_entries', 'gauge', 'Entries currently cached.', [(labels, stats['entries'])]),
+        ('bathroom_cache_evictions_total', 'counter', 'Entries evicted for size or age.', [(labels, stats['evictions'])]),
+        ('bathroom_cache_invalidations_total', 'counter', 'Entries dropped by invalidation.', [(labels, stats['invalidations'])]),
+    ]
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that reports statement latency, row counts and write lock waits to a Metrics.
+
+    A query is timed from execute() until its rows are read with fetchone() or
+    fetchall(); rows read by iterating the cursor are not counted. Before a
+    write opens a transaction the write lock is taken with BEGIN IMMEDIATE, as
+    sqlite3 would at the write itself, so the time spent waiting for it is
+    measured separately.
+    """
+
+    metrics = None
+    _pending = None
+
+    def execute(self, sql, parameters=()):
+        metrics = self.metrics
+        if metrics is None or not metrics.enabled:
+            return super().execute(sql, parameters)
+
+        self._finish()
+        self._acquire_write_lock(sql)
+        start = time.perf_counter()
+        super().execute(sql, parameters)
+        elapsed = time.perf_counter() - start
+        if sql.lstrip()[:15].upper() in ('BEGIN IMMEDIATE', 'BEGIN EXCLUSIVE'):
+            metrics.observe_lock_wait(elapsed)
+        if self.description is None:
+            metrics.observe_query(sql, elapsed, max(self.rowcount, 0), self.connection, parameters)
+        else:
+            self._pending = [sql, parameters, elapsed, 0]
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        metrics = self.metrics
+        if metrics is None or not metrics.enabled:
+            return super().executemany(sql, seq_of_parameters)
+
+        self._finish()
+        self._acquire_write_lock(sql)
+        start = time.perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        metrics.observe_query(sql, time.perf_counter() - start, max(self.rowcount, 0), self.connection)
+        return self
+
+    def fetchone(self):
+        if self._pending is None:
+            return super().fetchone()
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._pending[2] += time.perf_counter() - start
+        self._pending[3] += row is not None
+        self._finish()
+        return row
+
+    def fetchall(self):
+        if self._pending is None:
+            return super().fetchall()
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._pending[2] += time.perf_counter() - start
+        self._pending[3] += len(rows)
+        self._finish()
+        return rows
+
+    def _finish(self):
+        """Report the query whose rows were being read."""
+        if self._pending is not None:
+            sql, parameters, elapsed, rows = self._pending
+            self._pending = None
+            if self.metrics is not None:
+                self.metrics.observe_query(sql, elapsed, rows, self.connection, parameters)
+
+    def _acquire_write_lock(self, sql):
+        """Open the transaction of a write that would otherwise start one implicitly, timing the lock wait."""
+        conn = self.connection
+        if conn.in_transaction or conn.isolation_level is None or not sql.lstrip()[:7].upper().startswith(WRITE_STATEMENTS):
+            return
+        start = time.perf_counter()
+        super().execute('BEGIN IMMEDIATE')
+        self.metrics.observe_lock_wait(time.perf_counter() - start)
+
+# Process-wide metrics, on unless BATHROOM_METRICS=0; BATHROOM_SLOW_QUERY_MS sets the slow-query threshold
+METRICS = Metrics(enabled=os.environ.get('BATHROOM_METRICS', '1') != '0')
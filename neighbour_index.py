@@ -0,0 +1,191 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from setup_database import get_index_version
+
+# Entries kept in similarity_changes; a process that falls further behind reloads its index
+MAX_SIMILARITY_CHANGES = 100000
+
+def record_similarity_changes(cursor, image_keys):
+    """Log that the similarity lists of these images changed, pruning the oldest entries.
+
+    Call it in the transaction that writes the edges, so a process never sees
+    a logged change before the edges themselves.
+    """
+    cursor.executemany('INSERT INTO similarity_changes (image_key) VALUES (?)', [(key,) for key in image_keys])
+    cursor.execute('DELETE FROM similarity_changes WHERE seq <= (SELECT MAX(seq) FROM similarity_changes) - ?',
+                   (MAX_SIMILARITY_CHANGES,))
+
+def latest_similarity_change(cursor):
+    """Sequence number of the most recent logged change (0 if none)."""
+    cursor.execute('SELECT MAX(seq) FROM similarity_changes')
+    return cursor.fetchone()[0] or 0
+
+class NeighbourIndex:
+    """Precomputed top-k similar images held in memory as compact CSR arrays.
+
+    Image ids map to int32 ordinals; the neighbours of ordinal i are
+    indices[indptr[i]:indptr[i + 1]] with float32 scores, already sorted by
+    similarity (then popularity), so a lookup is a dict access and a slice.
+    Lists changed after the build are re-read by apply_changes into an
+    overlay that takes precedence over the CSR rows.
+    """
+
+    def __init__(self, ids, indptr, indices, scores, version=0, table='image_similarities', top_k=50, change_seq=0):
+        self.ids = ids
+        self.ordinals = {image_id: i for i, image_id in enumerate(ids)}
+        self.indptr = indptr
+        self.indices = indices
+        self.scores = scores
+        self.version = version
+        self.table = table
+        self.top_k = top_k
+        self.change_seq = change_seq
+        self.overlay = {}  # image id -> [(image id, score)], best first
+
+    @classmethod
+    def load(cls, cursor, top_k=50, table='image_similarities', version_name='similarities'):
+        """Build the index from image_similarities (or a table with its layout), keeping the top_k neighbours per image."""
+        version = get_index_version(cursor, version_name)
+        # Read first: changes logged while the table is read are applied again by apply_changes, which is harmless
+        change_seq = latest_similarity_change(cursor)
+        cursor.execute(f'''
+        SELECT s.image_key1, s.image_key2, s.similarity_score
+        FROM {table} s
+        JOIN images i ON i.image_key = s.image_key2
+        ORDER BY s.image_key1, s.similarity_score DESC, i.popularity DESC
+        ''')
+
+        sources, targets, scores = [], [], []
+        previous, count = None, 0
+        for key1, key2, score in cursor:
+            if key1 != previous:
+                previous, count = key1, 0
+            if count < top_k:
+                sources.append(key1)
+                targets.append(key2)
+                scores.append(score)
+                count += 1
+
+        # Ordinals follow key order, the same order the rows were sorted in, so the
+        # source ordinals are non-decreasing and CSR row bounds come from a search
+        keys = np.unique(np.asarray(sources + targets, dtype=np.int64))
+        source_ordinals = np.searchsorted(keys, np.asarray(sources, dtype=np.int64)).astype(np.int32)
+        indptr = np.searchsorted(source_ordinals, np.arange(len(keys) + 1)).astype(np.int64)
+
+        # Results are returned by external string id
+        key_list = keys.tolist()
+        id_by_key = {}
+        for start in range(0, len(key_list), 500):
+            batch = key_list[start:start + 500]
+            placeholders = ', '.join('?' for _ in batch)
+            cursor.execute(f'SELECT image_key, id FROM images WHERE image_key IN ({placeholders})', batch)
+            id_by_key.update((row[0], row[1]) for row in cursor.fetchall())
+
+        return cls(
+            [id_by_key[key] for key in key_list],
+            indptr,
+            np.searchsorted(keys, np.asarray(targets, dtype=np.int64)).astype(np.int32),
+            np.asarray(scores, dtype=np.float32),
+            version,
+            table,
+            top_k,
+            change_seq
+        )
+
+    def apply_changes(self, cursor, batch_size=500):
+        """Re-read the lists logged in similarity_changes since this index was built or last updated.
+
+        Each changed list costs one indexed query, so keeping up with likes is
+        cheap next to a reload. Returns False if changes this index has not
+        seen were already pruned, in which case it has to be reloaded.
+        """
+        cursor.execute('SELECT seq, image_key FROM similarity_changes WHERE seq > ? ORDER BY seq', (self.change_seq,))
+        changes = cursor.fetchall()
+        if not changes:
+            return True
+        if changes[0][0] > self.change_seq + 1:
+            return False
+
+        keys = list(dict.fromkeys(key for _, key in changes))
+        id_by_key = {}
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            placeholders = ', '.join('?' for _ in batch)
+            cursor.execute(f'SELECT image_key, id FROM images WHERE image_key IN ({placeholders})', batch)
+            id_by_key.update((row[0], row[1]) for row in cursor.fetchall())
+
+        for key in keys:
+            if key not in id_by_key:
+                continue
+            cursor.execute(f'''
+            SELECT i.id, s.similarity_score
+            FROM {self.table} s
+            JOIN images i ON i.image_key = s.image_key2
+            WHERE s.image_key1 = ?
+            ORDER BY s.similarity_score DESC, i.popularity DESC
+            LIMIT ?
+            ''', (key, self.top_k))
+            self.overlay[id_by_key[key]] = [(row[0], float(row[1])) for row in cursor.fetchall()]
+        self.change_seq = changes[-1][0]
+        return True
+
+    def __len__(self):
+        return len(self.indices)
+
+    def neighbours(self, image_id, limit=12):
+        """Get up to `limit` (image_id, score) pairs most similar to an image."""
+        overlaid = self.overlay.get(image_id)
+        if overlaid is not None:
+            return overlaid[:limit]
+        ordinal = self.ordinals.get(image_id)
+        if ordinal is None:
+            return []
+        start = self.indptr[ordinal]
+        end = min(self.indptr[ordinal + 1], start + limit)
+        return [(self.ids[i], float(score))
+                for i, score in zip(self.indices[start:end].tolist(), self.scores[start:end].tolist())]
+
+class ImageRowCache:
+    """Bounded LRU cache of image rows keyed by image id."""
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._rows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, cursor, image_ids):
+        """Get image rows for the given ids in order, loading missing ones with a single query."""
+        with self._lock:
+            found = {}
+            for image_id in image_ids:
+                row = self._rows.get(image_id)
+                if row is not None:
+                    self._rows.move_to_end(image_id)
+                    found[image_id] = row
+
+        missing = [image_id for image_id in image_ids if image_id not in found]
+        if missing:
+            placeholders = ', '.join('?' for _ in missing)
+            cursor.execute(f'SELECT * FROM images WHERE id IN ({placeholders})', missing)
+            loaded = {row['id']: dict(row) for row in cursor.fetchall()}
+            found.update(loaded)
+            with self._lock:
+                self._rows.update(loaded)
+                while len(self._rows) > self.max_size:
+                    self._rows.popitem(last=False)
+
+        return [dict(found[image_id]) for image_id in image_ids if image_id in found]
+
+    def invalidate(self, image_ids):
+        """Drop the cached rows of images that changed, e.g. in popularity."""
+        with self._lock:
+            for image_id in image_ids:
+                self._rows.pop(image_id, None)
+
+    def clear(self):
+        """Drop all cached rows."""
+        with self._lock:
+            self._rows.clear()
@@ -38,90 +38,106 @@ def extract_urls_from_text(text):
                 urls.append(part)
     return urls
 
-def process_csv_data(shower_csv, floor_csv, text_files):
-    """Process CSV files and text files to categorize images."""
-    # Initialize categories dictionary
-    categories = {category: [] for category in CATEGORIES}
+# Keyword rules for bathroom_shower_images.csv, checked in order: the first match wins
+SHOWER_CSV_RULES = [
+    ('standing_shower', 'shower', ['shower']),
+    ('bathtub', 'bath', ['bath', 'tub']),
+    ('mirror', 'mirror', ['mirror']),
+    ('vanity', 'vanity', ['vanity']),
+    ('toilet', 'toilet', ['toilet']),
+]
+
+FLOOR_CSV_RULES = [
+    ('floor_tiles', 'floor', ['tile', 'floor']),
+]
+
+# Text files containing image URLs, by category
+FILE_CATEGORY_MAPPING = {
+    'bathroom_mirror.txt': 'mirror',
+    'bathroom_vanity.txt': 'vanity',
+    'floortiles.txt': 'floor_tiles',
+    'wall tiles.txt': 'floor_tiles',  # Wall tiles can be categorized with floor tiles
+    'bathroom_color.txt': 'color',
+}
+
+def classify_chunk(df, rules):
+    """Categorize a DataFrame chunk with vectorized keyword matching.
     
-    # Process bathroom_shower_images.csv
-    shower_df = pd.read_csv(shower_csv)
-    for _, row in shower_df.iterrows():
-        # Handle missing or NaN descriptions
-        description = str(row['Description']) if pd.notna(row['Description']) else ""
-        
-        if 'shower' in description.lower():
-            categories['standing_shower'].append({
-                'url': row['URL'],
-                'description': description,
-                'source': row['Source'],
-                'id': f"shower_{row['Image_ID']}"
-            })
-        elif 'bath' in description.lower() or 'tub' in description.lower():
-            categories['bathtub'].append({
-                'url': row['URL'],
-                'description': description,
-                'source': row['Source'],
-                'id': f"bath_{row['Image_ID']}"
-            })
-        elif 'mirror' in description.lower():
-            categories['mirror'].append({
-                'url': row['URL'],
-                'description': description,
-                'source': row['Source'],
-                'id': f"mirror_{row['Image_ID']}"
-            })
-        elif 'vanity' in description.lower():
-            categories['vanity'].append({
-                'url': row['URL'],
-                'description': description,
-                'source': row['Source'],
-                'id': f"vanity_{row['Image_ID']}"
-            })
-        elif 'toilet' in description.lower():
-            categories['toilet'].append({
-                'url': row['URL'],
-                'description': description,
-                'source': row['Source'],
-                'id': f"toilet_{row['Image_ID']}"
-            })
+    Descriptions are lowercased once per chunk and each rule is one
+    `str.contains` over the whole column. Returns {category: [image dicts]}.
+    """
+    # Handle missing or NaN descriptions
+    descriptions = df['Description'].where(df['Description'].notna(), '').astype(str)
+    lowered = descriptions.str.lower()
     
-    # Process floor_tile_images.csv
-    floor_df = pd.read_csv(floor_csv)
-    for _, row in floor_df.iterrows():
-        # Handle missing or NaN descriptions
-        description = str(row['Description']) if pd.notna(row['Description']) else ""
+    unassigned = pd.Series(True, index=df.index)
+    chunk_categories = {}
+    for category, id_prefix, keywords in rules:
+        matches = pd.Series(False, index=df.index)
+        for keyword in keywords:
+            matches |= lowered.str.contains(keyword, regex=False)
+        matches &= unassigned
+        unassigned &= ~matches
         
-        if 'tile' in description.lower() or 'floor' in description.lower():
-            categories['floor_tiles'].append({
-                'url': row['URL'],
-                'description': description,
-                'source': row['Source'],
-                'id': f"floor_{row['Image_ID']}"
-            })
+        if not matches.any():
+            continue
+        
+        selected = df[matches]
+        chunk_categories[category] = [
+            {'url': url, 'description': description, 'source': source, 'id': f"{id_prefix}_{image_id}"}
+            for url, description, source, image_id in zip(
+                selected['URL'], descriptions[matches], selected['Source'], selected['Image_ID']
+            )
+        ]
     
-    # Process text files
-    file_category_mapping = {
-        'bathroom_mirror.txt': 'mirror',
-        'bathroom_vanity.txt': 'vanity',
-        'floortiles.txt': 'floor_tiles',
-        'wall tiles.txt': 'floor_tiles',  # Wall tiles can be categorized with floor tiles
-        'bathroom_color.txt': 'color',
-    }
+    return chunk_categories
+
+def iter_csv_images(csv_path, rules, chunksize=50000):
+    """Stream a CSV in chunks, yielding {category: [image dicts]} for each chunk."""
+    for df in pd.read_csv(csv_path, chunksize=chunksize):
+        yield classify_chunk(df, rules)
+
+def iter_categorized_images(shower_csv, floor_csv, text_files, chunksize=50000):
+    """Stream categorized images from the CSV files and text files.
+    
+    Yields one {category: [image dicts]} batch per CSV chunk and per text
+    file, so memory stays bounded by the chunk size rather than the dataset.
+    """
+    counts = {category: 0 for category in CATEGORIES}
+    
+    for csv_path, rules in ((shower_csv, SHOWER_CSV_RULES), (floor_csv, FLOOR_CSV_RULES)):
+        for chunk_categories in iter_csv_images(csv_path, rules, chunksize):
+            for category, images in chunk_categories.items():
+                counts[category] += len(images)
+            yield chunk_categories
     
+    # Process text files
     for filename, content in text_files.items():
-        category = file_category_mapping.get(filename)
+        category = FILE_CATEGORY_MAPPING.get(filename)
         if category is None:
             continue
             
         urls = extract_urls_from_text(content)
         
+        images = []
         for i, url in enumerate(urls):
-            categories[category].append({
+            images.append({
                 'url': url,
                 'description': f"{category.replace('_', ' ')} image",
                 'source': 'Pinterest',
-                'id': f"{category}_{len(categories[category]) + i}"
+                'id': f"{category}_{counts[category] + i}"
             })
+            counts[category] += 1
+        yield {category: images}
+
+def process_csv_data(shower_csv, floor_csv, text_files):
+    """Process CSV files and text files to categorize images."""
+    # Initialize categories dictionary
+    categories = {category: [] for category in CATEGORIES}
+    
+    for chunk_categories in iter_categorized_images(shower_csv, floor_csv, text_files):
+        for category, images in chunk_categories.items():
+            categories[category].extend(images)
     
     # Print statistics
     print("Categorization complete!")
@@ -1,233 +1,889 @@
 import os
 import pandas as pd
 import json
-import sqlite3
 import random
 import requests
 from urllib.parse import urlparse
 from datetime import datetime
 import re
+import base64
+import bisect
+from collections import OrderedDict
+import time
+import threading
+
+from database import Database
+from process_data import CATEGORIES
+from metrics import METRICS
+from setup_database import get_image_keys, get_index_version, migrate_schema, refresh_shuffle_keys
+from neighbour_index import NeighbourIndex, ImageRowCache, record_similarity_changes
+from ann_index import ANNIndex, ann_dir_for
+from recommendation_cache import RecommendationCache
+
+def encode_cursor(position, seed):
+    """Encode a feed position and shuffle seed as an opaque pagination cursor."""
+    payload = json.dumps({'p': position, 's': seed}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    """Decode a cursor created by encode_cursor into (position, seed).
+    
+    Raises ValueError if the cursor is malformed.
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        return payload['p'], payload['s']
+    except (ValueError, TypeError, KeyError, UnicodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+
+# Largest page the API serves; bigger limits are clamped to it
+MAX_PAGE_SIZE = 100
+
+def parse_limit(value, default=12):
+    """Parse a page size from a query string, clamping it to MAX_PAGE_SIZE.
+    
+    Raises ValueError unless the value is a positive integer.
+    """
+    if value is None:
+        return default
+    limit = int(value)
+    if limit < 1:
+        raise ValueError(f"Invalid limit: {value!r}")
+    return min(limit, MAX_PAGE_SIZE)
+
+# Keyset position that sorts before every image
+_FIRST_POSITION = (float('inf'), 0, '')
+
+# Most sources a for-you cursor can hold: the categories, the '*' fallback and 'cf'
+_MAX_CURSOR_SOURCES = 32
+
+# Range of a SQLite INTEGER; binding a larger Python int raises OverflowError
+_SQLITE_INT_MIN = -2 ** 63
+_SQLITE_INT_MAX = 2 ** 63 - 1
+
+def _is_sqlite_int(value):
+    """True for a non-bool int that SQLite can store."""
+    return isinstance(value, int) and not isinstance(value, bool) and _SQLITE_INT_MIN <= value <= _SQLITE_INT_MAX
+
+def _is_keyset_position(value):
+    """True for a (popularity, shuffle_key, id) position as produced by _last_position."""
+    return (
+        isinstance(value, list) and len(value) == 3
+        and (isinstance(value[0], float) or _is_sqlite_int(value[0]))
+        and _is_sqlite_int(value[1])
+        and isinstance(value[2], str)
+    )
+
+def check_cursor_position(feed, position):
+    """Check that a decoded cursor position has the shape the feed produces.
+    
+    Category and 'all' feeds use one keyset position; the for-you feed maps
+    each source to a position, with a (score, id) position under 'cf' for the
+    collaborative candidates. Raises ValueError otherwise, so a cursor from
+    another feed or a crafted one is rejected like a malformed cursor.
+    """
+    if feed != 'for-you':
+        if not _is_keyset_position(position):
+            raise ValueError(f"Invalid cursor position for feed {feed!r}")
+        return
+    
+    if not isinstance(position, dict) or len(position) > _MAX_CURSOR_SOURCES:
+        raise ValueError("Invalid cursor position for feed 'for-you'")
+    for source, value in position.items():
+        if source == 'cf':
+            valid = (
+                isinstance(value, list) and len(value) == 2
+                and (isinstance(value[0], float) or _is_sqlite_int(value[0]))
+                and isinstance(value[1], str)
+            )
+        else:
+            valid = _is_keyset_position(value)
+        if not valid:
+            raise ValueError("Invalid cursor position for feed 'for-you'")
+
+def _last_position(images):
+    """Return the keyset position (popularity, shuffle_key, id) of the last image in a page."""
+    if not images:
+        return None
+    last = images[-1]
+    return [last['popularity'], last['shuffle_key'], last['id']]
+
+def _now():
+    """Current time in the format stored in the database."""
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+def preference_event(user_id, image_id, rating):
+    """Build a like/dislike event for RecommendationSystem.apply_events."""
+    return {
+        'type': 'preference',
+        'user_id': user_id,
+        'image_id': image_id,
+        'rating': rating,
+        'timestamp': _now()
+    }
+
+def view_event(session_id, user_id, image_id, view_time):
+    """Build a view-time event for RecommendationSystem.apply_events."""
+    return {
+        'type': 'view',
+        'session_id': session_id,
+        'user_id': user_id,
+        'image_id': image_id,
+        'view_time': view_time,
+        'timestamp': _now()
+    }
+
+class _CandidateSource:
+    """Ranked candidates from one feed source, consumed in order while skipping excluded images."""
+    
+    def __init__(self, rows, excluded, complete):
+        self.rows = rows
+        self.excluded = excluded
+        self.complete = complete
+        self.consumed = 0
+        self.position = None
+    
+    def take(self, count):
+        """Take up to `count` images, advancing the keyset position past skipped ones too."""
+        taken = []
+        while len(taken) < count and self.consumed < len(self.rows):
+            row = self.rows[self.consumed]
+            self.consumed += 1
+            self.position = _last_position([row])
+            if row['id'] not in self.excluded:
+                taken.append(row)
+        return taken
+    
+    @property
+    def exhausted(self):
+        """True when the database has no candidates left for this source."""
+        if self.consumed < len(self.rows):
+            # Anything left over that would be skipped anyway does not count
+            return all(row['id'] in self.excluded for row in self.rows[self.consumed:]) and self.complete
+        return self.complete
 
 class RecommendationSystem:
-    def __init__(self, db_path='data/bathroom_images.db'):
-        """Initialize the recommendation system with database connection."""
+    def __init__(self, db_path='data/bathroom_images.db', ann_dir=None, metrics=METRICS):
+        """Initialize the recommendation system with per-thread database connections.
+        
+        Statement timings go to `metrics` (the process-wide registry by default, None to disable).
+        """
         self.db_path = db_path
-        self.conn = sqlite3.connect(db_path)
-        self.conn.row_factory = sqlite3.Row
-        self.cursor = self.conn.cursor()
+        self.db = Database(db_path, metrics=metrics)
+        
+        # "More like this" is served from an in-memory neighbour index, kept in step with
+        # the similarity table (checked at most every index_check_interval seconds):
+        # lists changed by likes are patched in, rebuilds reload it in the background
+        self.neighbour_index = None
+        self.index_check_interval = 5.0
+        self._index_checked_at = 0.0
+        self._index_lock = threading.Lock()
+        self._index_reload = None
+        self.max_neighbour_overlay = 100000
+        self.image_cache = ImageRowCache()
+        
+        # Item-item collaborative neighbours built offline by collaborative_filtering.py;
+        # up to collaborative_share of every for-you page comes from them
+        self.collaborative_index = None
+        self._collaborative_checked_at = 0.0
+        self.collaborative_share = 0.25
+        self.collaborative_seeds = 50
+        self.max_collaborative_candidates = 200
+        
+        # Category preferences and ratings of recently active users, see get_user_state.
+        # Writes bump the user's generation (users share a slot per hash, so the table
+        # stays bounded); a state loaded across a write is not cached.
+        self._user_state = OrderedDict()
+        self._user_state_lock = threading.Lock()
+        self._user_generations = [0] * 4096
+        self.max_cached_users = 10000
+        self.user_state_ttl = 300
+        
+        # Ranked feed results, invalidated per user by apply_events
+        self.cache = RecommendationCache()
+        self.cached_candidates = 200
+        self.anonymous_cache_ttl = 30
+        
+        # Optional embedding index for cross-category and fallback neighbours, used if it was
+        # built (next to the database unless `ann_dir` is given) and reloaded when rebuilt
+        self.ann_dir = ann_dir or ann_dir_for(db_path)
+        self.ann_index = None
+        self._ann_checked_at = 0.0
+        
+        # Feed queries rely on the ranking column and indexes, bring older databases up to date
+        migrate_schema(self.cursor)
     
-    def get_initial_recommendations(self, limit=20):
-        """Get initial recommendations based on popularity."""
-        self.cursor.execute('''
-        SELECT * FROM images 
-        ORDER BY popularity DESC, RANDOM()
-        LIMIT ?
-        ''', (limit,))
+    @property
+    def conn(self):
+        """The calling thread's database connection."""
+        return self.db.connection()
+    
+    @property
+    def cursor(self):
+        """The calling thread's cursor."""
+        return self.db.cursor()
+    
+    def get_image(self, image_id):
+        """Get a single image by id, or None if it does not exist."""
+        images = self.image_cache.get_many(self.cursor, [image_id])
+        return images[0] if images else None
+    
+    def _live_images(self, image_ids):
+        """Get image rows in order, leaving out images whose URL was found dead."""
+        return [image for image in self.image_cache.get_many(self.cursor, image_ids) if not image['dead']]
+    
+    def get_initial_recommendations(self, limit=20, after=None):
+        """Get initial recommendations based on popularity.
+        
+        Images are ranked by popularity, with ties broken by the precomputed
+        random `shuffle_key` so the query is an index range scan rather than an
+        ORDER BY RANDOM() sort. `after` is the (popularity, shuffle_key, id)
+        keyset position of the last image already shown; only images ranked
+        after it are returned.
+        """
+        if after is None:
+            self.cursor.execute('''
+            SELECT * FROM images 
+            WHERE dead = 0
+            ORDER BY popularity DESC, shuffle_key DESC, id DESC
+            LIMIT ?
+            ''', (limit,))
+        else:
+            self.cursor.execute('''
+            SELECT * FROM images 
+            WHERE dead = 0 AND (popularity, shuffle_key, id) < (?, ?, ?)
+            ORDER BY popularity DESC, shuffle_key DESC, id DESC
+            LIMIT ?
+            ''', (*after, limit))
         
         return [dict(row) for row in self.cursor.fetchall()]
     
-    def get_recommendations_by_category(self, category, limit=20):
-        """Get recommendations for a specific category."""
-        self.cursor.execute('''
-        SELECT * FROM images 
-        WHERE category = ?
-        ORDER BY popularity DESC, RANDOM()
-        LIMIT ?
-        ''', (category, limit))
+    def get_recommendations_by_category(self, category, limit=20, after=None):
+        """Get recommendations for a specific category, optionally after a keyset position."""
+        if after is None:
+            self.cursor.execute('''
+            SELECT * FROM images 
+            WHERE category = ? AND dead = 0
+            ORDER BY popularity DESC, shuffle_key DESC, id DESC
+            LIMIT ?
+            ''', (category, limit))
+        else:
+            self.cursor.execute('''
+            SELECT * FROM images 
+            WHERE category = ? AND dead = 0 AND (popularity, shuffle_key, id) < (?, ?, ?)
+            ORDER BY popularity DESC, shuffle_key DESC, id DESC
+            LIMIT ?
+            ''', (category, *after, limit))
         
         return [dict(row) for row in self.cursor.fetchall()]
     
-    def get_similar_images(self, image_id, limit=12):
-        """Get similar images based on similarity scores."""
-        self.cursor.execute('''
-        SELECT i.* 
-        FROM images i
-        JOIN image_similarities s ON i.id = s.image_id2
-        WHERE s.image_id1 = ?
-        ORDER BY s.similarity_score DESC, i.popularity DESC
-        LIMIT ?
-        ''', (image_id, limit))
+    def get_feed_page(self, feed, limit=20, cursor=None, user_id=None, seed=None):
+        """Get one page of a feed ('all', 'for-you' or a category) with a cursor for the next page.
         
-        return [dict(row) for row in self.cursor.fetchall()]
+        The cursor encodes the keyset position of the last image served plus the
+        session's shuffle seed, so every page is an index range scan and pages
+        never overlap. The seed only shuffles the order of images within a page.
+        """
+        position = None
+        if cursor:
+            position, seed = decode_cursor(cursor)
+            check_cursor_position(feed, position)
+        elif seed is None:
+            seed = random.getrandbits(32)
+        
+        if feed == 'for-you':
+            images, next_position, exhausted = self._cached_personalized_page(user_id, limit, position)
+        else:
+            images, next_position, exhausted = self._cached_ranked_page(feed, limit, position)
+        
+        next_cursor = encode_cursor(next_position, seed) if not exhausted else None
+        
+        # Shuffle within the page so equally popular images do not always appear in id order
+        random.Random(f"{seed}:{cursor}").shuffle(images)
+        
+        return {'images': images, 'next_cursor': next_cursor}
+    
+    def _cached_ranked_page(self, feed, limit, position):
+        """Serve an 'all' or category page from the feed's cached ranked list when it covers it.
+        
+        The first `cached_candidates` images of each anonymous feed are cached for
+        `anonymous_cache_ttl` seconds and shared by all users; pages past that
+        range go to the database.
+        """
+        key = ('ranked', feed)
+        ranked = self.cache.get(key)
+        if ranked is None:
+            if feed == 'all':
+                rows = self.get_initial_recommendations(self.cached_candidates)
+            else:
+                rows = self.get_recommendations_by_category(feed, self.cached_candidates)
+            # Ascending keyset keys allow a binary search for the cursor position
+            keys = [tuple(_last_position([row])) for row in reversed(rows)]
+            ranked = (keys, rows, len(rows) < self.cached_candidates)
+            self.cache.put(key, ranked, ttl=self.anonymous_cache_ttl)
+        
+        keys, rows, complete = ranked
+        start = 0 if position is None else len(keys) - bisect.bisect_left(keys, tuple(position))
+        images = rows[start:start + limit]
+        
+        if len(images) < limit and not complete:
+            if feed == 'all':
+                images = self.get_initial_recommendations(limit, after=position)
+            else:
+                images = self.get_recommendations_by_category(feed, limit, after=position)
+        
+        return list(images), _last_position(images), len(images) < limit
+    
+    def _cached_personalized_page(self, user_id, limit, position):
+        """Serve a for-you page from the cache, computing and caching it on a miss.
+        
+        Entries belong to the user and are dropped by apply_events whenever the
+        user's ratings or category preferences change. A page computed while
+        such a write landed is served but not cached.
+        """
+        key = ('for-you', user_id, json.dumps(position, sort_keys=True), limit)
+        page = self.cache.get(key)
+        if page is None:
+            generation = self.user_generation(user_id)
+            page = self._personalized_page(user_id, limit, after=position)
+            # Checked under the lock apply_events bumps it with, before it invalidates the cache
+            with self._user_state_lock:
+                if self._user_generations[hash(user_id) % len(self._user_generations)] == generation:
+                    self.cache.put(key, page, user_id=user_id)
+        
+        images, next_position, exhausted = page
+        return list(images), next_position, exhausted
+    
+    def get_similar_images(self, image_id, limit=12, cross_category=False):
+        """Get similar images from the in-memory neighbour index.
+        
+        With `cross_category` the embedding (ANN) index is searched across all
+        categories instead. Same-category results are topped up from the ANN
+        index when the neighbour index has fewer than `limit` of them.
+        """
+        ann_index = self.get_ann_index()
+        if cross_category and ann_index is not None:
+            # Over-fetch since images deleted or flagged dead after the index was built are dropped
+            neighbour_ids = [neighbour_id for neighbour_id, _ in ann_index.search(image_id, limit * 2)]
+            return self._live_images(neighbour_ids)[:limit]
+        
+        index = self.get_neighbour_index()
+        neighbour_ids = [neighbour_id for neighbour_id, _ in index.neighbours(image_id, limit)]
+        images = self._live_images(neighbour_ids)
+        
+        if len(images) < limit and ann_index is not None:
+            original = self.get_image(image_id)
+            seen = set(neighbour_ids)
+            # Over-fetch since results from other categories are dropped
+            candidates = [neighbour_id for neighbour_id, _ in ann_index.search(image_id, limit * 4)
+                          if neighbour_id not in seen]
+            for candidate in self._live_images(candidates):
+                if len(images) >= limit:
+                    break
+                if original is not None and candidate['category'] == original['category']:
+                    images.append(candidate)
+        
+        return images
+    
+    def get_ann_index(self):
+        """Get the embedding index, loading it or reloading it if it was rebuilt. None if it has not been built."""
+        now = time.monotonic()
+        if now - self._ann_checked_at < self.index_check_interval:
+            return self.ann_index
+        
+        with self._index_lock:
+            self._ann_checked_at = now
+            version = get_index_version(self.cursor, 'ann')
+            if (self.ann_index is None or self.ann_index.version != version) and ANNIndex.exists(self.ann_dir):
+                self.ann_index = ANNIndex.load(self.ann_dir)
+                self.ann_index.version = version
+        
+        return self.ann_index
+    
+    def get_neighbour_index(self):
+        """Get the neighbour index, keeping it in step with the similarity table.
+        
+        Lists changed by likes since the last check are re-read into the
+        index's overlay. After a full rebuild (a version bump), or once the
+        overlay holds more than `max_neighbour_overlay` lists, the index is
+        reloaded on a background thread while the current one keeps serving;
+        only the very first load blocks.
+        """
+        now = time.monotonic()
+        if self.neighbour_index is not None and now - self._index_checked_at < self.index_check_interval:
+            return self.neighbour_index
+        
+        with self._index_lock:
+            if self.neighbour_index is None:
+                self.neighbour_index = NeighbourIndex.load(self.cursor)
+                self._index_checked_at = now
+                return self.neighbour_index
+            if now - self._index_checked_at < self.index_check_interval:
+                # Another thread checked while this one waited for the lock
+                return self.neighbour_index
+            self._index_checked_at = now
+            
+            index = self.neighbour_index
+            up_to_date = index.apply_changes(self.cursor)
+            stale = (
+                not up_to_date
+                or index.version != get_index_version(self.cursor, 'similarities')
+                or len(index.overlay) > self.max_neighbour_overlay
+            )
+            if stale and (self._index_reload is None or not self._index_reload.is_alive()):
+                self._index_reload = threading.Thread(
+                    target=self._reload_neighbour_index, name='neighbour-index-reload', daemon=True
+                )
+                self._index_reload.start()
+        
+        return self.neighbour_index
     
-    def get_personalized_recommendations(self, user_id, limit=20):
+    def _reload_neighbour_index(self):
+        """Load the neighbour index from scratch and swap it in once it is complete."""
+        try:
+            index = NeighbourIndex.load(self.cursor)
+            # Catch up with likes written while the table was being read
+            index.apply_changes(self.cursor)
+            with self._index_lock:
+                self.neighbour_index = index
+                # A rebuild may come with re-ingested image rows
+                self.image_cache.clear()
+        except Exception as e:
+            print(f"Error reloading the neighbour index: {e}")
+        finally:
+            self.db.release()
+    
+    def get_collaborative_index(self):
+        """Get the collaborative neighbour index, reloading it when the offline job has rebuilt it."""
+        now = time.monotonic()
+        if self.collaborative_index is not None and now - self._collaborative_checked_at < self.index_check_interval:
+            return self.collaborative_index
+        
+        with self._index_lock:
+            self._collaborative_checked_at = now
+            version = get_index_version(self.cursor, 'collaborative')
+            if self.collaborative_index is None or self.collaborative_index.version != version:
+                self.collaborative_index = NeighbourIndex.load(
+                    self.cursor, table='collaborative_neighbours', version_name='collaborative'
+                )
+                # Cached for-you pages were blended from the previous neighbours
+                self.cache.clear()
+        
+        return self.collaborative_index
+    
+    def _collaborative_candidates(self, ratings):
+        """Rank unrated images by collaborative similarity to the user's liked images.
+        
+        The neighbours of the user's most recent `collaborative_seeds` likes are
+        scored by the sum of their similarities. `ratings` must be in the order
+        the images were rated. Returns (image id, score) pairs, best first.
+        """
+        index = self.get_collaborative_index()
+        if not len(index):
+            return []
+        
+        liked = [image_id for image_id, rating in ratings.items() if rating > 0]
+        scores = {}
+        for image_id in liked[-self.collaborative_seeds:]:
+            for neighbour_id, score in index.neighbours(image_id, self.max_collaborative_candidates):
+                if neighbour_id not in ratings:
+                    scores[neighbour_id] = scores.get(neighbour_id, 0) + score
+        
+        ranked = sorted(scores, key=lambda image_id: (-scores[image_id], image_id))
+        return [(image_id, scores[image_id]) for image_id in ranked[:self.max_collaborative_candidates]]
+    
+    def get_personalized_recommendations(self, user_id, limit=20, after=None):
         """Get personalized recommendations based on user preferences."""
-        # Get user's category preferences
-        self.cursor.execute('''
-        SELECT category, preference_score 
-        FROM category_preferences
-        WHERE user_id = ?
-        ORDER BY preference_score DESC
-        ''', (user_id,))
+        images, _, _ = self._personalized_page(user_id, limit, after)
+        return images
+    
+    def _personalized_page(self, user_id, limit, after=None):
+        """Build a personalized page and return (images, keyset positions reached, exhausted).
         
-        category_prefs = {row['category']: row['preference_score'] for row in self.cursor.fetchall()}
+        `after` maps each preferred category (and '*' for the popular fallback) to
+        the keyset position of the last image consumed from it. Candidates for
+        every source are fetched in one query; slots are allocated by preference
+        score in Python and disliked images are skipped using the in-memory
+        user state instead of a join. Up to `collaborative_share` of the page
+        comes first from collaborative neighbours of the user's likes, continuing
+        after the (score, id) under the 'cf' key of `after`; those images are
+        skipped by the other sources.
+        """
+        after = dict(after or {})
+        category_prefs, ratings = self.get_user_state(user_id)
         
         # If user has no preferences yet, return popular images
         if not category_prefs:
-            return self.get_initial_recommendations(limit)
+            images = self.get_initial_recommendations(limit, after=after.get('*'))
+            if images:
+                after['*'] = _last_position(images)
+            return images, after, len(images) < limit
         
-        # Get images from preferred categories
+        disliked = {image_id for image_id, rating in ratings.items() if rating <= 0}
+        collaborative = self._collaborative_candidates(ratings)
+        collaborative_ids = {image_id for image_id, _ in collaborative}
+        
+        # Over-fetch by the number of images that may be skipped, within a bound;
+        # a source that is cut short just continues from its position on the next page
+        preferred_fetch = limit + min(len(disliked), 3 * limit)
+        fallback_fetch = limit + min(len(ratings), 3 * limit)
+        candidates = self._fetch_personalized_candidates(
+            list(category_prefs), after, preferred_fetch, fallback_fetch
+        )
+        sources = {
+            source: _CandidateSource(
+                rows,
+                (disliked if source != '*' else ratings.keys()) | collaborative_ids,
+                len(rows) < (fallback_fetch if source == '*' else preferred_fetch)
+            )
+            for source, rows in candidates.items()
+        }
+        
+        # Blend in images liked by users with similar taste, continuing below the
+        # last one served, so the cursor stays valid when the candidates change
         recommendations = []
-        total_score = sum(category_prefs.values())
+        if 'cf' in after:
+            last_score, last_id = after['cf']
+            collaborative = [
+                (image_id, score) for image_id, score in collaborative
+                if (-score, image_id) > (-last_score, last_id)
+            ]
+        collaborative_page = collaborative[:int(limit * self.collaborative_share)]
+        recommendations.extend(self._live_images([image_id for image_id, _ in collaborative_page]))
+        if collaborative_page:
+            last_id, last_score = collaborative_page[-1]
+            after['cf'] = [last_score, last_id]
         
-        # Handle case where all preference scores are 0
-        if total_score == 0:
-            # Assign equal weight to all categories
-            for category in category_prefs:
-                category_limit = max(1, int(limit / len(category_prefs)))
-                self.cursor.execute('''
-                SELECT i.* 
-                FROM images i
-                LEFT JOIN user_preferences p ON i.id = p.image_id AND p.user_id = ?
-                WHERE i.category = ? AND (p.rating IS NULL OR p.rating > 0)
-                ORDER BY i.popularity DESC, RANDOM()
-                LIMIT ?
-                ''', (user_id, category, category_limit))
-                
-                recommendations.extend([dict(row) for row in self.cursor.fetchall()])
-            return recommendations[:limit]
+        # Get images from preferred categories
+        remaining = limit - len(recommendations)
+        total_score = sum(category_prefs.values())
         
         for category, score in sorted(category_prefs.items(), key=lambda x: x[1], reverse=True):
-            # Number of images to get from this category is proportional to preference score
-            category_limit = max(1, int(limit * (score / total_score)))
+            if total_score == 0:
+                # Assign equal weight to all categories
+                category_limit = max(1, int(remaining / len(category_prefs)))
+            else:
+                # Number of images to get from this category is proportional to preference score
+                category_limit = max(1, int(remaining * (score / total_score)))
             
-            self.cursor.execute('''
-            SELECT i.* 
-            FROM images i
-            LEFT JOIN user_preferences p ON i.id = p.image_id AND p.user_id = ?
-            WHERE i.category = ? AND (p.rating IS NULL OR p.rating > 0)
-            ORDER BY i.popularity DESC, RANDOM()
-            LIMIT ?
-            ''', (user_id, category, category_limit))
-            
-            recommendations.extend([dict(row) for row in self.cursor.fetchall()])
+            # Never take past the page size, the keyset position must match what is served
+            category_limit = min(category_limit, limit - len(recommendations))
+            if category_limit <= 0:
+                break
+            recommendations.extend(sources[category].take(category_limit))
         
-        # If we don't have enough recommendations, add some popular images
+        # If we don't have enough recommendations, add some popular images from other categories
         if len(recommendations) < limit:
-            self.cursor.execute('''
-            SELECT i.* 
-            FROM images i
-            LEFT JOIN user_preferences p ON i.id = p.image_id AND p.user_id = ?
-            WHERE p.image_id IS NULL
-            ORDER BY i.popularity DESC, RANDOM()
-            LIMIT ?
-            ''', (user_id, limit - len(recommendations)))
-            
-            recommendations.extend([dict(row) for row in self.cursor.fetchall()])
+            recommendations.extend(sources['*'].take(limit - len(recommendations)))
         
-        return recommendations[:limit]
+        # Once the fallback is exhausted, keep filling from the preferred categories
+        for category in category_prefs:
+            if len(recommendations) >= limit:
+                break
+            recommendations.extend(sources[category].take(limit - len(recommendations)))
+        
+        for source_name, source in sources.items():
+            if source.position is not None:
+                after[source_name] = source.position
+        exhausted = all(source.exhausted for source in sources.values()) and len(collaborative_page) == len(collaborative)
+        
+        return recommendations, after, exhausted
+    
+    def _fetch_personalized_candidates(self, categories, after, preferred_fetch, fallback_fetch):
+        """Fetch ranked candidates for each preferred category and the fallback in one query.
+        
+        The fallback ('*') is the most popular images outside the preferred
+        categories. It is fetched per remaining category, so every subquery is a
+        range scan of idx_images_category_rank, and merged here; when the user
+        prefers every category there is no fallback to fetch.
+        """
+        others = [category for category in CATEGORIES if category not in categories]
+        subqueries = []
+        params = []
+        for source, category, fetch in (
+            [(category, category, preferred_fetch) for category in categories]
+            + [('*', category, fallback_fetch) for category in others]
+        ):
+            subqueries.append('''
+            SELECT * FROM (
+                SELECT ? AS source, * FROM images
+                WHERE category = ? AND dead = 0 AND (popularity, shuffle_key, id) < (?, ?, ?)
+                ORDER BY popularity DESC, shuffle_key DESC, id DESC
+                LIMIT ?
+            )''')
+            params.extend([source, category, *after.get(source, _FIRST_POSITION), fetch])
+        
+        candidates = {source: [] for source in categories + ['*']}
+        if subqueries:
+            self.cursor.execute('\nUNION ALL\n'.join(subqueries), params)
+            for row in self.cursor.fetchall():
+                image = dict(row)
+                candidates[image.pop('source')].append(image)
+        
+        # Merge the fallback's per-category runs into one ranking
+        candidates['*'].sort(key=lambda image: (image['popularity'], image['shuffle_key'], image['id']), reverse=True)
+        del candidates['*'][fallback_fetch:]
+        return candidates
+    
+    def user_generation(self, user_id):
+        """Counter bumped whenever apply_events writes for this user (or one sharing its slot)."""
+        with self._user_state_lock:
+            return self._user_generations[hash(user_id) % len(self._user_generations)]
+    
+    def get_user_state(self, user_id):
+        """Get a user's (category preferences, {image_id: rating}) from the in-memory cache.
+        
+        Loaded from the database on first use or after `user_state_ttl` seconds,
+        and kept up to date by apply_events. A load that overlaps a write for
+        the user is returned but not cached. Returns copies, safe to use
+        without holding the lock.
+        """
+        slot = hash(user_id) % len(self._user_generations)
+        with self._user_state_lock:
+            state = self._user_state.get(user_id)
+            if state is not None and time.monotonic() - state['loaded_at'] < self.user_state_ttl:
+                self._user_state.move_to_end(user_id)
+                return dict(state['prefs']), dict(state['ratings'])
+            generation = self._user_generations[slot]
+        
+        self.cursor.execute('''
+        SELECT category, preference_score 
+        FROM category_preferences
+        WHERE user_id = ?
+        ''', (user_id,))
+        prefs = {row['category']: row['preference_score'] for row in self.cursor.fetchall()}
+        
+        # In rating order, so the most recent likes come last
+        self.cursor.execute('''
+        SELECT image_id, rating FROM user_preferences
+        WHERE user_id = ?
+        ORDER BY timestamp, rowid
+        ''', (user_id,))
+        ratings = {row['image_id']: row['rating'] for row in self.cursor.fetchall()}
+        
+        with self._user_state_lock:
+            if self._user_generations[slot] == generation:
+                self._user_state[user_id] = {'prefs': prefs, 'ratings': ratings, 'loaded_at': time.monotonic()}
+                self._user_state.move_to_end(user_id)
+                while len(self._user_state) > self.max_cached_users:
+                    self._user_state.popitem(last=False)
+        
+        return dict(prefs), dict(ratings)
     
     def record_user_preference(self, user_id, image_id, rating):
         """Record user preference (like/dislike) for an image."""
-        # Get image category
-        self.cursor.execute('SELECT category FROM images WHERE id = ?', (image_id,))
-        result = self.cursor.fetchone()
-        if not result:
-            return False
+        event = preference_event(user_id, image_id, rating)
+        return self.apply_events([event]) == 1
+    
+    def record_view_time(self, session_id, user_id, image_id, view_time):
+        """Record time spent viewing an image."""
+        self.apply_events([view_event(session_id, user_id, image_id, view_time)])
+        return True
+    
+    def apply_events(self, events):
+        """Apply a batch of preference and view events in a single transaction.
         
-        category = result['category']
+        Writes are grouped per table: preferences and sessions are upserted with
+        one executemany each, and popularity and category preference deltas are
+        summed per image and per (user, category) first. Preferences for unknown
+        images are skipped. Returns the number of events applied.
+        """
+        if not events:
+            return 0
         
-        # Record preference
-        self.cursor.execute('''
-        INSERT OR REPLACE INTO user_preferences (user_id, image_id, rating, timestamp)
+        # Look up the categories of all images touched by the batch at once
+        image_ids = list({event['image_id'] for event in events})
+        categories = {}
+        for start in range(0, len(image_ids), 500):
+            chunk = image_ids[start:start + 500]
+            placeholders = ', '.join('?' for _ in chunk)
+            self.cursor.execute(f'SELECT id, category FROM images WHERE id IN ({placeholders})', chunk)
+            categories.update((row['id'], row['category']) for row in self.cursor.fetchall())
+        
+        preferences = []
+        sessions = []
+        popularity_deltas = {}
+        category_deltas = {}
+        applied = 0
+        
+        for event in events:
+            image_id = event['image_id']
+            category = categories.get(image_id)
+            
+            if event['type'] == 'preference':
+                if category is None:
+                    continue
+                preferences.append((event['user_id'], image_id, event['rating'], event['timestamp']))
+                popularity_delta = event['rating']
+                category_delta = event['rating']
+            else:
+                sessions.append((
+                    event['session_id'], event['user_id'], image_id, event['view_time'], event['timestamp']
+                ))
+                # If view time is significant, slightly increase image popularity and category preference
+                if event['view_time'] > 5 and category is not None:
+                    popularity_delta = 0.5
+                    category_delta = 0.2
+                else:
+                    popularity_delta = category_delta = 0
+            
+            applied += 1
+            if popularity_delta:
+                popularity_deltas[image_id] = popularity_deltas.get(image_id, 0) + popularity_delta
+                key = (event['user_id'], category)
+                previous = category_deltas.get(key, (0, event['timestamp']))
+                category_deltas[key] = (previous[0] + category_delta, max(previous[1], event['timestamp']))
+        
+        # Upserts rather than INSERT OR REPLACE, so the insight counter triggers see every change
+        self.cursor.executemany('''
+        INSERT INTO user_preferences (user_id, image_id, rating, timestamp)
         VALUES (?, ?, ?, ?)
-        ''', (user_id, image_id, rating, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        ON CONFLICT(user_id, image_id)
+        DO UPDATE SET rating = excluded.rating, timestamp = excluded.timestamp
+        ''', preferences)
         
-        # Update image popularity
-        self.cursor.execute('''
+        self.cursor.executemany('''
+        INSERT INTO user_sessions (session_id, user_id, image_id, view_time, timestamp)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(session_id, user_id, image_id)
+        DO UPDATE SET view_time = excluded.view_time, timestamp = excluded.timestamp
+        ''', sessions)
+        
+        # Update image popularity and re-draw its tiebreak within the new popularity tier
+        self.cursor.executemany('''
         UPDATE images
-        SET popularity = popularity + ?
+        SET popularity = popularity + ?, shuffle_key = ABS(RANDOM() % 2147483648)
         WHERE id = ?
-        ''', (rating, image_id))
+        ''', [(delta, image_id) for image_id, delta in popularity_deltas.items()])
         
-        # Update category preference
-        self.cursor.execute('''
+        self.cursor.executemany('''
         INSERT INTO category_preferences (user_id, category, preference_score, timestamp)
         VALUES (?, ?, ?, ?)
         ON CONFLICT(user_id, category) 
         DO UPDATE SET 
-            preference_score = preference_score + ?,
-            timestamp = ?
-        ''', (
-            user_id, category, rating, datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            rating, datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        ))
+            preference_score = preference_score + excluded.preference_score,
+            timestamp = excluded.timestamp
+        ''', [
+            (user_id, category, delta, timestamp)
+            for (user_id, category), (delta, timestamp) in category_deltas.items()
+        ])
         
         self.conn.commit()
-        return True
+        
+        # Cached rows of images whose popularity or tiebreak changed are now stale
+        self.image_cache.invalidate(popularity_deltas)
+        
+        touched_users = {user_id for user_id, _, _, _ in preferences}
+        touched_users.update(user_id for user_id, _ in category_deltas)
+        
+        # Keep the in-memory state of cached users in sync with what was written,
+        # and tell loads and pages computed before the commit not to cache their result
+        with self._user_state_lock:
+            for user_id in touched_users:
+                self._user_generations[hash(user_id) % len(self._user_generations)] += 1
+            for user_id, image_id, rating, _ in preferences:
+                state = self._user_state.get(user_id)
+                if state is not None:
+                    # A re-rated image moves to the end, as in the timestamp order it was loaded in
+                    state['ratings'].pop(image_id, None)
+                    state['ratings'][image_id] = rating
+            for (user_id, category), (delta, _) in category_deltas.items():
+                state = self._user_state.get(user_id)
+                if state is not None:
+                    state['prefs'][category] = state['prefs'].get(category, 0) + delta
+        
+        # Cached feeds of users whose preferences changed are now stale
+        for user_id in touched_users:
+            self.cache.invalidate_user(user_id)
+        
+        return applied
     
-    def record_view_time(self, session_id, user_id, image_id, view_time):
-        """Record time spent viewing an image."""
-        self.cursor.execute('''
-        INSERT OR REPLACE INTO user_sessions (session_id, user_id, image_id, view_time, timestamp)
-        VALUES (?, ?, ?, ?, ?)
-        ''', (
-            session_id, user_id, image_id, view_time, 
-            datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        ))
+    def update_similarity_scores(self, user_id, new_image_ids=None, max_fanout=50, max_pairs=2000):
+        """Strengthen similarity between newly liked images and the user's earlier likes.
         
-        # If view time is significant, slightly increase image popularity
-        if view_time > 5:  # More than 5 seconds
+        Only pairs involving `new_image_ids` are touched (the user's most recent
+        like if omitted), each paired with at most `max_fanout` of the user's
+        most recent other likes, and at most `max_pairs` rows are written per
+        call, most recent likes first, so the cost is bounded. Images the user
+        no longer likes (e.g. liked then disliked in the same batch) are
+        skipped. Pairs missing from image_similarities are inserted. Returns
+        the number of rows written.
+        """
+        if new_image_ids is None:
             self.cursor.execute('''
-            UPDATE images
-            SET popularity = popularity + 0.5
-            WHERE id = ?
-            ''', (image_id,))
-            
-            # Get image category
-            self.cursor.execute('SELECT category FROM images WHERE id = ?', (image_id,))
-            result = self.cursor.fetchone()
-            if result:
-                category = result['category']
-                
-                # Slightly increase category preference
-                self.cursor.execute('''
-                INSERT INTO category_preferences (user_id, category, preference_score, timestamp)
-                VALUES (?, ?, 0.2, ?)
-                ON CONFLICT(user_id, category) 
-                DO UPDATE SET 
-                    preference_score = preference_score + 0.2,
-                    timestamp = ?
-                ''', (
-                    user_id, category, datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                    datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                ))
+            SELECT image_id FROM user_preferences
+            WHERE user_id = ? AND rating > 0
+            ORDER BY timestamp DESC, rowid DESC
+            LIMIT 1
+            ''', (user_id,))
+            new_image_ids = [row['image_id'] for row in self.cursor.fetchall()]
         
-        self.conn.commit()
-        return True
-    
-    def update_similarity_scores(self, user_id):
-        """Update similarity scores based on user preferences."""
-        # Get user's liked images
-        self.cursor.execute('''
+        new_image_ids = list(dict.fromkeys(new_image_ids))
+        if not new_image_ids:
+            return 0
+        
+        # Keep only the images whose final rating is still a like
+        placeholders = ', '.join('?' for _ in new_image_ids)
+        self.cursor.execute(f'''
         SELECT image_id FROM user_preferences
-        WHERE user_id = ? AND rating > 0
-        ''', (user_id,))
+        WHERE user_id = ? AND rating > 0 AND image_id IN ({placeholders})
+        ''', (user_id, *new_image_ids))
+        liked = {row['image_id'] for row in self.cursor.fetchall()}
+        new_image_ids = [image_id for image_id in new_image_ids if image_id in liked]
+        if not new_image_ids:
+            return 0
         
-        liked_images = [row['image_id'] for row in self.cursor.fetchall()]
+        # Get the user's earlier liked images, most recent first
+        placeholders = ', '.join('?' for _ in new_image_ids)
+        self.cursor.execute(f'''
+        SELECT i.image_key FROM user_preferences p
+        JOIN images i ON i.id = p.image_id
+        WHERE p.user_id = ? AND p.rating > 0 AND p.image_id NOT IN ({placeholders})
+        ORDER BY p.timestamp DESC, p.rowid DESC
+        LIMIT ?
+        ''', (user_id, *new_image_ids, max_fanout))
         
-        # If user hasn't liked enough images, don't update similarities
-        if len(liked_images) < 2:
-            return 0
+        earlier_likes = [row['image_key'] for row in self.cursor.fetchall()]
+        keys = get_image_keys(self.cursor, new_image_ids)
+        # Most recent first, so the cap drops the oldest new likes
+        new_keys = [keys[image_id] for image_id in reversed(new_image_ids) if image_id in keys]
         
-        # Increase similarity between liked images
-        updates = []
-        for i, img1 in enumerate(liked_images):
-            for img2 in liked_images[i+1:]:
-                updates.append((0.1, img1, img2))
-                updates.append((0.1, img2, img1))
+        # Pair each new like with the earlier likes and with the other new likes
+        pairs = []
+        for i, key1 in enumerate(new_keys):
+            for key2 in earlier_likes + new_keys[i+1:]:
+                if len(pairs) >= max_pairs:
+                    break
+                pairs.append((key1, key2, 0.1))
+                pairs.append((key2, key1, 0.1))
         
-        # Batch update
+        # Batch upsert
         self.cursor.executemany('''
-        UPDATE image_similarities
-        SET similarity_score = similarity_score + ?
-        WHERE image_id1 = ? AND image_id2 = ?
-        ''', updates)
+        INSERT INTO image_similarities (image_key1, image_key2, similarity_score)
+        VALUES (?, ?, ?)
+        ON CONFLICT(image_key1, image_key2)
+        DO UPDATE SET similarity_score = similarity_score + excluded.similarity_score
+        ''', pairs)
+        
+        # Running recommenders re-read just the lists that changed
+        record_similarity_changes(self.cursor, {key1 for key1, _, _ in pairs})
+        self.conn.commit()
+        return len(pairs)
+    
+    def refresh_feed_ranking(self):
+        """Re-draw the random tiebreak of every image so equally popular images rotate.
         
+        Run this periodically (e.g. nightly or on startup), not while users are
+        paging, since it moves images relative to existing cursors.
+        """
+        count = refresh_shuffle_keys(self.cursor)
         self.conn.commit()
-        return len(updates)
+        self.image_cache.clear()
+        return count
     
     def close(self):
-        """Close the database connection."""
-        if self.conn:
-            self.conn.close()
+        """Close the database connections of all threads."""
+        if self._index_reload is not None:
+            self._index_reload.join()
+        self.db.close()
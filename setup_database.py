@@ -7,23 +7,86 @@ import requests
 from urllib.parse import urlparse
 from datetime import datetime
 import re
+import time
+import hashlib
 
 # Import process_data and filter_data modules
-from process_data import CATEGORIES
+from process_data import CATEGORIES, iter_categorized_images
 from filter_data import filter_irrelevant_images
+from database import explain_query_plan
 
-def setup_database(filtered_categories):
-    """Set up the SQLite database with initial data."""
-    db_path = 'data/bathroom_images.db'
+def ensure_shuffle_keys(cursor):
+    """Add the shuffle_key ranking column to older databases and fill missing keys."""
+    cursor.execute('PRAGMA table_info(images)')
+    columns = [row[1] for row in cursor.fetchall()]
+    if 'shuffle_key' not in columns:
+        cursor.execute('ALTER TABLE images ADD COLUMN shuffle_key INTEGER')
     
-    # Create data directory if it doesn't exist
-    os.makedirs('data', exist_ok=True)
+    cursor.execute('''
+    UPDATE images
+    SET shuffle_key = ABS(RANDOM() % 2147483648)
+    WHERE shuffle_key IS NULL
+    ''')
+
+def ensure_fingerprints(cursor):
+    """Add the fingerprint column used by delta ingestion to older databases."""
+    cursor.execute('PRAGMA table_info(images)')
+    columns = [row[1] for row in cursor.fetchall()]
+    if 'fingerprint' not in columns:
+        cursor.execute('ALTER TABLE images ADD COLUMN fingerprint TEXT')
+
+def image_fingerprint(image, category):
+    """Hash the source fields of an image so changed rows are detected on re-ingest."""
+    fields = (image['url'], image.get('description', ''), image.get('source', 'Unknown'), category)
+    return hashlib.blake2b('\x1f'.join(str(field) for field in fields).encode('utf-8'), digest_size=16).hexdigest()
+
+def refresh_shuffle_keys(cursor):
+    """Re-draw the random tiebreak for every image. Returns the number of images updated."""
+    cursor.execute('UPDATE images SET shuffle_key = ABS(RANDOM() % 2147483648)')
+    return cursor.rowcount
+
+def create_indexes(cursor):
+    """Create the secondary indexes used by the feed queries."""
+    # Feeds are ranked by popularity with a precomputed random tiebreak, and keyset
+    # pagination walks these indexes backwards: (popularity, shuffle_key, id) < (?, ?, ?)
+    cursor.execute('DROP INDEX IF EXISTS idx_images_category_popularity')
+    cursor.execute('DROP INDEX IF EXISTS idx_images_popularity')
     
-    # Connect to database
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_images_category_rank
+    ON images (category, popularity, shuffle_key, id)
+    ''')
     
-    # Create tables
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_images_rank
+    ON images (popularity, shuffle_key, id)
+    ''')
+
+def create_index_versions(cursor):
+    """Create the table that records when derived indexes (e.g. similarities) were rebuilt."""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS index_versions (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+
+def bump_index_version(cursor, name):
+    """Mark a derived index as rebuilt so in-memory copies reload it."""
+    create_index_versions(cursor)
+    cursor.execute('''
+    INSERT INTO index_versions (name, version) VALUES (?, 1)
+    ON CONFLICT(name) DO UPDATE SET version = version + 1
+    ''', (name,))
+
+def get_index_version(cursor, name):
+    """Get the current version of a derived index (0 if never built)."""
+    cursor.execute('SELECT version FROM index_versions WHERE name = ?', (name,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+def create_tables(cursor):
+    """Create all tables and indexes if they do not exist yet."""
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS images (
         id TEXT PRIMARY KEY,
@@ -32,7 +95,9 @@ def setup_database(filtered_categories):
         source TEXT,
         category TEXT NOT NULL,
         popularity INTEGER DEFAULT 0,
-        date_added TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        date_added TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        shuffle_key INTEGER,
+        fingerprint TEXT
     )
     ''')
     
@@ -80,6 +145,429 @@ def setup_database(filtered_categories):
     )
     ''')
     
+    create_index_versions(cursor)
+    ensure_shuffle_keys(cursor)
+    ensure_fingerprints(cursor)
+    create_indexes(cursor)
+
+def create_secondary_indexes(cursor):
+    """Create the indexes behind per-user history lookups and similarity reads."""
+    # View history and insights: WHERE user_id = ? ORDER BY timestamp DESC
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_user_sessions_user_time
+    ON user_sessions (user_id, timestamp)
+    ''')
+    
+    # Latest likes (update_similarity_scores) and preference history
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_user_preferences_user_time
+    ON user_preferences (user_id, timestamp)
+    ''')
+    
+    # Favourite / least favourite category: WHERE user_id = ? ORDER BY preference_score
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_category_preferences_user_score
+    ON category_preferences (user_id, preference_score)
+    ''')
+    
+    # Neighbours of an image, best first, answered from the index alone
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_image_similarities_score
+    ON image_similarities (image_id1, similarity_score, image_id2)
+    ''')
+
+def use_integer_image_keys(cursor):
+    """Give images an integer surrogate key and store similarities on integer pairs.
+
+    SQLite cannot change a primary key in place, so images and
+    image_similarities are rebuilt: images keeps its string id (still used by
+    the API and the user tables) as a unique column, existing rowids become
+    the image_key values, and image_similarities becomes a WITHOUT ROWID table
+    keyed by (image_key1, image_key2). Popularity is stored as REAL.
+    """
+    cursor.execute('PRAGMA table_info(images)')
+    if 'image_key' in [row[1] for row in cursor.fetchall()]:
+        return
+
+    cursor.execute('''
+    CREATE TABLE images_new (
+        image_key INTEGER PRIMARY KEY,
+        id TEXT NOT NULL UNIQUE,
+        url TEXT NOT NULL,
+        description TEXT,
+        source TEXT,
+        category TEXT NOT NULL,
+        popularity REAL DEFAULT 0,
+        date_added TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        shuffle_key INTEGER,
+        fingerprint TEXT
+    )
+    ''')
+    cursor.execute('''
+    INSERT INTO images_new (image_key, id, url, description, source, category, popularity, date_added, shuffle_key, fingerprint)
+    SELECT rowid, id, url, description, source, category, CAST(popularity AS REAL), date_added, shuffle_key, fingerprint
+    FROM images
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE image_similarities_new (
+        image_key1 INTEGER NOT NULL,
+        image_key2 INTEGER NOT NULL,
+        similarity_score REAL NOT NULL,
+        PRIMARY KEY (image_key1, image_key2),
+        FOREIGN KEY (image_key1) REFERENCES images(image_key),
+        FOREIGN KEY (image_key2) REFERENCES images(image_key)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+    INSERT INTO image_similarities_new (image_key1, image_key2, similarity_score)
+    SELECT a.image_key, b.image_key, s.similarity_score
+    FROM image_similarities s
+    JOIN images_new a ON a.id = s.image_id1
+    JOIN images_new b ON b.id = s.image_id2
+    ''')
+
+    cursor.execute('DROP TABLE image_similarities')
+    cursor.execute('DROP TABLE images')
+    cursor.execute('ALTER TABLE images_new RENAME TO images')
+    cursor.execute('ALTER TABLE image_similarities_new RENAME TO image_similarities')
+
+    create_indexes(cursor)
+    # The primary key (image_key1, image_key2) rides along in every index entry,
+    # so this index covers neighbour lookups
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_image_similarities_score
+    ON image_similarities (image_key1, similarity_score)
+    ''')
+
+def create_insight_summaries(cursor):
+    """Create per-user interaction counters kept up to date by triggers, and backfill them.
+    
+    user_preference_counts holds each user's total, liked and disliked image
+    counts and category_views the number of viewed images per user and
+    category, so preference insights read a handful of rows instead of a
+    user's whole history. Writers must upsert rather than INSERT OR REPLACE:
+    the deletes done by REPLACE do not fire triggers.
+    """
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS user_preference_counts (
+        user_id TEXT PRIMARY KEY,
+        total INTEGER NOT NULL DEFAULT 0,
+        likes INTEGER NOT NULL DEFAULT 0,
+        dislikes INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS category_views (
+        user_id TEXT NOT NULL,
+        category TEXT NOT NULL,
+        views INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, category)
+    ) WITHOUT ROWID
+    ''')
+    
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_user_preferences_insert
+    AFTER INSERT ON user_preferences
+    BEGIN
+        INSERT INTO user_preference_counts (user_id, total, likes, dislikes)
+        VALUES (NEW.user_id, 1, NEW.rating > 0, NEW.rating < 0)
+        ON CONFLICT(user_id) DO UPDATE SET
+            total = total + 1,
+            likes = likes + (NEW.rating > 0),
+            dislikes = dislikes + (NEW.rating < 0);
+    END
+    ''')
+    
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_user_preferences_update
+    AFTER UPDATE OF rating ON user_preferences
+    BEGIN
+        UPDATE user_preference_counts
+        SET likes = likes + (NEW.rating > 0) - (OLD.rating > 0),
+            dislikes = dislikes + (NEW.rating < 0) - (OLD.rating < 0)
+        WHERE user_id = NEW.user_id;
+    END
+    ''')
+    
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_user_preferences_delete
+    AFTER DELETE ON user_preferences
+    BEGIN
+        UPDATE user_preference_counts
+        SET total = total - 1,
+            likes = likes - (OLD.rating > 0),
+            dislikes = dislikes - (OLD.rating < 0)
+        WHERE user_id = OLD.user_id;
+    END
+    ''')
+    
+    # Views of images that are not in the catalog are not counted, as in the JOIN they replace
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_user_sessions_insert
+    AFTER INSERT ON user_sessions
+    WHEN EXISTS (SELECT 1 FROM images WHERE id = NEW.image_id)
+    BEGIN
+        INSERT INTO category_views (user_id, category, views)
+        VALUES (NEW.user_id, (SELECT category FROM images WHERE id = NEW.image_id), 1)
+        ON CONFLICT(user_id, category) DO UPDATE SET views = views + 1;
+    END
+    ''')
+    
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_user_sessions_delete
+    AFTER DELETE ON user_sessions
+    WHEN EXISTS (SELECT 1 FROM images WHERE id = OLD.image_id)
+    BEGIN
+        UPDATE category_views
+        SET views = views - 1
+        WHERE user_id = OLD.user_id
+          AND category = (SELECT category FROM images WHERE id = OLD.image_id);
+    END
+    ''')
+    
+    # Backfill from the existing history
+    cursor.execute('DELETE FROM user_preference_counts')
+    cursor.execute('''
+    INSERT INTO user_preference_counts (user_id, total, likes, dislikes)
+    SELECT user_id, COUNT(*), SUM(rating > 0), SUM(rating < 0)
+    FROM user_preferences
+    GROUP BY user_id
+    ''')
+    
+    cursor.execute('DELETE FROM category_views')
+    cursor.execute('''
+    INSERT INTO category_views (user_id, category, views)
+    SELECT s.user_id, i.category, COUNT(*)
+    FROM user_sessions s
+    JOIN images i ON s.image_id = i.id
+    GROUP BY s.user_id, i.category
+    ''')
+
+def create_collaborative_neighbours(cursor):
+    """Create the table of item-item collaborative neighbours.
+    
+    Filled offline by collaborative_filtering.calculate_collaborative_neighbours
+    from the whole user_preferences history, with the same layout as
+    image_similarities so both load into a NeighbourIndex.
+    """
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS collaborative_neighbours (
+        image_key1 INTEGER NOT NULL,
+        image_key2 INTEGER NOT NULL,
+        similarity_score REAL NOT NULL,
+        PRIMARY KEY (image_key1, image_key2)
+    ) WITHOUT ROWID
+    ''')
+
+def create_url_checks(cursor):
+    """Create the table of image URL health checks.
+    
+    Filled by url_health during ingest and by its catalog check. Rows are
+    keyed by URL rather than image, so a re-ingested image reuses its last
+    check until it goes stale.
+    """
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS url_checks (
+        url TEXT PRIMARY KEY,
+        status INTEGER,
+        content_type TEXT,
+        content_length INTEGER,
+        verdict TEXT NOT NULL,
+        error TEXT,
+        checked_at INTEGER NOT NULL
+    ) WITHOUT ROWID
+    ''')
+
+def backfill_fingerprints(cursor, batch_size=10000):
+    """Fingerprint images ingested before delta ingestion.
+    
+    upsert_images treats a missing fingerprint as a change, so without this
+    the first delta ingest would rewrite every older image and recompute its
+    similarities.
+    """
+    cursor.execute('SELECT id, url, description, source, category FROM images WHERE fingerprint IS NULL')
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        cursor.connection.executemany('UPDATE images SET fingerprint = ? WHERE id = ?', [
+            (image_fingerprint({'url': url, 'description': description or '', 'source': source}, category), image_id)
+            for image_id, url, description, source, category in rows
+        ])
+
+def create_category_change_trigger(cursor):
+    """Keep category_views correct when an image moves to another category.
+    
+    A delta ingest can change an image's category; the views already counted
+    under the old category move to the new one. The image_id index lets the
+    trigger find the image's views without scanning user_sessions.
+    """
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_user_sessions_image
+    ON user_sessions (image_id, user_id)
+    ''')
+    
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_images_category_update
+    AFTER UPDATE OF category ON images
+    WHEN OLD.category IS NOT NEW.category
+    BEGIN
+        UPDATE category_views
+        SET views = views - (
+            SELECT COUNT(*) FROM user_sessions s
+            WHERE s.image_id = NEW.id AND s.user_id = category_views.user_id
+        )
+        WHERE category = OLD.category
+          AND user_id IN (SELECT user_id FROM user_sessions WHERE image_id = NEW.id);
+        
+        INSERT INTO category_views (user_id, category, views)
+        SELECT user_id, NEW.category, COUNT(*) FROM user_sessions
+        WHERE image_id = NEW.id
+        GROUP BY user_id
+        ON CONFLICT(user_id, category) DO UPDATE SET views = views + excluded.views;
+    END
+    ''')
+
+def add_dead_url_flag(cursor):
+    """Add the flag that hides images whose URL was found dead.
+    
+    Set from url_checks by url_health.mark_dead_images. Flagged images are
+    left out of the feeds and similar-image results but keep their user
+    history, so a wrong verdict is undone by the next check.
+    """
+    cursor.execute('PRAGMA table_info(images)')
+    if 'dead' not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute('ALTER TABLE images ADD COLUMN dead INTEGER NOT NULL DEFAULT 0')
+
+def create_similarity_changes(cursor):
+    """Create the log of images whose similarity lists changed outside a full rebuild.
+    
+    update_similarity_scores appends the source key of every list it writes
+    to; running recommenders re-read just those lists into their neighbour
+    index instead of reloading the whole table (see
+    neighbour_index.record_similarity_changes). Old entries are pruned.
+    """
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS similarity_changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        image_key INTEGER NOT NULL
+    )
+    ''')
+
+def get_image_keys(cursor, image_ids, batch_size=500):
+    """Map external image ids to their integer keys. Unknown ids are left out."""
+    image_ids = list(image_ids)
+    keys = {}
+    for start in range(0, len(image_ids), batch_size):
+        batch = image_ids[start:start + batch_size]
+        placeholders = ', '.join('?' for _ in batch)
+        cursor.execute(f'SELECT id, image_key FROM images WHERE id IN ({placeholders})', batch)
+        keys.update((row[0], row[1]) for row in cursor.fetchall())
+    return keys
+
+# Schema versions in order; the version a database is at is kept in PRAGMA user_version
+SCHEMA_MIGRATIONS = [
+    (1, 'tables, ranking and fingerprint columns, feed indexes', create_tables),
+    (2, 'per-user history and similarity indexes', create_secondary_indexes),
+    (3, 'integer image keys, WITHOUT ROWID similarities', use_integer_image_keys),
+    (4, 'per-user insight counters maintained by triggers', create_insight_summaries),
+    (5, 'item-item collaborative neighbours', create_collaborative_neighbours),
+    (6, 'image URL health checks', create_url_checks),
+    (7, 'fingerprints for images ingested before delta ingestion', backfill_fingerprints),
+    (8, 'category_views follow image category changes', create_category_change_trigger),
+    (9, 'flag for images whose URL is dead', add_dead_url_flag),
+    (10, 'log of like-driven similarity list changes', create_similarity_changes),
+]
+
+def get_schema_version(cursor):
+    """Get the schema version recorded in the database (0 for unversioned databases)."""
+    cursor.execute('PRAGMA user_version')
+    return cursor.fetchone()[0]
+
+def migrate_schema(cursor, analyze=True):
+    """Bring a new or live database up to the latest schema version.
+    
+    Every migration is idempotent and runs in its own transaction together
+    with its version bump, so databases created before versioning (version 0)
+    are upgraded in place. ANALYZE refreshes the planner statistics once any
+    migration has run. Returns the versions applied.
+    """
+    conn = cursor.connection
+    current = get_schema_version(cursor)
+    applied = []
+    for version, description, migration in SCHEMA_MIGRATIONS:
+        if version <= current:
+            continue
+    
+        print(f"Applying schema migration {version}: {description}")
+        if not conn.in_transaction:
+            cursor.execute('BEGIN IMMEDIATE')
+        migration(cursor)
+        cursor.execute(f'PRAGMA user_version = {int(version)}')
+        conn.commit()
+        applied.append(version)
+    
+    if applied and analyze:
+        cursor.execute('ANALYZE')
+        conn.commit()
+    return applied
+
+# Hot queries and the index each one should be answered from
+QUERY_PLAN_CHECKS = [
+    ('category feed', '''
+     SELECT * FROM images WHERE category = ? AND dead = 0
+     ORDER BY popularity DESC, shuffle_key DESC, id DESC LIMIT 12
+     ''', ('toilet',), 'idx_images_category_rank'),
+    ('all feed', '''
+     SELECT * FROM images WHERE dead = 0
+     ORDER BY popularity DESC, shuffle_key DESC, id DESC LIMIT 12
+     ''', (), 'idx_images_rank'),
+    ('view history', '''
+     SELECT s.*, i.category, i.description FROM user_sessions s
+     JOIN images i ON s.image_id = i.id
+     WHERE s.user_id = ? ORDER BY s.timestamp DESC LIMIT 50
+     ''', ('user',), 'idx_user_sessions_user_time'),
+    ('latest likes', '''
+     SELECT image_id FROM user_preferences
+     WHERE user_id = ? AND rating > 0 ORDER BY timestamp DESC, rowid DESC LIMIT 10
+     ''', ('user',), 'idx_user_preferences_user_time'),
+    ('favorite category', '''
+     SELECT category FROM category_preferences
+     WHERE user_id = ? ORDER BY preference_score DESC LIMIT 1
+     ''', ('user',), 'idx_category_preferences_user_score'),
+    ('similar images', '''
+     SELECT image_key2 FROM image_similarities
+     WHERE image_key1 = ? ORDER BY similarity_score DESC LIMIT 12
+     ''', (1,), 'idx_image_similarities_score'),
+    ('neighbour join', '''
+     SELECT i.id, s.similarity_score FROM image_similarities s
+     JOIN images i ON i.image_key = s.image_key2
+     WHERE s.image_key1 = ? ORDER BY s.similarity_score DESC LIMIT 12
+     ''', (1,), 'idx_image_similarities_score'),
+]
+
+def verify_query_plans(cursor):
+    """Check that every hot query uses its index without a temporary sort.
+    
+    Returns one dict per query with the plan lines and an `ok` flag.
+    """
+    results = []
+    for name, sql, params, index in QUERY_PLAN_CHECKS:
+        plan = explain_query_plan(cursor, sql, params)
+        uses_index = any(index in line for line in plan)
+        temp_sort = any('USE TEMP B-TREE' in line for line in plan)
+        results.append({
+            'query': name,
+            'index': index,
+            'plan': plan,
+            'ok': uses_index and not temp_sort
+        })
+    return results
+
+def insert_images(cursor, filtered_categories):
+    """Insert categorized images into the images table. Returns the number of images inserted."""
     # Prepare data for batch insertion
     images_data = []
     for category, images in filtered_categories.items():
@@ -91,41 +579,245 @@ def setup_database(filtered_categories):
                 image.get('source', 'Unknown'),
                 category,
                 0,  # Initial popularity
-                datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                image_fingerprint(image, category)
             ))
     
-    # Batch insert
-    cursor.executemany(
-        'INSERT OR REPLACE INTO images (id, url, description, source, category, popularity, date_added) VALUES (?, ?, ?, ?, ?, ?, ?)',
-        images_data
-    )
+    # Batch insert, resetting re-ingested images in place so their integer keys stay valid
+    cursor.executemany('''
+    INSERT INTO images (id, url, description, source, category, popularity, date_added, fingerprint, shuffle_key)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ABS(RANDOM() % 2147483648))
+    ON CONFLICT(id) DO UPDATE SET
+        url = excluded.url,
+        description = excluded.description,
+        source = excluded.source,
+        category = excluded.category,
+        popularity = excluded.popularity,
+        date_added = excluded.date_added,
+        fingerprint = excluded.fingerprint,
+        shuffle_key = excluded.shuffle_key
+    ''', images_data)
+    return len(images_data)
+
+def upsert_images(cursor, filtered_categories, batch_size=500):
+    """Insert new images and update changed ones, leaving unchanged rows alone.
+    
+    Rows are matched by id and compared by fingerprint. Updated images keep
+    their popularity, date_added and shuffle_key. Returns (new_ids, changed_ids).
+    """
+    rows = [
+        (image['id'], image['url'], image.get('description', ''), image.get('source', 'Unknown'),
+         category, image_fingerprint(image, category))
+        for category, images in filtered_categories.items()
+        for image in images
+    ]
+    
+    existing = {}
+    for start in range(0, len(rows), batch_size):
+        batch_ids = [row[0] for row in rows[start:start + batch_size]]
+        placeholders = ', '.join('?' for _ in batch_ids)
+        cursor.execute(f'SELECT id, fingerprint FROM images WHERE id IN ({placeholders})', batch_ids)
+        existing.update(cursor.fetchall())
+    
+    new_ids = [row[0] for row in rows if row[0] not in existing]
+    changed_ids = [row[0] for row in rows if row[0] in existing and existing[row[0]] != row[5]]
+    
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    cursor.executemany('''
+    INSERT INTO images (id, url, description, source, category, popularity, date_added, fingerprint, shuffle_key)
+    VALUES (?, ?, ?, ?, ?, 0, ?, ?, ABS(RANDOM() % 2147483648))
+    ON CONFLICT(id) DO UPDATE SET
+        url = excluded.url,
+        description = excluded.description,
+        source = excluded.source,
+        category = excluded.category,
+        fingerprint = excluded.fingerprint
+    WHERE images.fingerprint IS NOT excluded.fingerprint
+    ''', [row[:5] + (now, row[5]) for row in rows if existing.get(row[0]) != row[5]])
     
+    # A changed description or category invalidates the image's own neighbours and its
+    # place in other images' lists; the second delete scans the table once per batch
+    changed_keys = list(get_image_keys(cursor, changed_ids).values())
+    for start in range(0, len(changed_keys), batch_size):
+        batch = changed_keys[start:start + batch_size]
+        placeholders = ', '.join('?' for _ in batch)
+        cursor.execute(f'DELETE FROM image_similarities WHERE image_key1 IN ({placeholders})', batch)
+        cursor.execute(f'DELETE FROM image_similarities WHERE image_key2 IN ({placeholders})', batch)
+    
+    return new_ids, changed_ids
+
+def insert_initial_similarities(cursor, category_image_ids):
+    """Link each image to its next 10 neighbours (similarity 0.8) among the first 100 ids of each category."""
     # Calculate initial similarities (simple approach: images in same category have similarity of 0.8)
     # For a notebook environment, we'll limit the number of similarity relationships to avoid performance issues
     similarities = []
-    for category, images in filtered_categories.items():
+    for category, image_ids in category_image_ids.items():
         # Limit to 100 images per category for similarity calculation
-        limited_images = images[:min(100, len(images))]
-        for i, image1 in enumerate(limited_images):
-            for j, image2 in enumerate(limited_images[i+1:i+11]):  # Only calculate for 10 nearest images
-                similarities.append((image1['id'], image2['id'], 0.8))
-                similarities.append((image2['id'], image1['id'], 0.8))  # Symmetrical
+        limited_ids = image_ids[:min(100, len(image_ids))]
+        keys = get_image_keys(cursor, limited_ids)
+        limited_keys = [keys[image_id] for image_id in limited_ids if image_id in keys]
+        for i, key1 in enumerate(limited_keys):
+            for key2 in limited_keys[i+1:i+11]:  # Only calculate for 10 nearest images
+                similarities.append((key1, key2, 0.8))
+                similarities.append((key2, key1, 0.8))  # Symmetrical
     
     # Batch insert similarities
     cursor.executemany(
-        'INSERT OR REPLACE INTO image_similarities (image_id1, image_id2, similarity_score) VALUES (?, ?, ?)',
+        'INSERT OR REPLACE INTO image_similarities (image_key1, image_key2, similarity_score) VALUES (?, ?, ?)',
         similarities
     )
+    bump_index_version(cursor, 'similarities')
+    return len(similarities)
+
+def setup_database(filtered_categories):
+    """Set up the SQLite database with initial data."""
+    db_path = 'data/bathroom_images.db'
+    
+    # Create data directory if it doesn't exist
+    os.makedirs('data', exist_ok=True)
+    
+    # Connect to database
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    
+    # Create tables
+    migrate_schema(cursor)
+    
+    image_count = insert_images(cursor, filtered_categories)
+    similarity_count = insert_initial_similarities(cursor, {
+        category: [image['id'] for image in images[:100]]
+        for category, images in filtered_categories.items()
+    })
     
     conn.commit()
     conn.close()
     
     print(f"Database setup complete!")
-    print(f"Added {len(images_data)} images to the database.")
-    print(f"Calculated {len(similarities)} initial similarity relationships.")
+    print(f"Added {image_count} images to the database.")
+    print(f"Calculated {similarity_count} initial similarity relationships.")
     
     return db_path
 
+def stream_setup_database(shower_csv, floor_csv, text_files, chunksize=50000, check_urls=False):
+    """Ingest the CSV and text files into the database chunk by chunk.
+    
+    Streaming equivalent of process_csv_data -> filter_irrelevant_images ->
+    setup_database: each chunk is categorized with vectorized string matching,
+    filtered and inserted in its own transaction, so memory stays flat no
+    matter how large the exports are. With `check_urls` images whose URL is
+    dead are dropped too (see url_health.filter_live_images).
+    """
+    db_path = 'data/bathroom_images.db'
+    os.makedirs('data', exist_ok=True)
+    
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    migrate_schema(cursor)
+    
+    rows_seen = 0
+    image_count = 0
+    urls_checked = 0
+    dead_count = 0
+    before_counts = {category: 0 for category in CATEGORIES}
+    after_counts = {category: 0 for category in CATEGORIES}
+    first_ids = {category: [] for category in CATEGORIES}
+    start_time = time.perf_counter()
+    
+    for chunk_categories in iter_categorized_images(shower_csv, floor_csv, text_files, chunksize):
+        filtered = filter_irrelevant_images(chunk_categories, verbose=False)
+        if check_urls:
+            # Imported here so aiohttp is only needed when URLs are checked
+            from url_health import filter_live_images
+            relevant_count = sum(len(images) for images in filtered.values())
+            filtered, checked = filter_live_images(cursor, filtered)
+            urls_checked += checked
+            dead_count += relevant_count - sum(len(images) for images in filtered.values())
+        image_count += insert_images(cursor, filtered)
+        conn.commit()
+        
+        for category, images in chunk_categories.items():
+            rows_seen += len(images)
+            before_counts[category] += len(images)
+        for category, images in filtered.items():
+            after_counts[category] += len(images)
+            # Only the first 100 ids per category are needed for the initial similarities
+            first_ids[category].extend(image['id'] for image in images[:100 - len(first_ids[category])])
+    
+    similarity_count = insert_initial_similarities(cursor, first_ids)
+    conn.commit()
+    conn.close()
+    
+    elapsed = time.perf_counter() - start_time
+    print("Streaming ingest complete!")
+    for category in CATEGORIES:
+        print(f"{category}: {before_counts[category]} → {after_counts[category]}")
+    print(f"Added {image_count} images to the database "
+          f"({rows_seen / elapsed if elapsed > 0 else 0:.0f} categorized rows/sec).")
+    if check_urls:
+        print(f"Checked {urls_checked} image URLs and dropped {dead_count} dead images.")
+    print(f"Calculated {similarity_count} initial similarity relationships.")
+    
+    return db_path
+
+def delta_setup_database(shower_csv, floor_csv, text_files, chunksize=50000, db_path='data/bathroom_images.db',
+                         check_urls=False, remove_dead=False):
+    """Ingest only new or changed images into an existing database.
+    
+    Source rows are categorized and filtered chunk by chunk as in
+    stream_setup_database, then upserted by fingerprint so accumulated
+    popularity survives a re-ingest. With `check_urls` only URLs whose last
+    health check is stale are checked again, and images already in the
+    database whose URL is now dead are flagged and left out of the feeds
+    (deleted with their user history if `remove_dead` is set). Returns
+    (db_path, ids of new and changed images) so similarities can be computed
+    for just those images.
+    """
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    migrate_schema(cursor)
+    
+    rows_seen = 0
+    urls_checked = 0
+    flagged_count = 0
+    removed_count = 0
+    new_ids = []
+    changed_ids = []
+    start_time = time.perf_counter()
+    
+    for chunk_categories in iter_categorized_images(shower_csv, floor_csv, text_files, chunksize):
+        filtered = filter_irrelevant_images(chunk_categories, verbose=False)
+        if check_urls:
+            from url_health import filter_live_images, mark_dead_images, remove_images
+            live, checked = filter_live_images(cursor, filtered)
+            urls_checked += checked
+            # Images already in the database follow their latest check, in both directions
+            flagged_count += mark_dead_images(cursor, [image['id'] for images in filtered.values() for image in images])
+            if remove_dead:
+                live_ids = {image['id'] for images in live.values() for image in images}
+                removed_count += remove_images(cursor, [
+                    image['id'] for images in filtered.values() for image in images if image['id'] not in live_ids
+                ])
+            filtered = live
+        chunk_new, chunk_changed = upsert_images(cursor, filtered)
+        conn.commit()
+    
+        rows_seen += sum(len(images) for images in chunk_categories.values())
+        new_ids.extend(chunk_new)
+        changed_ids.extend(chunk_changed)
+    
+    conn.close()
+    
+    elapsed = time.perf_counter() - start_time
+    print("Delta ingest complete!")
+    print(f"Scanned {rows_seen} categorized rows in {elapsed:.1f}s: "
+          f"{len(new_ids)} new images, {len(changed_ids)} changed images.")
+    if check_urls:
+        print(f"Checked {urls_checked} stale image URLs and updated the dead flag of {flagged_count} images.")
+        if remove_dead:
+            print(f"Removed {removed_count} images whose URL is dead.")
+    
+    return db_path, new_ids + changed_ids
+
 def calculate_better_similarities_limited(filtered_categories, db_path, max_images_per_category=50):
     """Calculate better similarity relationships between images with limits to prevent performance issues."""
     conn = sqlite3.connect(db_path)
@@ -137,7 +829,7 @@ def calculate_better_similarities_limited(filtered_categories, db_path, max_imag
     images = []
     for category in CATEGORIES:
         cursor.execute('''
-        SELECT id, category, description FROM images 
+        SELECT image_key, category, description FROM images 
         WHERE category = ? 
         ORDER BY RANDOM() 
         LIMIT ?
@@ -146,7 +838,7 @@ def calculate_better_similarities_limited(filtered_categories, db_path, max_imag
     
     print(f"Processing similarities for {len(images)} images...")
     # Create a dictionary for quick lookup
-    image_dict = {img['id']: {'category': img['category'], 'description': img['description']} for img in images}
+    image_dict = {img['image_key']: {'category': img['category'], 'description': img['description']} for img in images}
     
     similarities = []
     
@@ -189,12 +881,35 @@ def calculate_better_similarities_limited(filtered_categories, db_path, max_imag
     print(f"Inserting {len(similarities)} similarity relationships...")
     # Batch insert or update
     cursor.executemany(
-        'INSERT OR REPLACE INTO image_similarities (image_id1, image_id2, similarity_score) VALUES (?, ?, ?)',
+        'INSERT OR REPLACE INTO image_similarities (image_key1, image_key2, similarity_score) VALUES (?, ?, ?)',
         similarities
     )
+    bump_index_version(cursor, 'similarities')
     
     conn.commit()
     conn.close()
     
     print(f"Enhanced similarity calculation complete! Created {len(similarities)} relationships.")
     return len(similarities)
+
+if __name__ == '__main__':
+    # Upgrade an existing database in place and report how the hot queries are planned;
+    # with --refresh-ranking also rotate equally popular images (run it nightly, e.g. from cron)
+    import sys
+    
+    paths = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    db_path = paths[0] if paths else 'data/bathroom_images.db'
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    applied = migrate_schema(cursor)
+    print(f"Schema version {get_schema_version(cursor)} (applied: {applied or 'none'})")
+    
+    if '--refresh-ranking' in sys.argv:
+        rotated = refresh_shuffle_keys(cursor)
+        conn.commit()
+        print(f"Re-drew the feed tiebreak of {rotated} images.")
+    
+    for check in verify_query_plans(cursor):
+        status = 'ok' if check['ok'] else 'CHECK'
+        print(f"[{status}] {check['query']}: {' | '.join(check['plan'])}")
+    conn.close()
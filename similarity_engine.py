@@ -0,0 +1,458 @@
+import os
+import re
+import json
+import sqlite3
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import scipy.sparse as sp
+
+from process_data import CATEGORIES
+from setup_database import bump_index_version, get_index_version
+
+# Same weighting as calculate_better_similarities_limited: a base score for sharing
+# a category plus a weighted text similarity
+CATEGORY_WEIGHT = 0.5
+TEXT_WEIGHT = 0.3
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+def tokenize(description):
+    """Split a description into lowercase word tokens."""
+    return TOKEN_PATTERN.findall((description or '').lower())
+
+def terms_dir_for(db_path):
+    """Directory of the category term models saved for a database: `terms/` next to the database file."""
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)), 'terms')
+
+def count_terms(descriptions, vocabulary=None, binary=False):
+    """Count the tokens of each description into a CSR matrix, tokenizing each description once.
+
+    With a `vocabulary` ({token: column}) unknown tokens are ignored; without
+    one it is built from the descriptions. Returns (counts, vocabulary).
+    """
+    fixed = vocabulary is not None
+    vocabulary = {} if vocabulary is None else vocabulary
+    indptr = [0]
+    indices = []
+    for description in descriptions:
+        tokens = tokenize(description)
+        if binary:
+            tokens = set(tokens)
+        for token in tokens:
+            column = vocabulary.get(token) if fixed else vocabulary.setdefault(token, len(vocabulary))
+            if column is not None:
+                indices.append(column)
+        indptr.append(len(indices))
+
+    data = np.ones(len(indices), dtype=np.float32)
+    counts = sp.csr_matrix(
+        (data, np.asarray(indices, dtype=np.int32), np.asarray(indptr, dtype=np.int64)),
+        shape=(len(descriptions), len(vocabulary))
+    )
+    counts.sum_duplicates()
+    return counts, vocabulary
+
+class TermModel:
+    """Vocabulary and term weights fitted on one category's descriptions.
+
+    fit() returns the L2-normalized TF-IDF (or binary) term matrix of the
+    descriptions it saw; transform() turns more descriptions into rows of the
+    same space, so images ingested later are scored without re-tokenizing
+    their category. Terms that occur in a single description cannot link two
+    images and are dropped. Terms in more than `max_df` of the descriptions
+    carry almost no signal and get no weight, except in rows they would leave
+    empty, such as the templated descriptions of the text-file categories,
+    which keep them so they still link to the rest of their category.
+    """
+
+    def __init__(self, tokens, weights, fallback_weights, binary=False):
+        self.tokens = list(tokens)
+        self.vocabulary = {token: column for column, token in enumerate(self.tokens)}
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.fallback_weights = np.asarray(fallback_weights, dtype=np.float32)
+        self.binary = binary
+
+    @classmethod
+    def fit(cls, descriptions, binary=False, max_df=0.5):
+        """Fit a model on descriptions. Returns (model, their term matrix)."""
+        counts, vocabulary = count_terms(descriptions, binary=binary)
+        n_docs = len(descriptions)
+        document_frequency = np.bincount(counts.indices, minlength=counts.shape[1])
+        shared = np.flatnonzero(document_frequency >= 2)
+        frequency = document_frequency[shared]
+
+        if binary:
+            idf = np.ones(len(shared), dtype=np.float32)
+        else:
+            idf = np.log((1 + n_docs) / (1 + frequency)) + 1
+        keep = frequency <= max(2, max_df * n_docs)
+
+        tokens = list(vocabulary)
+        model = cls([tokens[column] for column in shared], idf * keep, idf, binary)
+        return model, model._weigh(counts[:, shared])
+
+    def transform(self, descriptions):
+        """Term matrix rows for descriptions, ignoring terms the model was not fitted with."""
+        counts, _ = count_terms(descriptions, self.vocabulary, self.binary)
+        return self._weigh(counts)
+
+    def _weigh(self, counts):
+        matrix = (counts @ sp.diags(self.weights)).tocsr()
+        matrix.eliminate_zeros()
+
+        emptied = (np.diff(matrix.indptr) == 0) & (np.diff(counts.indptr) > 0)
+        if emptied.any():
+            fallback = sp.diags(emptied.astype(np.float32)) @ counts @ sp.diags(self.fallback_weights)
+            matrix = (matrix + fallback).tocsr()
+            matrix.eliminate_zeros()
+
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        return (sp.diags((1 / norms).astype(np.float32)) @ matrix).tocsr()
+
+def build_term_matrix(descriptions, binary=False, max_df=0.5):
+    """Build an L2-normalized TF-IDF (or binary) term matrix, one row per description. See TermModel."""
+    return TermModel.fit(descriptions, binary=binary, max_df=max_df)[1]
+
+def top_k_neighbours(matrix, top_k=20, block_size=2048, min_score=0.1, start=0, stop=None, rows=None, transposed=None):
+    """Find the top-k most similar rows of a normalized term matrix for rows start..stop.
+
+    Cosine similarities are computed a block of rows at a time with a sparse
+    matrix product, so memory is bounded by the block rather than the catalog.
+    Pairs below `min_score` are discarded before ranking. Pass `rows` (an array
+    of row numbers) to score only those rows, and `transposed` (the matrix
+    transposed to CSR) to reuse it across calls. Returns parallel arrays
+    (rows, neighbours, scores) of int32/int32/float32.
+    """
+    matrix = sp.csr_matrix(matrix, dtype=np.float32)
+    if transposed is None:
+        transposed = matrix.T.tocsr()
+    if rows is None:
+        rows = np.arange(start, matrix.shape[0] if stop is None else stop, dtype=np.int32)
+    rows = np.asarray(rows, dtype=np.int32)
+    all_rows, all_cols, all_scores = [], [], []
+
+    for block_start in range(0, len(rows), block_size):
+        block_rows = rows[block_start:block_start + block_size]
+        block = (matrix[block_rows] @ transposed).tocsr()
+        block_rows, cols, scores = _top_k_rows(block, top_k, block_rows, min_score)
+        all_rows.append(block_rows)
+        all_cols.append(cols)
+        all_scores.append(scores)
+
+    if not all_rows:
+        empty = np.empty(0, dtype=np.int32)
+        return empty, empty, np.empty(0, dtype=np.float32)
+
+    return np.concatenate(all_rows), np.concatenate(all_cols), np.concatenate(all_scores)
+
+def _top_k_rows(block, top_k, block_rows, min_score):
+    """Select the top-k entries of every row of a sparse similarity block, excluding self-pairs.
+
+    `block_rows` holds the matrix row number of every row of the block.
+    """
+    rows = np.repeat(np.arange(block.shape[0], dtype=np.int32), np.diff(block.indptr))
+    cols = block.indices.astype(np.int32)
+    scores = block.data
+
+    keep = (cols != block_rows[rows]) & (scores >= min_score)
+    rows, cols, scores = rows[keep], cols[keep], scores[keep]
+
+    # Sort by row, then by descending score (scores are in (0, 1], so row + 1 - score
+    # is a single sort key), and keep the first k of every row
+    order = np.argsort(rows + (1 - scores.astype(np.float64)), kind='stable')
+    rows, cols, scores = rows[order], cols[order], scores[order]
+    rank = np.arange(len(rows)) - np.searchsorted(rows, rows, side='left')
+    selected = rank < top_k
+
+    return block_rows[rows[selected]], cols[selected], scores[selected].astype(np.float32)
+
+def write_similarities(cursor, similarities, batch_size=10000, table='image_similarities'):
+    """Insert (image_key1, image_key2, score) tuples into image_similarities (or `table`) in bounded batches."""
+    sql = f'INSERT OR REPLACE INTO {table} (image_key1, image_key2, similarity_score) VALUES (?, ?, ?)'
+    batch = []
+    written = 0
+    for similarity in similarities:
+        batch.append(similarity)
+        if len(batch) >= batch_size:
+            cursor.executemany(sql, batch)
+            written += len(batch)
+            batch = []
+    if batch:
+        cursor.executemany(sql, batch)
+        written += len(batch)
+    return written
+
+def _save_array(path, array):
+    """Write an array under a temporary name and rename it into place, so open memory maps stay valid."""
+    temporary = f"{path[:-len('.npy')]}.tmp.npy"
+    np.save(temporary, array)
+    os.replace(temporary, path)
+
+def _save_matrix(directory, name, matrix):
+    """Write a CSR matrix as .npy arrays that workers can memory-map. Returns its path prefix."""
+    path = os.path.join(directory, name)
+    for part in ('data', 'indices', 'indptr'):
+        _save_array(f"{path}.{part}.npy", getattr(matrix, part))
+    _save_array(f"{path}.shape.npy", np.asarray(matrix.shape, dtype=np.int64))
+    return path
+
+def _save_category(directory, category, model, matrix, keys, version):
+    """Save a category's term model, matrix and image keys. Returns the matrix path prefix.
+
+    The model file is removed first and written last, so an interrupted save
+    is never mistaken for a complete one.
+    """
+    path = os.path.join(directory, category)
+    if os.path.exists(f"{path}.model.json"):
+        os.remove(f"{path}.model.json")
+    _save_matrix(directory, category, matrix)
+    _save_array(f"{path}.keys.npy", np.asarray(keys, dtype=np.int64))
+    _save_array(f"{path}.weights.npy", np.vstack([model.weights, model.fallback_weights]))
+    with open(f"{path}.model.json", 'w') as f:
+        json.dump({'version': version, 'binary': model.binary, 'tokens': model.tokens}, f)
+    return path
+
+def _load_category(directory, category, version, binary):
+    """Load a category saved by _save_category as (model, matrix, keys).
+
+    None if it was never saved, or was saved by a build other than `version`
+    of the 'terms' index or with other term weights.
+    """
+    path = os.path.join(directory, category)
+    try:
+        with open(f"{path}.model.json") as f:
+            saved = json.load(f)
+    except FileNotFoundError:
+        return None
+    if saved['version'] != version or saved['binary'] != binary:
+        return None
+
+    weights, fallback_weights = np.load(f"{path}.weights.npy")
+    arrays = [np.load(f"{path}.{part}.npy") for part in ('data', 'indices', 'indptr')]
+    matrix = sp.csr_matrix(tuple(arrays), shape=tuple(np.load(f"{path}.shape.npy")))
+    model = TermModel(saved['tokens'], weights, fallback_weights, saved['binary'])
+    return model, matrix, np.load(f"{path}.keys.npy")
+
+# The matrix the current worker process last used, as (path, matrix, transposed)
+_worker_matrix = None
+
+def _load_matrix(path):
+    """Memory-map a matrix written by _save_matrix, keeping it for the worker's next task."""
+    global _worker_matrix
+    if _worker_matrix is None or _worker_matrix[0] != path:
+        arrays = [np.load(f"{path}.{part}.npy", mmap_mode='r') for part in ('data', 'indices', 'indptr')]
+        matrix = sp.csr_matrix(tuple(arrays), shape=tuple(np.load(f"{path}.shape.npy")))
+        _worker_matrix = (path, matrix, matrix.T.tocsr())
+    return _worker_matrix[1:]
+
+def _similarity_tasks(cursor, directory, version, workers, top_k, block_size, binary, min_score):
+    """Split the catalog into (category, image keys, task arguments) work items, one category at a time.
+
+    Each category's term model and matrix are fitted and saved to
+    `directory`, where workers memory-map the matrix, so tasks only carry its
+    path; calculate_incremental_similarities reuses the saved models. Large
+    categories are split into row ranges so every worker gets a share of the
+    matrix products.
+    """
+    for category in CATEGORIES:
+        cursor.execute('SELECT image_key, description FROM images WHERE category = ? ORDER BY image_key', (category,))
+        rows = cursor.fetchall()
+        if len(rows) < 2:
+            continue
+
+        keys = [row[0] for row in rows]
+        model, matrix = TermModel.fit([row[1] for row in rows], binary=binary)
+        path = _save_category(directory, category, model, matrix, keys, version)
+        rows_per_task = max(block_size, -(-len(keys) // (2 * workers)))
+        for start in range(0, len(keys), rows_per_task):
+            yield category, keys, (path, top_k, block_size, min_score, start, min(start + rows_per_task, len(keys)))
+
+def _count_tasks(cursor, workers, block_size):
+    """Number of work items _similarity_tasks will yield, from the category sizes alone."""
+    cursor.execute('SELECT category, COUNT(*) FROM images GROUP BY category')
+    sizes = dict(cursor.fetchall())
+    total = 0
+    for category in CATEGORIES:
+        size = sizes.get(category, 0)
+        if size >= 2:
+            rows_per_task = max(block_size, -(-size // (2 * workers)))
+            total += -(-size // rows_per_task)
+    return total
+
+def _compute_task(args):
+    """Worker entry point: top-k neighbours for one row range of a category matrix."""
+    path, top_k, block_size, min_score, start, stop = args
+    matrix, transposed = _load_matrix(path)
+    return top_k_neighbours(matrix, top_k, block_size, min_score, start, stop, transposed=transposed)
+
+def _run_tasks(tasks, workers):
+    """Yield (category, keys, args, result) as tasks finish, in a process pool if workers > 1.
+
+    Tasks are submitted lazily, at most two per worker ahead, so the
+    category matrices are built (and their results written) as the pool
+    works through them rather than all up front.
+    """
+    if workers <= 1:
+        for category, keys, args in tasks:
+            yield category, keys, args, _compute_task(args)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        tasks = iter(tasks)
+        while True:
+            for category, keys, args in tasks:
+                pending[pool.submit(_compute_task, args)] = (category, keys, args)
+                if len(pending) >= 2 * workers:
+                    break
+            if not pending:
+                return
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                category, keys, args = pending.pop(future)
+                yield category, keys, args, future.result()
+
+def calculate_tfidf_similarities(db_path, top_k=20, block_size=2048, binary=False, min_score=0.1, workers=1,
+                                 terms_dir=None):
+    """Calculate text similarities for every image in the catalog.
+
+    Vectorized replacement for calculate_better_similarities_limited: instead of
+    sampling images and comparing word sets pair by pair, each category's
+    descriptions become a TF-IDF matrix and the top-k same-category neighbours
+    of every image are found with blocked sparse matrix products. With
+    `workers` > 1 the row blocks run in a process pool; workers return compact
+    arrays and this process is the only writer, inserting in bounded batches.
+    The fitted term models are saved to `terms_dir` (terms_dir_for(db_path)
+    by default) for calculate_incremental_similarities.
+    """
+    global _worker_matrix
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    directory = terms_dir or terms_dir_for(db_path)
+    os.makedirs(directory, exist_ok=True)
+
+    # Models saved by this build carry the new version; it is committed with the similarities
+    bump_index_version(cursor, 'terms')
+    version = get_index_version(cursor, 'terms')
+    _worker_matrix = None
+
+    task_count = _count_tasks(cursor, workers, block_size)
+    print(f"Calculating similarities in {task_count} tasks with {workers} worker(s)...")
+
+    tasks = _similarity_tasks(cursor, directory, version, workers, top_k, block_size, binary, min_score)
+    total = 0
+    for done, (category, keys, args, result) in enumerate(_run_tasks(tasks, workers), start=1):
+        sources, neighbours, scores = result
+        scores = CATEGORY_WEIGHT + TEXT_WEIGHT * scores
+        written = write_similarities(cursor, (
+            (keys[source], keys[neighbour], float(score))
+            for source, neighbour, score in zip(sources.tolist(), neighbours.tolist(), scores.tolist())
+        ))
+        total += written
+        start, stop = args[4], args[5]
+        print(f"[{done}/{task_count}] {category} rows {start}-{stop}: {written} similarity relationships")
+
+    bump_index_version(cursor, 'similarities')
+    conn.commit()
+    conn.close()
+    # Serial runs map the matrices in this process; let go of them
+    _worker_matrix = None
+
+    print(f"TF-IDF similarity calculation complete! Created {total} relationships.")
+    return total
+
+def calculate_incremental_similarities(db_path, image_ids, top_k=20, block_size=2048, binary=False, min_score=0.1,
+                                       terms_dir=None, batch_size=500):
+    """Calculate similarities for newly ingested or changed images only.
+
+    Only the given images are read from the database. They are transformed
+    with the term model saved by the last full build, their rows replace or
+    extend the saved category matrix (leaving any category they moved out
+    of), and only those rows are scored against it. A category without a
+    usable saved model is fitted from the database once and saved. Terms
+    first seen in new descriptions count from the next full build. Every pair
+    found is stored in both directions, so existing images can pick up the
+    new ones as neighbours; readers keep only the best top-k per image.
+    """
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    directory = terms_dir or terms_dir_for(db_path)
+    os.makedirs(directory, exist_ok=True)
+    version = get_index_version(cursor, 'terms')
+
+    image_ids = list(dict.fromkeys(image_ids))
+    delta = {}
+    for start in range(0, len(image_ids), batch_size):
+        batch = image_ids[start:start + batch_size]
+        placeholders = ', '.join('?' for _ in batch)
+        cursor.execute(f'SELECT image_key, category, description FROM images WHERE id IN ({placeholders})', batch)
+        for key, category, description in cursor.fetchall():
+            delta.setdefault(category, []).append((key, description))
+    delta_keys = np.asarray([key for rows in delta.values() for key, _ in rows], dtype=np.int64)
+
+    total = 0
+    for category in CATEGORIES:
+        rows = delta.get(category, [])
+        saved = _load_category(directory, category, version, binary)
+        if saved is None:
+            if not rows:
+                continue
+            # No usable saved model: fit this category from the database once
+            cursor.execute('SELECT image_key, description FROM images WHERE category = ? ORDER BY image_key', (category,))
+            category_rows = cursor.fetchall()
+            keys = np.asarray([row[0] for row in category_rows], dtype=np.int64)
+            model, matrix = TermModel.fit([row[1] for row in category_rows], binary=binary)
+            new_rows = np.flatnonzero(np.isin(keys, delta_keys))
+        else:
+            model, matrix, keys = saved
+            # Rows of changed images are replaced, and images that moved category leave this one
+            stale = np.isin(keys, delta_keys)
+            if not rows and not stale.any():
+                continue
+            kept = np.flatnonzero(~stale)
+            matrix, keys = matrix[kept], keys[kept]
+            if rows:
+                matrix = sp.vstack([matrix, model.transform([row[1] for row in rows])], format='csr')
+                keys = np.concatenate([keys, np.asarray([row[0] for row in rows], dtype=np.int64)])
+            new_rows = np.arange(len(keys) - len(rows), len(keys))
+        _save_category(directory, category, model, matrix, keys, version)
+        if len(new_rows) == 0 or len(keys) < 2:
+            continue
+
+        sources, neighbours, scores = top_k_neighbours(matrix, top_k, block_size, min_score, rows=new_rows)
+        scores = CATEGORY_WEIGHT + TEXT_WEIGHT * scores
+        keys = keys.tolist()
+        written = write_similarities(cursor, (
+            pair
+            for source, neighbour, score in zip(sources.tolist(), neighbours.tolist(), scores.tolist())
+            for pair in ((keys[source], keys[neighbour], score), (keys[neighbour], keys[source], score))
+        ))
+        total += written
+        print(f"{category}: {len(new_rows)} new images, {written} similarity relationships")
+
+    bump_index_version(cursor, 'similarities')
+    conn.commit()
+    conn.close()
+
+    print(f"Incremental similarity calculation complete! Created {total} relationships.")
+    return total
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild TF-IDF image similarities.')
+    parser.add_argument('--db', default='data/bathroom_images.db', help='path to the SQLite database')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='number of worker processes')
+    parser.add_argument('--top-k', type=int, default=20, help='neighbours kept per image')
+    parser.add_argument('--block-size', type=int, default=2048, help='rows per sparse matrix product')
+    parser.add_argument('--binary', action='store_true', help='use binary term weights instead of TF-IDF')
+    args = parser.parse_args()
+
+    calculate_tfidf_similarities(
+        args.db,
+        top_k=args.top_k,
+        block_size=args.block_size,
+        binary=args.binary,
+        workers=args.workers
+    )
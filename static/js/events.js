@@ -0,0 +1,44 @@
+// Buffered interaction events shared by the feed and similar images pages
+
+// Likes, dislikes and view times wait here and are sent to /api/events in batches
+let pendingEvents = [];
+const EVENT_FLUSH_INTERVAL = 5000; // in milliseconds
+const EVENT_MAX_BATCH = 50;
+
+// Function to queue an event: {type: 'like' | 'dislike', image_id} or {type: 'view', image_id, view_time}
+function queueEvent(event) {
+    pendingEvents.push(event);
+    
+    if (pendingEvents.length >= EVENT_MAX_BATCH) {
+        flushEvents();
+    }
+}
+
+// Function to send all queued events in one request
+function flushEvents() {
+    if (pendingEvents.length === 0) {
+        return;
+    }
+    
+    const body = JSON.stringify({events: pendingEvents});
+    pendingEvents = [];
+    
+    // sendBeacon still delivers while the page is being hidden or unloaded
+    if (navigator.sendBeacon && navigator.sendBeacon('/api/events', new Blob([body], {type: 'application/json'}))) {
+        return;
+    }
+    
+    fetch('/api/events', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: body,
+        keepalive: true,
+    })
+    .catch(error => {
+        console.error('Error sending events:', error);
+    });
+}
+
+setInterval(flushEvents, EVENT_FLUSH_INTERVAL);
@@ -2,7 +2,7 @@
 
 // Global variables
 let currentCategory = 'all';
-let currentPage = 1;
+let nextCursor = null;
 let imagesPerPage = 12;
 let viewStartTimes = {};
 
@@ -39,7 +39,6 @@ document.addEventListener('DOMContentLoaded', function() {
     const loadMoreBtn = document.getElementById('load-more-btn');
     if (loadMoreBtn) {
         loadMoreBtn.addEventListener('click', function() {
-            currentPage++;
             loadImages(true);
         });
     }
@@ -57,9 +56,9 @@ function navigateToCategory(category) {
     const url = category === 'all' ? '/' : `/${category}`;
     history.pushState({category: category}, '', url);
     
-    // Update current category and reset page
+    // Update current category and reset pagination
     currentCategory = category;
-    currentPage = 1;
+    nextCursor = null;
     
     // Update active class on category buttons
     const categoryLinks = document.querySelectorAll('.category-btn');
@@ -84,12 +83,21 @@ function loadImages(append = false) {
     if (!append) {
         imageGrid.innerHTML = '<div class="loading">Loading images...</div>';
         viewStartTimes = {}; // Reset view start times
+        nextCursor = null;
     }
     
-    // Fetch images from API
-    fetch(`/api/images?category=${currentCategory}&limit=${imagesPerPage}&page=${currentPage}`)
+    // Fetch images from API, continuing from the cursor of the previous page
+    let url = `/api/images?category=${currentCategory}&limit=${imagesPerPage}`;
+    if (append && nextCursor) {
+        url += `&cursor=${encodeURIComponent(nextCursor)}`;
+    }
+    
+    fetch(url)
         .then(response => response.json())
-        .then(images => {
+        .then(data => {
+            const images = data.images;
+            nextCursor = data.next_cursor;
+            
             // Remove loading indicator if not appending
             if (!append) {
                 imageGrid.innerHTML = '';
@@ -109,8 +117,8 @@ function loadImages(append = false) {
                 // Hide load more button if no more images
                 document.getElementById('load-more-btn').style.display = 'none';
             } else {
-                // Show load more button
-                document.getElementById('load-more-btn').style.display = 'block';
+                // Show load more button only while there are more pages
+                document.getElementById('load-more-btn').style.display = nextCursor ? 'block' : 'none';
                 
                 // Add images to grid
                 images.forEach(image => {
@@ -140,11 +148,8 @@ function createImageCard(image) {
     
     // Create image element
     const img = document.createElement('img');
-    img.src = image.url;
     img.alt = image.description || 'Bathroom image';
-    img.onerror = function() {
-        this.src = '/static/img/placeholder.jpg';
-    };
+    setThumbnailSource(img, image, '(max-width: 480px) 100vw, 400px');
     imageContainer.appendChild(img);
     
     // Create info section
@@ -202,64 +207,32 @@ function createImageCard(image) {
 
 // Function to like an image
 function likeImage(imageId, button) {
-    fetch('/api/preference', {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-            image_id: imageId,
-            rating: 1
-        }),
-    })
-    .then(response => response.json())
-    .then(data => {
-        if (data.success) {
-            button.textContent = '❤️ Liked';
-            button.disabled = true;
-            button.classList.add('liked');
-            
-            // Disable dislike button
-            const dislikeBtn = button.parentNode.querySelector('.btn-dislike');
-            if (dislikeBtn) {
-                dislikeBtn.disabled = true;
-            }
-        }
-    })
-    .catch(error => {
-        console.error('Error liking image:', error);
-    });
+    queueEvent({type: 'like', image_id: imageId});
+    
+    button.textContent = '❤️ Liked';
+    button.disabled = true;
+    button.classList.add('liked');
+    
+    // Disable dislike button
+    const dislikeBtn = button.parentNode.querySelector('.btn-dislike');
+    if (dislikeBtn) {
+        dislikeBtn.disabled = true;
+    }
 }
 
 // Function to dislike an image
 function dislikeImage(imageId, button) {
-    fetch('/api/preference', {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-            image_id: imageId,
-            rating: -1
-        }),
-    })
-    .then(response => response.json())
-    .then(data => {
-        if (data.success) {
-            button.textContent = '✖️ Disliked';
-            button.disabled = true;
-            button.classList.add('disliked');
-            
-            // Disable like button
-            const likeBtn = button.parentNode.querySelector('.btn-like');
-            if (likeBtn) {
-                likeBtn.disabled = true;
-            }
-        }
-    })
-    .catch(error => {
-        console.error('Error disliking image:', error);
-    });
+    queueEvent({type: 'dislike', image_id: imageId});
+    
+    button.textContent = '✖️ Disliked';
+    button.disabled = true;
+    button.classList.add('disliked');
+    
+    // Disable like button
+    const likeBtn = button.parentNode.querySelector('.btn-like');
+    if (likeBtn) {
+        likeBtn.disabled = true;
+    }
 }
 
 // Function to record view times
@@ -270,19 +243,7 @@ function recordViewTimes() {
         const viewTime = Math.round((now - startTime) / 1000); // Convert to seconds
         
         if (viewTime >= 1) { // Only record if viewed for at least 1 second
-            fetch('/api/view_time', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({
-                    image_id: imageId,
-                    view_time: viewTime
-                }),
-            })
-            .catch(error => {
-                console.error('Error recording view time:', error);
-            });
+            queueEvent({type: 'view', image_id: imageId, view_time: viewTime});
         }
     }
     
@@ -293,8 +254,9 @@ function recordViewTimes() {
 // Function to handle visibility change (tab switching)
 function handleVisibilityChange() {
     if (document.hidden) {
-        // Page is hidden, record view times
+        // Page is hidden, record view times and send everything queued
         recordViewTimes();
+        flushEvents();
     } else {
         // Page is visible again, start timing for visible images
         const imageCards = document.querySelectorAll('.image-card');
@@ -307,7 +269,8 @@ function handleVisibilityChange() {
     }
 }
 
-// Handle page unload to record final view times
-window.addEventListener('beforeunload', function() {
+// Handle page hide to record final view times before the page goes away
+window.addEventListener('pagehide', function() {
     recordViewTimes();
+    flushEvents();
 });
@@ -57,11 +57,8 @@ function createOriginalImageElement(image) {
     
     // Create image element
     const img = document.createElement('img');
-    img.src = image.url;
     img.alt = image.description || 'Original bathroom image';
-    img.onerror = function() {
-        this.src = '/static/img/placeholder.jpg';
-    };
+    setThumbnailSource(img, image, '(max-width: 768px) 100vw, 600px');
     
     // Create info section
     const infoSection = document.createElement('div');
@@ -126,11 +123,8 @@ function createImageCard(image) {
     
     // Create image element
     const img = document.createElement('img');
-    img.src = image.url;
     img.alt = image.description || 'Bathroom image';
-    img.onerror = function() {
-        this.src = '/static/img/placeholder.jpg';
-    };
+    setThumbnailSource(img, image, '(max-width: 480px) 100vw, 400px');
     imageContainer.appendChild(img);
     
     // Create info section
@@ -179,64 +173,32 @@ function createImageCard(image) {
 
 // Function to like an image
 function likeImage(imageId, button) {
-    fetch('/api/preference', {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-            image_id: imageId,
-            rating: 1
-        }),
-    })
-    .then(response => response.json())
-    .then(data => {
-        if (data.success) {
-            button.textContent = '❤️ Liked';
-            button.disabled = true;
-            button.classList.add('liked');
-            
-            // Disable dislike button
-            const dislikeBtn = button.parentNode.querySelector('.btn-dislike');
-            if (dislikeBtn) {
-                dislikeBtn.disabled = true;
-            }
-        }
-    })
-    .catch(error => {
-        console.error('Error liking image:', error);
-    });
+    queueEvent({type: 'like', image_id: imageId});
+    
+    button.textContent = '❤️ Liked';
+    button.disabled = true;
+    button.classList.add('liked');
+    
+    // Disable dislike button
+    const dislikeBtn = button.parentNode.querySelector('.btn-dislike');
+    if (dislikeBtn) {
+        dislikeBtn.disabled = true;
+    }
 }
 
 // Function to dislike an image
 function dislikeImage(imageId, button) {
-    fetch('/api/preference', {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-            image_id: imageId,
-            rating: -1
-        }),
-    })
-    .then(response => response.json())
-    .then(data => {
-        if (data.success) {
-            button.textContent = '✖️ Disliked';
-            button.disabled = true;
-            button.classList.add('disliked');
-            
-            // Disable like button
-            const likeBtn = button.parentNode.querySelector('.btn-like');
-            if (likeBtn) {
-                likeBtn.disabled = true;
-            }
-        }
-    })
-    .catch(error => {
-        console.error('Error disliking image:', error);
-    });
+    queueEvent({type: 'dislike', image_id: imageId});
+    
+    button.textContent = '✖️ Disliked';
+    button.disabled = true;
+    button.classList.add('disliked');
+    
+    // Disable like button
+    const likeBtn = button.parentNode.querySelector('.btn-like');
+    if (likeBtn) {
+        likeBtn.disabled = true;
+    }
 }
 
 // Function to record view times
@@ -247,19 +209,7 @@ function recordViewTimes() {
         const viewTime = Math.round((now - startTime) / 1000); // Convert to seconds
         
         if (viewTime >= 1) { // Only record if viewed for at least 1 second
-            fetch('/api/view_time', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({
-                    image_id: imageId,
-                    view_time: viewTime
-                }),
-            })
-            .catch(error => {
-                console.error('Error recording view time:', error);
-            });
+            queueEvent({type: 'view', image_id: imageId, view_time: viewTime});
         }
     }
     
@@ -270,8 +220,9 @@ function recordViewTimes() {
 // Function to handle visibility change (tab switching)
 function handleVisibilityChange() {
     if (document.hidden) {
-        // Page is hidden, record view times
+        // Page is hidden, record view times and send everything queued
         recordViewTimes();
+        flushEvents();
     } else {
         // Page is visible again, start timing for visible images
         const imageCards = document.querySelectorAll('.image-card');
@@ -294,7 +245,8 @@ function handleVisibilityChange() {
     }
 }
 
-// Handle page unload to record final view times
-window.addEventListener('beforeunload', function() {
+// Handle page hide to record final view times before the page goes away
+window.addEventListener('pagehide', function() {
     recordViewTimes();
+    flushEvents();
 });
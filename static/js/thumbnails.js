@@ -0,0 +1,26 @@
+// Resized thumbnails served by /img/<image_id>/<width>
+
+// Widths the server renders, matching THUMBNAIL_WIDTHS in thumbnails.py
+const THUMBNAIL_WIDTHS = [236, 474, 736];
+
+// Function to load an image through the thumbnail proxy, picking the width from the sizes hint
+function setThumbnailSource(img, image, sizes) {
+    const base = `/img/${encodeURIComponent(image.id)}`;
+    img.srcset = THUMBNAIL_WIDTHS.map(width => `${base}/${width} ${width}w`).join(', ');
+    img.sizes = sizes;
+    img.src = `${base}/${THUMBNAIL_WIDTHS[1]}`;
+    img.loading = 'lazy';
+    img.decoding = 'async';
+    
+    img.onerror = function() {
+        if (this.dataset.fallback !== 'original') {
+            // The proxy could not fetch the original, so try the source directly
+            this.dataset.fallback = 'original';
+            this.removeAttribute('srcset');
+            this.src = image.url;
+        } else {
+            this.onerror = null;
+            this.src = '/static/img/placeholder.jpg';
+        }
+    };
+}
@@ -0,0 +1,40 @@
+import pytest
+
+import app as flask_app
+import metrics
+from metrics import METRICS
+
+@pytest.fixture
+def client():
+    threshold_ms = METRICS.slow_queries.threshold_ms
+    yield flask_app.app.test_client()
+    METRICS.slow_queries.threshold_ms = threshold_ms
+
+def test_slow_queries_answer_loopback_clients(client):
+    response = client.post('/admin/slow-queries', json={'threshold_ms': 20})
+    assert response.status_code == 200
+    assert METRICS.slow_queries.threshold_ms == 20
+    assert client.get('/admin/slow-queries').status_code == 200
+
+def test_slow_queries_refuse_remote_clients(client):
+    remote = {'REMOTE_ADDR': '203.0.113.5'}
+    threshold_ms = METRICS.slow_queries.threshold_ms
+    assert client.post('/admin/slow-queries', json={'threshold_ms': 1}, environ_base=remote).status_code == 403
+    assert client.get('/admin/slow-queries', environ_base=remote).status_code == 403
+    assert METRICS.slow_queries.threshold_ms == threshold_ms
+
+def test_admin_token_is_required_when_set(client, monkeypatch):
+    monkeypatch.setattr(metrics, 'ADMIN_TOKEN', 'secret')
+    remote = {'REMOTE_ADDR': '203.0.113.5'}
+    assert client.get('/admin/slow-queries').status_code == 403
+    assert client.get('/admin/slow-queries', headers={'X-Admin-Token': 'wrong'}, environ_base=remote).status_code == 403
+    assert client.get('/admin/slow-queries', headers={'X-Admin-Token': 'secret'}, environ_base=remote).status_code == 200
+
+@pytest.mark.parametrize('threshold_ms', [0, 0.5, -1, True, 'fast'])
+def test_slow_query_threshold_has_a_minimum(client, threshold_ms):
+    assert client.post('/admin/slow-queries', json={'threshold_ms': threshold_ms}).status_code == 400
+
+def test_metrics_switch_refuses_remote_clients(client):
+    response = client.post('/admin/metrics', json={'enabled': False}, environ_base={'REMOTE_ADDR': '203.0.113.5'})
+    assert response.status_code == 403
+    assert METRICS.enabled
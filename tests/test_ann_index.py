@@ -0,0 +1,50 @@
+import sqlite3
+
+import pytest
+
+from ann_index import ANNIndex
+from setup_database import get_index_version, migrate_schema
+
+WORDS = ['white', 'black', 'marble', 'wooden', 'modern', 'vintage', 'freestanding', 'tub', 'sink', 'tiles']
+
+@pytest.fixture
+def db(tmp_path):
+    db_path = str(tmp_path / 'ann.db')
+    conn = sqlite3.connect(db_path)
+    migrate_schema(conn.cursor(), analyze=False)
+    conn.executemany(
+        'INSERT INTO images (id, url, description, source, category, popularity, shuffle_key) VALUES (?, ?, ?, ?, ?, ?, ?)',
+        ((f"bathtub_{i}", f"http://example.com/{i}.jpg", f"{WORDS[i % 10]} {WORDS[i // 10 % 10]} bathtub",
+          'Pinterest', 'bathtub', 0, i) for i in range(200))
+    )
+    conn.commit()
+    yield db_path, conn
+    conn.close()
+
+def test_update_adds_new_and_drops_removed_images(db, tmp_path):
+    db_path, conn = db
+    directory = str(tmp_path / 'ann')
+    ANNIndex.build(db_path, directory)
+    version = get_index_version(conn.cursor(), 'ann')
+
+    conn.execute("INSERT INTO images (id, url, description, source, category, popularity, shuffle_key) "
+                 "VALUES ('bathtub_new', 'http://example.com/new.jpg', 'white marble bathtub', 'Pinterest', 'bathtub', 0, 1)")
+    conn.execute("UPDATE images SET dead = 1 WHERE id = 'bathtub_1'")
+    conn.execute("DELETE FROM images WHERE id = 'bathtub_2'")
+    conn.commit()
+
+    index = ANNIndex.update(db_path, ['bathtub_new'], directory)
+    assert get_index_version(conn.cursor(), 'ann') == version + 1
+    assert set(index.ids) == {f"bathtub_{i}" for i in range(200) if i not in (1, 2)} | {'bathtub_new'}
+    # bathtub_20 has the same description ('white marble bathtub')
+    assert 'bathtub_20' in dict(index.search('bathtub_new', 5, nprobe=len(index.centroids)))
+    assert ANNIndex.load(directory).ids == index.ids
+
+def test_large_update_falls_back_to_a_full_build(db, tmp_path):
+    db_path, conn = db
+    directory = str(tmp_path / 'ann')
+    built = ANNIndex.build(db_path, directory, n_lists=4)
+
+    index = ANNIndex.update(db_path, [f"bathtub_{i}" for i in range(100)], directory)
+    assert sorted(index.ids) == sorted(built.ids)
+    assert len(index.centroids) != len(built.centroids)
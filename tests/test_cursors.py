@@ -0,0 +1,54 @@
+import sqlite3
+
+import pytest
+
+from recommendation_system import RecommendationSystem, check_cursor_position, encode_cursor
+from setup_database import migrate_schema
+
+@pytest.fixture
+def recommender(tmp_path):
+    db_path = str(tmp_path / 'feed.db')
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    migrate_schema(cursor, analyze=False)
+    cursor.executemany(
+        'INSERT INTO images (id, url, description, source, category, popularity, shuffle_key) VALUES (?, ?, ?, ?, ?, ?, ?)',
+        ((f"toilet_{i}", f"http://example.com/{i}.jpg", 'white toilet', 'Pinterest', 'toilet', i % 3, i)
+         for i in range(30))
+    )
+    conn.commit()
+    conn.close()
+    recommender = RecommendationSystem(db_path, metrics=None)
+    yield recommender
+    recommender.close()
+
+@pytest.mark.parametrize('position', [
+    [-1, 10 ** 30, 'x'],
+    [-1, -2 ** 63 - 1, 'x'],
+    [10 ** 30, 1, 'x'],
+    [True, 1, 'x'],
+    [1, 1.5, 'x'],
+    [1, 1],
+], ids=['huge shuffle key', 'tiny shuffle key', 'huge popularity', 'bool', 'float shuffle key', 'short'])
+def test_out_of_range_positions_are_rejected(position):
+    with pytest.raises(ValueError):
+        check_cursor_position('all', position)
+    with pytest.raises(ValueError):
+        check_cursor_position('for-you', {'toilet': position})
+
+def test_positions_at_the_integer_limits_are_accepted():
+    check_cursor_position('all', [2 ** 63 - 1, -2 ** 63, 'x'])
+    check_cursor_position('for-you', {'*': [1.5, 2 ** 63 - 1, 'x'], 'cf': [0.5, 'x']})
+
+def test_crafted_cursor_is_a_value_error(recommender):
+    cursor = encode_cursor([-1, 10 ** 30, 'x'], 1)
+    with pytest.raises(ValueError):
+        recommender.get_feed_page('all', 5, cursor=cursor)
+
+def test_pages_do_not_overlap(recommender):
+    page = recommender.get_feed_page('toilet', 12)
+    seen = [image['id'] for image in page['images']]
+    while page['next_cursor']:
+        page = recommender.get_feed_page('toilet', 12, cursor=page['next_cursor'])
+        seen.extend(image['id'] for image in page['images'])
+    assert sorted(seen) == sorted(f"toilet_{i}" for i in range(30))
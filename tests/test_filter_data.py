@@ -0,0 +1,21 @@
+import pytest
+
+from filter_data import filter_irrelevant_images, is_relevant_image
+
+IMAGES = [
+    {'id': 'toilet_1', 'description': 'White Toilet', 'url': 'http://example.com/1.jpg'},
+    {'id': 'toilet_2', 'description': 'modern bathroom', 'url': 'http://example.com/toilet-2.jpg'},
+    {'id': 'toilet_3', 'description': 'toilet paper holder', 'url': 'http://example.com/3.jpg'},
+    {'id': 'toilet_4', 'description': 'kitchen sink', 'url': 'http://example.com/4.jpg'},
+    {'id': 'toilet_5', 'description': 'toilets', 'url': 'http://example.com/5.jpg'},
+    {'id': 'toilet_6', 'url': 'http://example.com/toilet.jpg'},
+    {'id': 'toilet_7', 'description': float('nan'), 'url': None},
+]
+
+@pytest.mark.parametrize('images', [IMAGES, []], ids=['mixed', 'empty'])
+def test_vectorized_filter_matches_the_per_image_check(images):
+    expected = [image['id'] for image in images if is_relevant_image(
+        {key: value if isinstance(value, str) else '' for key, value in image.items()}, 'toilet'
+    )]
+    filtered = filter_irrelevant_images({'toilet': images}, verbose=False)
+    assert [image['id'] for image in filtered['toilet']] == expected
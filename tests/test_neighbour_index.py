@@ -0,0 +1,73 @@
+import sqlite3
+
+import pytest
+
+from recommendation_system import RecommendationSystem
+from setup_database import bump_index_version, get_index_version, migrate_schema
+
+@pytest.fixture
+def recommender(tmp_path):
+    """Ten images in a chain of similarities, with the neighbour index checked on every call."""
+    db_path = str(tmp_path / 'neighbours.db')
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    migrate_schema(cursor, analyze=False)
+    cursor.executemany(
+        'INSERT INTO images (id, url, description, source, category, popularity, shuffle_key) VALUES (?, ?, ?, ?, ?, ?, ?)',
+        ((f"toilet_{i}", f"http://example.com/{i}.jpg", 'white toilet', 'Pinterest', 'toilet', 0, i) for i in range(10))
+    )
+    cursor.executemany(
+        'INSERT INTO image_similarities (image_key1, image_key2, similarity_score) VALUES (?, ?, 0.5)',
+        [(key, key + 1) for key in range(1, 10)] + [(key + 1, key) for key in range(1, 10)]
+    )
+    conn.commit()
+    conn.close()
+
+    recommender = RecommendationSystem(db_path, metrics=None)
+    recommender.index_check_interval = 0
+    yield recommender
+    recommender.close()
+
+def like(recommender, user_id, image_ids):
+    for image_id in image_ids:
+        recommender.record_user_preference(user_id, image_id, 1)
+    return recommender.update_similarity_scores(user_id, image_ids)
+
+def test_likes_are_patched_into_the_loaded_index(recommender):
+    index = recommender.get_neighbour_index()
+    version = get_index_version(recommender.cursor, 'similarities')
+    assert [image_id for image_id, _ in index.neighbours('toilet_0')] == ['toilet_1']
+
+    assert like(recommender, 'user_1', ['toilet_0', 'toilet_5']) == 2
+    assert recommender.get_neighbour_index() is index
+    assert get_index_version(recommender.cursor, 'similarities') == version
+    assert recommender._index_reload is None
+    assert index.neighbours('toilet_0') == [('toilet_1', 0.5), ('toilet_5', pytest.approx(0.1))]
+    assert index.neighbours('toilet_5')[-1] == ('toilet_0', pytest.approx(0.1))
+
+def test_rebuild_is_reloaded_in_the_background(recommender):
+    index = recommender.get_neighbour_index()
+    recommender.cursor.execute('UPDATE image_similarities SET similarity_score = 0.9 WHERE image_key1 = 1')
+    bump_index_version(recommender.cursor, 'similarities')
+    recommender.conn.commit()
+
+    # The current index keeps serving until the new one is complete
+    assert recommender.get_neighbour_index() is index
+    recommender._index_reload.join()
+    reloaded = recommender.get_neighbour_index()
+    assert reloaded is not index
+    assert reloaded.neighbours('toilet_0') == [('toilet_1', pytest.approx(0.9))]
+
+def test_pruned_changes_force_a_reload(recommender):
+    index = recommender.get_neighbour_index()
+    like(recommender, 'user_1', ['toilet_0', 'toilet_5'])
+    recommender.cursor.execute('DELETE FROM similarity_changes')
+    recommender.conn.commit()
+    like(recommender, 'user_1', ['toilet_9'])
+
+    assert not index.apply_changes(recommender.cursor)
+    recommender.get_neighbour_index()
+    recommender._index_reload.join()
+    reloaded = recommender.get_neighbour_index()
+    assert reloaded is not index
+    assert 'toilet_9' in dict(reloaded.neighbours('toilet_0'))
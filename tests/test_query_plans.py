@@ -0,0 +1,52 @@
+import sqlite3
+
+import pytest
+
+from process_data import CATEGORIES
+from database import explain_query_plan
+from setup_database import QUERY_PLAN_CHECKS, SCHEMA_MIGRATIONS, get_schema_version, migrate_schema, verify_query_plans
+
+@pytest.fixture
+def migrated_db(tmp_path):
+    """A database migrated to the latest schema, with enough rows for ANALYZE to have statistics."""
+    conn = sqlite3.connect(tmp_path / 'plans.db')
+    cursor = conn.cursor()
+    migrate_schema(cursor, analyze=False)
+
+    cursor.executemany(
+        'INSERT INTO images (id, url, description, source, category, popularity, shuffle_key) VALUES (?, ?, ?, ?, ?, ?, ?)',
+        ((f"{category}_{i}", f"http://example.com/{category}/{i}.jpg", 'white marble bath', 'Pinterest',
+          category, i % 17, i) for category in CATEGORIES for i in range(200))
+    )
+    cursor.executemany(
+        'INSERT INTO user_preferences (user_id, image_id, rating, timestamp) VALUES (?, ?, ?, ?)',
+        ((f"user_{i % 20}", f"toilet_{i}", 1 if i % 3 else -1, f"2026-01-01 00:00:{i % 60:02d}") for i in range(200))
+    )
+    cursor.executemany(
+        'INSERT INTO image_similarities (image_key1, image_key2, similarity_score) VALUES (?, ?, ?)',
+        ((key, key + offset, 0.5 + offset / 100) for key in range(1, 500) for offset in range(1, 6))
+    )
+    conn.commit()
+    cursor.execute('ANALYZE')
+    conn.commit()
+    yield cursor
+    conn.close()
+
+def test_migrations_reach_latest_version(migrated_db):
+    assert get_schema_version(migrated_db) == SCHEMA_MIGRATIONS[-1][0]
+
+def test_migrations_are_idempotent(migrated_db):
+    assert migrate_schema(migrated_db) == []
+
+@pytest.mark.parametrize('sql, params, index', [
+    pytest.param(sql, params, index, id=name) for name, sql, params, index in QUERY_PLAN_CHECKS
+])
+def test_hot_query_uses_its_index(migrated_db, sql, params, index):
+    plan = explain_query_plan(migrated_db, sql, params)
+    assert any(index in line for line in plan), plan
+    assert not any('USE TEMP B-TREE' in line for line in plan), plan
+
+def test_verify_query_plans_reports_every_check(migrated_db):
+    results = verify_query_plans(migrated_db)
+    assert [result['query'] for result in results] == [name for name, _, _, _ in QUERY_PLAN_CHECKS]
+    assert all(result['ok'] for result in results)
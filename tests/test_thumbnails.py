@@ -0,0 +1,94 @@
+import io
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from PIL import Image
+
+from thumbnails import FORMATS, TOUCH_INTERVAL, ThumbnailCache, ThumbnailService, variant_key
+
+WIDTHS = (100, 200)
+
+def make_original(width=400, height=600):
+    output = io.BytesIO()
+    Image.new('RGB', (width, height), 'white').save(output, 'JPEG')
+    return output.getvalue()
+
+@pytest.fixture
+def image_server():
+    """Local HTTP server returning the same JPEG for every path, counting requests."""
+    body = make_original()
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.path)
+            # Long enough for concurrent requests to find the download in flight
+            time.sleep(0.2)
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", requests
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def service(tmp_path):
+    service = ThumbnailService(str(tmp_path / 'thumbnails'), widths=WIDTHS, workers=2)
+    yield service
+    service.close()
+
+def test_second_request_is_a_cache_hit(image_server, service):
+    base_url, requests = image_server
+    url = f"{base_url}/originals/1.jpg"
+
+    key, data = service.get(url, 100, 'jpeg')
+    assert key == variant_key(url, 100, 'jpeg')
+    assert Image.open(io.BytesIO(data)).width == 100
+
+    assert service.get(url, 100, 'jpeg') == (key, data)
+    assert service.cache.stats()['hits'] == 1
+    assert len(requests) == 1
+
+def test_concurrent_requests_share_one_fetch(image_server, service):
+    base_url, requests = image_server
+    url = f"{base_url}/originals/2.jpg"
+    wanted = [(width, fmt) for width in WIDTHS for fmt in FORMATS] * 2
+
+    with ThreadPoolExecutor(len(wanted)) as executor:
+        results = list(executor.map(lambda variant: service.get(url, *variant), wanted))
+
+    assert len(requests) == 1
+    assert service.fetches == 1
+    assert {key for key, _ in results} == {variant_key(url, width, fmt) for width, fmt in wanted}
+    # Every width and format was cached by the one download
+    for width, fmt in wanted:
+        assert service.cache.get(variant_key(url, width, fmt)) is not None
+
+def test_cache_hits_only_touch_old_files(tmp_path):
+    cache = ThumbnailCache(str(tmp_path), max_bytes=1024 * 1024)
+    cache.put('ab' * 32, 'jpg', b'fresh')
+    cache.put('cd' * 32, 'jpg', b'stale')
+    fresh_path = cache._files['ab' * 32][0]
+    stale_path = cache._files['cd' * 32][0]
+
+    recent = time.time() - 60
+    old = time.time() - TOUCH_INTERVAL - 60
+    os.utime(fresh_path, (recent, recent))
+    os.utime(stale_path, (old, old))
+
+    assert cache.get('ab' * 32) == b'fresh'
+    assert cache.get('cd' * 32) == b'stale'
+    assert os.stat(fresh_path).st_mtime == pytest.approx(recent)
+    assert os.stat(stale_path).st_mtime > time.time() - 60
@@ -0,0 +1,125 @@
+import asyncio
+import sqlite3
+import threading
+from collections import Counter
+
+import pytest
+from aiohttp import web
+
+from setup_database import migrate_schema
+from url_health import check_catalog, check_urls_async
+
+REQUESTS = web.AppKey('requests', Counter)
+
+async def handle(request):
+    request.app[REQUESTS][(request.method, request.match_info['kind'])] += 1
+    kind = request.match_info['kind']
+    if kind == 'gone':
+        return web.Response(status=404)
+    if kind == 'busy':
+        return web.Response(status=503)
+    if kind == 'blocked':
+        return web.Response(status=403)
+    if kind == 'removed':
+        return web.Response(status=410)
+    if kind == 'page':
+        return web.Response(text='<html>Pin not found</html>', content_type='text/html')
+    if kind == 'nohead' and request.method == 'HEAD':
+        return web.Response(status=405)
+    return web.Response(body=b'\xff\xd8' + b'\0' * 510, content_type='image/jpeg')
+
+def make_app():
+    app = web.Application()
+    app[REQUESTS] = Counter()
+    app.router.add_route('*', '/{kind}/{name}', handle)
+    return app
+
+async def start_server(app):
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    return runner, f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+EXPECTED = {
+    'ok': 'ok', 'nohead': 'ok', 'gone': 'dead', 'removed': 'dead', 'page': 'dead', 'busy': 'error', 'blocked': 'error'
+}
+
+def test_check_urls_verdicts_and_get_fallback():
+    app = make_app()
+
+    async def run():
+        runner, base_url = await start_server(app)
+        try:
+            return base_url, await check_urls_async([f"{base_url}/{kind}/1.jpg" for kind in EXPECTED], timeout=5)
+        finally:
+            await runner.cleanup()
+
+    base_url, results = asyncio.run(run())
+    verdicts = {row[0]: row[4] for row in results}
+    assert verdicts == {f"{base_url}/{kind}/1.jpg": verdict for kind, verdict in EXPECTED.items()}
+
+    requests = app[REQUESTS]
+    # A 2xx HEAD is enough; a rejected HEAD is retried as a GET
+    assert requests[('HEAD', 'ok')] == 1 and requests[('GET', 'ok')] == 0
+    assert requests[('HEAD', 'nohead')] == 1 and requests[('GET', 'nohead')] == 1
+    assert requests[('GET', 'busy')] == 1
+
+@pytest.fixture
+def image_server():
+    """The stub hosts on their own event loop thread, for the blocking check_urls callers."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    runner, base_url = asyncio.run_coroutine_threadsafe(start_server(make_app()), loop).result()
+    yield base_url
+    asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+
+@pytest.fixture
+def catalog(tmp_path, image_server):
+    """A database with one image per stub URL kind, and a like and similarity edge on the dead one."""
+    db_path = str(tmp_path / 'catalog.db')
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    migrate_schema(cursor, analyze=False)
+    cursor.executemany(
+        'INSERT INTO images (id, url, description, source, category, popularity, shuffle_key) VALUES (?, ?, ?, ?, ?, ?, ?)',
+        ((f"bathtub_{kind}", f"{image_server}/{kind}/1.jpg", 'bathroom', 'Pinterest', 'bathtub', 0, i)
+         for i, kind in enumerate(EXPECTED))
+    )
+    cursor.execute('SELECT image_key FROM images WHERE id = ?', ('bathtub_gone',))
+    gone_key = cursor.fetchone()[0]
+    cursor.execute('INSERT INTO image_similarities (image_key1, image_key2, similarity_score) VALUES (?, 1, 0.5)', (gone_key,))
+    cursor.execute("INSERT INTO user_preferences (user_id, image_id, rating) VALUES ('user_1', 'bathtub_gone', 1)")
+    conn.commit()
+    yield db_path, cursor, gone_key
+    conn.close()
+
+def test_check_catalog_flags_dead_images(catalog):
+    db_path, cursor, gone_key = catalog
+
+    summary = check_catalog(db_path, timeout=5)
+    assert summary == {'ok': 2, 'dead': 3, 'error': 2}
+
+    cursor.execute('SELECT id FROM images WHERE dead = 1 ORDER BY id')
+    assert [row[0] for row in cursor.fetchall()] == ['bathtub_gone', 'bathtub_page', 'bathtub_removed']
+    # Nothing is deleted by default
+    cursor.execute('SELECT COUNT(*) FROM images')
+    assert cursor.fetchone()[0] == len(EXPECTED)
+    cursor.execute('SELECT COUNT(*) FROM image_similarities WHERE image_key1 = ?', (gone_key,))
+    assert cursor.fetchone()[0] == 1
+    cursor.execute("SELECT total FROM user_preference_counts WHERE user_id = 'user_1'")
+    assert cursor.fetchone() == (1,)
+
+def test_check_catalog_removes_dead_images_on_request(catalog):
+    db_path, cursor, gone_key = catalog
+
+    summary = check_catalog(db_path, remove_dead=True, timeout=5)
+    assert summary == {'ok': 2, 'dead': 3, 'error': 2}
+
+    cursor.execute('SELECT id FROM images ORDER BY id')
+    assert [row[0] for row in cursor.fetchall()] == ['bathtub_blocked', 'bathtub_busy', 'bathtub_nohead', 'bathtub_ok']
+    cursor.execute('SELECT COUNT(*) FROM image_similarities WHERE image_key1 = ?', (gone_key,))
+    assert cursor.fetchone()[0] == 0
+    cursor.execute("SELECT total FROM user_preference_counts WHERE user_id = 'user_1'")
+    assert cursor.fetchone() == (0,)
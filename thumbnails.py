@@ -0,0 +1,274 @@
+import io
+import os
+import time
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image, ImageOps
+
+THUMBNAIL_DIR = os.environ.get('BATHROOM_THUMBNAIL_DIR', 'data/thumbnails')
+THUMBNAIL_CACHE_BYTES = int(os.environ.get('BATHROOM_THUMBNAIL_CACHE_MB', 1024)) * 1024 * 1024
+
+# Grid cards are 250-400px wide; these cover them on 1x and 2x screens and the similar page
+THUMBNAIL_WIDTHS = (236, 474, 736)
+
+# Encoded variants: (MIME type, file extension, Pillow format, Pillow save options)
+FORMATS = {
+    'webp': ('image/webp', 'webp', 'WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('image/jpeg', 'jpg', 'JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+FETCH_TIMEOUT = (3.05, 10)  # connect and read timeouts in seconds
+MAX_ORIGINAL_BYTES = 20 * 1024 * 1024
+FAILURE_TTL = 300  # seconds before an original that failed is fetched again
+MAX_FAILURES = 10000
+
+# Seconds between mtime updates of a cached file; the LRU order on disk only needs to be roughly right
+TOUCH_INTERVAL = 3600
+
+# A variant's address covers its source URL, width and format, so its bytes never change
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+class ThumbnailError(Exception):
+    """The original image could not be fetched or decoded."""
+
+def choose_format(accept):
+    """Pick WebP when the Accept header allows it, JPEG otherwise."""
+    return 'webp' if 'image/webp' in (accept or '') else 'jpeg'
+
+def variant_key(url, width, fmt):
+    """Address of a variant: the SHA-256 of its source URL, width and format."""
+    return hashlib.sha256(f"{url}\n{width}\n{fmt}".encode('utf-8')).hexdigest()
+
+def make_session(pool_size=32):
+    """A requests session with a connection pool large enough for concurrent thumbnail misses."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['User-Agent'] = 'bathroom-recommender-thumbnails/1.0'
+    return session
+
+def render_variants(original, widths, fmt):
+    """Decode an original once and encode it at each width, never upscaling. Returns {width: bytes}."""
+    _, _, pillow_format, options = FORMATS[fmt]
+    try:
+        with Image.open(io.BytesIO(original)) as image:
+            # Let the JPEG decoder scale down by a power of two while staying above the largest width
+            image.draft('RGB', (max(widths), max(widths)))
+            image = ImageOps.exif_transpose(image)
+            if image.mode not in ('RGB', 'RGBA'):
+                has_alpha = image.mode in ('LA', 'PA') or 'transparency' in image.info
+                image = image.convert('RGBA' if has_alpha else 'RGB')
+            if fmt == 'jpeg' and image.mode == 'RGBA':
+                background = Image.new('RGB', image.size, 'white')
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+
+            variants = {}
+            # Resize from the previous, larger variant rather than from the original each time
+            for width in sorted(widths, reverse=True):
+                if image.width > width:
+                    image = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+                output = io.BytesIO()
+                image.save(output, pillow_format, **options)
+                variants[width] = output.getvalue()
+            return variants
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise ThumbnailError(f"Could not decode image: {e}") from e
+
+class ThumbnailCache:
+    """Disk cache of encoded variants, evicting the least recently used files over a size budget.
+
+    Files live at <directory>/<key[:2]>/<key>.<ext>. Reads touch the file's
+    mtime when it is over TOUCH_INTERVAL old, so the recency order survives
+    a restart without a metadata write on every hit.
+    """
+
+    def __init__(self, directory=THUMBNAIL_DIR, max_bytes=THUMBNAIL_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._files = OrderedDict()  # key -> (path, size), least recently used first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._load()
+
+    def _load(self):
+        """Index the files already on disk, oldest first."""
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                key, ext = os.path.splitext(name)
+                if not ext or name.startswith('.'):
+                    continue
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                found.append((stat.st_mtime, key, path, stat.st_size))
+        for _, key, path, size in sorted(found):
+            self._files[key] = (path, size)
+            self._bytes += size
+        self._evict()
+
+    def get(self, key):
+        """Get the bytes of a cached variant, or None."""
+        with self._lock:
+            entry = self._files.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._files.move_to_end(key)
+
+        path = entry[0]
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+                touched_at = os.fstat(f.fileno()).st_mtime
+            now = time.time()
+            if now - touched_at > TOUCH_INTERVAL:
+                os.utime(path, (now, now))
+        except FileNotFoundError:
+            # Evicted by another thread, or removed from disk
+            with self._lock:
+                if self._files.get(key) == entry:
+                    del self._files[key]
+                    self._bytes -= entry[1]
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key, ext, data):
+        """Store a variant, evicting the least recently used files to stay within max_bytes."""
+        directory = os.path.join(self.directory, key[:2])
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{key}.{ext}")
+        # Write to a temporary file first so readers never see a partial image
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            previous = self._files.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._files[key] = (path, len(data))
+            self._bytes += len(data)
+            self._evict()
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and len(self._files) > 1:
+            _, (path, size) = self._files.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        """Counters in the shape of RecommendationCache.stats(), plus the bytes on disk."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._files),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': 0,
+            }
+
+class ThumbnailService:
+    """Resized variants of source images, fetched once and served from the disk cache.
+
+    On a miss the original is downloaded through a pooled session and every
+    width in `widths` is rendered in every format on the worker pool, so the
+    other widths and formats are cached by the same fetch. Concurrent requests
+    for the same original wait for one download instead of starting their own.
+    """
+
+    def __init__(self, directory=THUMBNAIL_DIR, max_bytes=THUMBNAIL_CACHE_BYTES, widths=THUMBNAIL_WIDTHS,
+                 workers=None, session=None):
+        self.cache = ThumbnailCache(directory, max_bytes)
+        self.widths = tuple(widths)
+        self.session = session or make_session()
+        self._executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count(), thread_name_prefix='thumbnail')
+        self._inflight = {}
+        self._failures = OrderedDict()  # url -> time of the failure
+        self._lock = threading.Lock()
+        self.fetches = 0
+
+    def get(self, url, width, fmt):
+        """Get (key, bytes) of a variant. Raises ThumbnailError if the original is unavailable."""
+        key = variant_key(url, width, fmt)
+        data = self.cache.get(key)
+        if data is not None:
+            return key, data
+
+        with self._lock:
+            failed_at = self._failures.get(url)
+            if failed_at is not None and time.monotonic() - failed_at < FAILURE_TTL:
+                raise ThumbnailError(f"Original recently failed: {url}")
+            future = self._inflight.get(url)
+            owner = future is None
+            if owner:
+                future = self._inflight[url] = Future()
+
+        if owner:
+            try:
+                future.set_result(self._build(url))
+            except Exception as e:
+                if isinstance(e, ThumbnailError):
+                    with self._lock:
+                        self._failures[url] = time.monotonic()
+                        while len(self._failures) > MAX_FAILURES:
+                            self._failures.popitem(last=False)
+                # Waiting requests get the same error
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    del self._inflight[url]
+        return key, future.result()[fmt][width]
+
+    def _build(self, url):
+        """Fetch an original and cache every variant of it. Returns {format: {width: bytes}}."""
+        original = self.fetch(url)
+        renders = {fmt: self._executor.submit(render_variants, original, self.widths, fmt) for fmt in FORMATS}
+        variants = {}
+        for fmt, render in renders.items():
+            variants[fmt] = render.result()
+            ext = FORMATS[fmt][1]
+            for width, data in variants[fmt].items():
+                self.cache.put(variant_key(url, width, fmt), ext, data)
+        return variants
+
+    def fetch(self, url):
+        """Download an original, refusing anything over MAX_ORIGINAL_BYTES."""
+        self.fetches += 1
+        try:
+            with self.session.get(url, timeout=FETCH_TIMEOUT, stream=True) as response:
+                response.raise_for_status()
+                content = bytearray()
+                for chunk in response.iter_content(65536):
+                    content += chunk
+                    if len(content) > MAX_ORIGINAL_BYTES:
+                        raise ThumbnailError(f"Original larger than {MAX_ORIGINAL_BYTES} bytes: {url}")
+                return bytes(content)
+        except requests.RequestException as e:
+            raise ThumbnailError(f"Could not fetch {url}: {e}") from e
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.session.close()
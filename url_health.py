@@ -0,0 +1,277 @@
+import time
+import asyncio
+import sqlite3
+import argparse
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from setup_database import bump_index_version, get_image_keys
+
+# Requests in flight in total, and to any one host
+MAX_CONNECTIONS = 100
+MAX_PER_HOST = 8
+
+# Seconds allowed for one request, and for opening its connection
+CHECK_TIMEOUT = 10
+CONNECT_TIMEOUT = 5
+
+# Seconds a check stays fresh, by verdict: dead links rarely come back, errors are often transient
+CHECK_TTL = {
+    'ok': 7 * 86400,
+    'dead': 30 * 86400,
+    'error': 86400,
+}
+
+# Statuses that mean the image is gone. Anything else, including 401/403/451 from CDNs
+# that block hotlinking or unknown user agents, may succeed later and is only an error
+DEAD_STATUSES = {404, 410}
+
+USER_AGENT = 'bathroom-recommender-url-check/1.0'
+
+def verdict(status, content_type):
+    """Classify a check as 'ok', 'dead' (gone or not an image) or 'error' (unknown, check again soon)."""
+    if status is None:
+        return 'error'
+    if 200 <= status < 300:
+        # A missing Content-Type gets the benefit of the doubt; an HTML page does not
+        return 'ok' if content_type is None or content_type.startswith('image/') else 'dead'
+    if status in DEAD_STATUSES:
+        return 'dead'
+    return 'error'
+
+async def check_url(session, url, timeout=CHECK_TIMEOUT):
+    """Check one URL with HEAD, falling back to GET when HEAD gives no clear answer.
+
+    Some servers reject or mishandle HEAD (405, 403, 5xx, dropped
+    connections), so any result other than 2xx or a timeout is retried as a
+    GET whose headers are read and whose body is not. Returns a url_checks row.
+    """
+    status = content_type = content_length = error = None
+    for method in ('HEAD', 'GET'):
+        try:
+            async with session.request(method, url, allow_redirects=True,
+                                       timeout=aiohttp.ClientTimeout(total=timeout, sock_connect=CONNECT_TIMEOUT)) as response:
+                status = response.status
+                content_type = response.content_type if 'Content-Type' in response.headers else None
+                content_length = response.content_length
+                error = None
+        except asyncio.TimeoutError:
+            status = content_type = content_length = None
+            error = f"{method} timed out after {timeout}s"
+            break
+        except (aiohttp.ClientError, ValueError) as e:
+            status = content_type = content_length = None
+            error = f"{method} {type(e).__name__}: {e}"[:200]
+        if status is not None and 200 <= status < 300:
+            break
+    return (url, status, content_type, content_length, verdict(status, content_type), error, int(time.time()))
+
+async def check_urls_async(urls, max_connections=MAX_CONNECTIONS, max_per_host=MAX_PER_HOST, timeout=CHECK_TIMEOUT):
+    """Check URLs concurrently over one pooled session. Returns url_checks rows in completion order.
+
+    Each host has its own semaphore, so the timeout only covers the request
+    itself and never time spent queueing behind other requests to that host.
+    """
+    host_limits = {}
+    results = []
+    pending = iter(urls)
+    connector = aiohttp.TCPConnector(limit=max_connections, limit_per_host=max_per_host, ttl_dns_cache=300)
+
+    async with aiohttp.ClientSession(connector=connector, headers={'User-Agent': USER_AGENT}) as session:
+        async def worker():
+            # Workers share one iterator, so at most max_connections URLs are in progress
+            for url in pending:
+                host = urlsplit(url).netloc
+                limit = host_limits.get(host)
+                if limit is None:
+                    limit = host_limits[host] = asyncio.Semaphore(max_per_host)
+                async with limit:
+                    results.append(await check_url(session, url, timeout))
+
+        await asyncio.gather(*(worker() for _ in range(max_connections)))
+    return results
+
+def check_urls(urls, **options):
+    """Blocking wrapper around check_urls_async."""
+    return asyncio.run(check_urls_async(urls, **options))
+
+def stale_urls(cursor, urls, now=None, batch_size=500):
+    """Get the distinct URLs that were never checked or whose last check has expired."""
+    now = time.time() if now is None else now
+    urls = list(dict.fromkeys(urls))
+    fresh = set()
+    for start in range(0, len(urls), batch_size):
+        batch = urls[start:start + batch_size]
+        placeholders = ', '.join('?' for _ in batch)
+        cursor.execute(f'SELECT url, verdict, checked_at FROM url_checks WHERE url IN ({placeholders})', batch)
+        fresh.update(url for url, result, checked_at in cursor.fetchall() if now - checked_at < CHECK_TTL.get(result, 0))
+    return [url for url in urls if url not in fresh]
+
+def dead_urls(cursor, urls, batch_size=500):
+    """Get the URLs whose last check found them dead."""
+    urls = list(dict.fromkeys(urls))
+    dead = set()
+    for start in range(0, len(urls), batch_size):
+        batch = urls[start:start + batch_size]
+        placeholders = ', '.join('?' for _ in batch)
+        cursor.execute(f"SELECT url FROM url_checks WHERE verdict = 'dead' AND url IN ({placeholders})", batch)
+        dead.update(row[0] for row in cursor.fetchall())
+    return dead
+
+def record_url_checks(cursor, results):
+    """Store check results, replacing earlier checks of the same URLs."""
+    cursor.executemany('''
+    INSERT INTO url_checks (url, status, content_type, content_length, verdict, error, checked_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(url) DO UPDATE SET
+        status = excluded.status,
+        content_type = excluded.content_type,
+        content_length = excluded.content_length,
+        verdict = excluded.verdict,
+        error = excluded.error,
+        checked_at = excluded.checked_at
+    ''', results)
+
+def filter_live_images(cursor, categories, **options):
+    """Drop images whose URL is dead, checking stale URLs first.
+
+    Ingest stage run after filter_irrelevant_images: only URLs without a
+    fresh check go over the network, and the results are recorded in
+    url_checks. Images whose check failed without a verdict are kept.
+    Returns (filtered categories, number of URLs checked).
+    """
+    urls = [image['url'] for images in categories.values() for image in images]
+    to_check = stale_urls(cursor, urls)
+    if to_check:
+        record_url_checks(cursor, check_urls(to_check, **options))
+    dead = dead_urls(cursor, urls)
+    filtered = {
+        category: [image for image in images if image['url'] not in dead]
+        for category, images in categories.items()
+    }
+    return filtered, len(to_check)
+
+def mark_dead_images(cursor, image_ids=None, batch_size=500):
+    """Set the dead flag of images from their URL's last check, clearing it for URLs that recovered.
+
+    Covers every image, or only `image_ids`. Flagged images are left out of
+    the feeds; their rows and user history are kept. Returns the number of
+    images whose flag changed.
+    """
+    update = '''
+    UPDATE images SET dead = 1 - dead
+    WHERE dead != EXISTS (SELECT 1 FROM url_checks c WHERE c.url = images.url AND c.verdict = 'dead')
+    '''
+    changed = 0
+    if image_ids is None:
+        cursor.execute(update)
+        changed = cursor.rowcount
+    else:
+        image_ids = list(image_ids)
+        for start in range(0, len(image_ids), batch_size):
+            batch = image_ids[start:start + batch_size]
+            placeholders = ', '.join('?' for _ in batch)
+            cursor.execute(update + f' AND id IN ({placeholders})', batch)
+            changed += cursor.rowcount
+    if changed:
+        # Running recommenders drop their cached rows, which hold the old flag
+        bump_index_version(cursor, 'similarities')
+    return changed
+
+def remove_images(cursor, image_ids, batch_size=500):
+    """Delete images with their similarity edges, collaborative neighbours and user history.
+
+    Irreversible, so only done on request (--remove-dead); mark_dead_images
+    hides images without losing anything. The insight triggers keep the
+    per-user counters in step with the deleted preferences and views.
+    Unknown ids are ignored. Returns the number of images deleted.
+    """
+    keys = get_image_keys(cursor, image_ids)
+    removed_ids = list(keys)
+    removed_keys = list(keys.values())
+    for start in range(0, len(removed_ids), batch_size):
+        ids = removed_ids[start:start + batch_size]
+        batch = removed_keys[start:start + batch_size]
+        placeholders = ', '.join('?' for _ in batch)
+        for table in ('image_similarities', 'collaborative_neighbours'):
+            cursor.execute(f'DELETE FROM {table} WHERE image_key1 IN ({placeholders})', batch)
+            cursor.execute(f'DELETE FROM {table} WHERE image_key2 IN ({placeholders})', batch)
+        cursor.execute(f'DELETE FROM user_preferences WHERE image_id IN ({placeholders})', ids)
+        cursor.execute(f'DELETE FROM user_sessions WHERE image_id IN ({placeholders})', ids)
+        cursor.execute(f'DELETE FROM images WHERE id IN ({placeholders})', ids)
+    if removed_ids:
+        # Running recommenders reload their neighbour lists and drop cached rows
+        bump_index_version(cursor, 'similarities')
+        bump_index_version(cursor, 'collaborative')
+    return len(removed_ids)
+
+def remove_dead_images(cursor):
+    """Delete every image flagged dead by mark_dead_images. Returns the number deleted."""
+    cursor.execute('SELECT id FROM images WHERE dead = 1')
+    return remove_images(cursor, [row[0] for row in cursor.fetchall()])
+
+def check_catalog(db_path, batch_size=5000, remove_dead=False, **options):
+    """Re-check the stale URLs of every image in a database and summarize the catalog's health.
+
+    Results are committed per batch, so an interrupted run keeps its
+    progress. Images found dead are then flagged and left out of the feeds,
+    or deleted with their history if `remove_dead` is set (see
+    remove_images). Returns {verdict: image count} counted before any
+    deletion, with 'unchecked' for images that have no check yet.
+    """
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    cursor.execute('SELECT url FROM images')
+    to_check = stale_urls(cursor, (row[0] for row in cursor.fetchall()))
+    print(f"Checking {len(to_check)} stale URLs...")
+
+    start_time = time.perf_counter()
+    for start in range(0, len(to_check), batch_size):
+        record_url_checks(cursor, check_urls(to_check[start:start + batch_size], **options))
+        conn.commit()
+        done = min(start + batch_size, len(to_check))
+        print(f"Checked {done}/{len(to_check)} URLs ({done / (time.perf_counter() - start_time):.0f} URLs/sec)")
+
+    cursor.execute('''
+    SELECT COALESCE(c.verdict, 'unchecked'), COUNT(*)
+    FROM images i
+    LEFT JOIN url_checks c ON c.url = i.url
+    GROUP BY 1
+    ''')
+    summary = dict(cursor.fetchall())
+    changed = mark_dead_images(cursor)
+    removed = remove_dead_images(cursor) if remove_dead else 0
+    conn.commit()
+    conn.close()
+
+    print("URL health: " + ', '.join(f"{name}: {count}" for name, count in sorted(summary.items())))
+    print(f"Updated the dead flag of {changed} images.")
+    if remove_dead:
+        print(f"Removed {removed} images with dead URLs.")
+    return summary
+
+if __name__ == '__main__':
+    from setup_database import migrate_schema
+
+    parser = argparse.ArgumentParser(description='Check the image URLs of a database and record their health.')
+    parser.add_argument('--db', default='data/bathroom_images.db', help='path to the SQLite database')
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS, help='requests in flight in total')
+    parser.add_argument('--max-per-host', type=int, default=MAX_PER_HOST, help='requests in flight per host')
+    parser.add_argument('--timeout', type=float, default=CHECK_TIMEOUT, help='seconds allowed per request')
+    parser.add_argument('--remove-dead', action='store_true',
+                        help='delete images with dead URLs and their user history instead of hiding them')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    migrate_schema(conn.cursor())
+    conn.close()
+
+    check_catalog(
+        args.db,
+        max_connections=args.max_connections,
+        max_per_host=args.max_per_host,
+        timeout=args.timeout,
+        remove_dead=args.remove_dead
+    )
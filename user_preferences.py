@@ -12,13 +12,15 @@ from recommendation_system import RecommendationSystem
 
 class UserPreferenceTracker:
     def __init__(self, db_path='data/bathroom_images.db'):
-        """Initialize the user preference tracker with database connection."""
+        """Initialize the user preference tracker, sharing the recommender's connections."""
         self.db_path = db_path
-        self.conn = sqlite3.connect(db_path)
-        self.conn.row_factory = sqlite3.Row
-        self.cursor = self.conn.cursor()
         self.recommender = RecommendationSystem(db_path)
     
+    @property
+    def cursor(self):
+        """The calling thread's cursor."""
+        return self.recommender.cursor
+    
     def get_user_preferences(self, user_id):
         """Get all preferences for a specific user."""
         self.cursor.execute('''
@@ -57,77 +59,88 @@ class UserPreferenceTracker:
     
     def get_preference_insights(self, user_id):
         """Get insights about user preferences."""
-        # Get total interactions
-        self.cursor.execute('''
-        SELECT COUNT(*) as total FROM user_preferences
-        WHERE user_id = ?
-        ''', (user_id,))
-        total_interactions = self.cursor.fetchone()['total']
-        
-        # Get likes count
-        self.cursor.execute('''
-        SELECT COUNT(*) as likes FROM user_preferences
-        WHERE user_id = ? AND rating > 0
-        ''', (user_id,))
-        likes = self.cursor.fetchone()['likes']
-        
-        # Get dislikes count
-        self.cursor.execute('''
-        SELECT COUNT(*) as dislikes FROM user_preferences
-        WHERE user_id = ? AND rating < 0
-        ''', (user_id,))
-        dislikes = self.cursor.fetchone()['dislikes']
-        
-        # Get favorite category
-        self.cursor.execute('''
-        SELECT category FROM category_preferences
-        WHERE user_id = ?
-        ORDER BY preference_score DESC
-        LIMIT 1
-        ''', (user_id,))
-        result = self.cursor.fetchone()
-        favorite_category = result['category'] if result else None
+        return self.get_preference_insights_many([user_id])[user_id]
+    
+    def get_preference_insights_many(self, user_ids, batch_size=500):
+        """Get insights for many users, one aggregated query per batch of users.
         
-        # Get least favorite category
-        self.cursor.execute('''
-        SELECT category FROM category_preferences
-        WHERE user_id = ?
-        ORDER BY preference_score ASC
-        LIMIT 1
-        ''', (user_id,))
-        result = self.cursor.fetchone()
-        least_favorite_category = result['category'] if result else None
+        Counts are read from the trigger-maintained user_preference_counts and
+        category_views summaries rather than the full history. The favorite,
+        least favorite and most viewed categories come from ROW_NUMBER()
+        windows partitioned by user, and all parts are folded into one row per
+        user by a single GROUP BY. Returns {user_id: insights}.
+        """
+        user_ids = list(dict.fromkeys(user_ids))
+        insights = {
+            user_id: {
+                'total_interactions': 0,
+                'likes': 0,
+                'dislikes': 0,
+                'favorite_category': None,
+                'least_favorite_category': None,
+                'most_viewed_category': None
+            }
+            for user_id in user_ids
+        }
         
-        # Get most viewed category
-        self.cursor.execute('''
-        SELECT i.category, COUNT(*) as view_count
-        FROM user_sessions s
-        JOIN images i ON s.image_id = i.id
-        WHERE s.user_id = ?
-        GROUP BY i.category
-        ORDER BY view_count DESC
-        LIMIT 1
-        ''', (user_id,))
-        result = self.cursor.fetchone()
-        most_viewed_category = result['category'] if result else None
+        for start in range(0, len(user_ids), batch_size):
+            batch = user_ids[start:start + batch_size]
+            self.cursor.execute('''
+            WITH users(user_id) AS (SELECT value FROM json_each(?))
+            SELECT user_id,
+                   SUM(total) AS total_interactions,
+                   SUM(likes) AS likes,
+                   SUM(dislikes) AS dislikes,
+                   MAX(favorite_category) AS favorite_category,
+                   MAX(least_favorite_category) AS least_favorite_category,
+                   MAX(most_viewed_category) AS most_viewed_category
+            FROM (
+                SELECT user_id, total, likes, dislikes,
+                       NULL AS favorite_category, NULL AS least_favorite_category, NULL AS most_viewed_category
+                FROM user_preference_counts
+                WHERE user_id IN users
+                
+                UNION ALL
+                
+                SELECT user_id, 0, 0, 0,
+                       CASE WHEN favorite_rank = 1 THEN category END,
+                       CASE WHEN least_favorite_rank = 1 THEN category END,
+                       NULL
+                FROM (
+                    SELECT user_id, category,
+                           ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY preference_score DESC, category) AS favorite_rank,
+                           ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY preference_score ASC, category) AS least_favorite_rank
+                    FROM category_preferences
+                    WHERE user_id IN users
+                )
+                WHERE favorite_rank = 1 OR least_favorite_rank = 1
+                
+                UNION ALL
+                
+                SELECT user_id, 0, 0, 0, NULL, NULL, category
+                FROM (
+                    SELECT user_id, category,
+                           ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY views DESC, category) AS view_rank
+                    FROM category_views
+                    WHERE user_id IN users AND views > 0
+                )
+                WHERE view_rank = 1
+            )
+            GROUP BY user_id
+            ''', (json.dumps(batch),))
+            
+            for row in self.cursor.fetchall():
+                insight = dict(row)
+                insights[insight.pop('user_id')] = insight
         
-        return {
-            'total_interactions': total_interactions,
-            'likes': likes,
-            'dislikes': dislikes,
-            'favorite_category': favorite_category,
-            'least_favorite_category': least_favorite_category,
-            'most_viewed_category': most_viewed_category
-        }
+        return insights
     
     def generate_personalized_recommendations(self, user_id, limit=5):
         """Generate personalized recommendations based on user preferences."""
         return self.recommender.get_personalized_recommendations(user_id, limit)
     
     def close(self):
-        """Close the database connection."""
-        if self.conn:
-            self.conn.close()
+        """Close the database connections."""
         if self.recommender:
             self.recommender.close()
 